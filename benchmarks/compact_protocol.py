@@ -0,0 +1,54 @@
+"""
+Compare the compact binary subprotocol with JSON on a replay of room traffic: bytes on the wire,
+with and without permessage-deflate, and CPU per message to encode and decode:
+
+    python benchmarks/compact_protocol.py
+"""
+import json
+import time
+
+from ws4redis import compact
+from ws4redis.deflate import PerMessageDeflate
+
+from permessage_deflate import room_traffic
+
+
+def deflated(messages):
+    sender = PerMessageDeflate.negotiate('permessage-deflate', window_bits=12, min_size=64)
+    wire = 0
+    for message in messages:
+        compressed = sender.compress(message)
+        wire += len(message if compressed is None else compressed)
+    return wire
+
+
+def per_message(function, items):
+    started = time.process_time()
+    for item in items:
+        function(item)
+    return (time.process_time() - started) / len(items)
+
+
+def main():
+    messages = room_traffic(20000)
+    events = [json.loads(message.decode('utf-8')) for message in messages]
+    packed = [compact.pack(event) for event in events]
+    raw = sum(len(message) for message in messages)
+    print("{0} messages\n".format(len(messages)))
+    print("{0:>8} {1:>10} {2:>16} {3:>12} {4:>12}".format('encoding', 'KiB', 'KiB deflated', 'encode', 'decode'))
+    for name, wire, encode, decode in (
+            ('json', messages, lambda event: json.dumps(event).encode('utf-8'),
+             lambda message: json.loads(message.decode('utf-8'))),
+            ('compact', packed, compact.pack, compact.unpack)):
+        size = sum(len(message) for message in wire)
+        print("{0:>8} {1:>10.1f} {2:>16.1f} {3:>10.2f}us {4:>10.2f}us".format(
+            name, size / 1024.0, deflated(wire) / 1024.0,
+            per_message(encode, events) * 1e6, per_message(decode, wire) * 1e6))
+    print("\ncompact is {0:.0%} of json".format(sum(len(message) for message in packed) / float(raw)))
+    # what the servers actually do per published message: parse the JSON from Redis and pack it,
+    # once per process thanks to the cache in encode_message
+    print("json to compact: {0:.2f}us".format(per_message(compact.encode_message.__wrapped__, messages) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Measure how many small client frames per second WebSocket.receive parses, against reading each
+frame with separate recv calls for its header, length, mask and payload, as it used to be done:
+
+    python benchmarks/frame_reader.py
+"""
+import os
+import socket
+import struct
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lanes.settings')
+
+from ws4redis.websocket import Header, WebSocket
+
+# bytes sent at once, within what the socket buffers so that sending never blocks
+BATCH_SIZE = 32 * 1024
+
+
+class UnbufferedWebSocket(WebSocket):
+    """
+    The former frame reader, which asks the socket for each part of a frame on its own.
+    """
+    __slots__ = ()
+
+    def recv_exactly(self, size):
+        data = self.stream.read(size)
+        while len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+    def read_frame(self):
+        first_byte, second_byte = struct.unpack('!BB', self.recv_exactly(2))
+        header = Header(fin=first_byte & Header.FIN_MASK, opcode=first_byte & Header.OPCODE_MASK,
+                        flags=first_byte & Header.HEADER_FLAG_MASK, length=second_byte & Header.LENGTH_MASK)
+        if header.length == 126:
+            header.length = struct.unpack('!H', self.recv_exactly(2))[0]
+        elif header.length == 127:
+            header.length = struct.unpack('!Q', self.recv_exactly(8))[0]
+        if second_byte & Header.MASK_MASK:
+            header.mask = self.recv_exactly(4)
+        payload = self.recv_exactly(header.length)
+        if header.mask:
+            payload = header.unmask_payload(payload)
+        return header, payload
+
+
+def client_frame(payload):
+    header = Header(length=len(payload))
+    header.mask = os.urandom(4)
+    return Header.encode_header(True, WebSocket.OPCODE_TEXT, header.mask, len(payload), 0) + \
+        header.mask_payload(payload)
+
+
+def measure(websocket_class, payload, seconds=1.0):
+    server, client = socket.socketpair()
+    websocket = websocket_class(server)
+    frame = client_frame(payload)
+    count = max(1, BATCH_SIZE // len(frame))
+    data = frame * count
+    frames = 0
+    started = time.time()
+    while time.time() - started < seconds:
+        client.sendall(data)
+        for _ in range(count):
+            websocket.receive()
+        frames += count
+    elapsed = time.time() - started
+    server.close()
+    client.close()
+    return frames / elapsed
+
+
+def main():
+    print("{0:>12} {1:>16} {2:>16} {3:>9}".format('payload', 'unbuffered/s', 'buffered/s', 'speedup'))
+    for size in (16, 64, 512, 4096):
+        payload = b'x' * size
+        before = measure(UnbufferedWebSocket, payload)
+        after = measure(WebSocket, payload)
+        print("{0:>10} B {1:>16.0f} {2:>16.0f} {3:>8.1f}x".format(size, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+Compare Header.mask_payload against the former byte by byte XOR loop, for payload sizes from
+10 bytes to 1 MiB:
+
+    python benchmarks/mask_payload.py
+"""
+import os
+import timeit
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lanes.settings')
+
+from ws4redis.websocket import Header
+
+SIZES = (10, 100, 1024, 16 * 1024, 128 * 1024, 1024 * 1024)
+
+
+def bytewise_mask(mask, payload):
+    payload = bytearray(payload)
+    mask = bytearray(mask)
+    for i in range(len(payload)):
+        payload[i] ^= mask[i % 4]
+    return bytes(payload)
+
+
+def main():
+    print("{0:>10} {1:>14} {2:>14} {3:>9}".format('size', 'bytewise', 'mask_payload', 'speedup'))
+    for size in SIZES:
+        header = Header(length=size)
+        header.mask = os.urandom(4)
+        payload = os.urandom(size)
+        number = max(1, 1000000 // size)
+        before = min(timeit.repeat(lambda: bytewise_mask(header.mask, payload), number=number, repeat=3)) / number
+        after = min(timeit.repeat(lambda: header.mask_payload(payload), number=number, repeat=3)) / number
+        print("{0:>10} {1:>12.2f}us {2:>12.2f}us {3:>8.1f}x".format(size, before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Measure bandwidth and CPU per message of permessage-deflate on a replay of room traffic, for
+the window sizes and context takeover modes a server may negotiate:
+
+    python benchmarks/permessage_deflate.py
+"""
+import hashlib
+import json
+import random
+import time
+
+from ws4redis.deflate import PerMessageDeflate
+
+WORDS = ('the', 'deploy', 'is', 'green', 'again', 'anyone', 'seen', 'the', 'flaky', 'test', 'in',
+         'lanes', 'lunch', '?', 'ship', 'it', 'redis', 'websocket', 'pinned', 'that', ':)')
+USERS = ['user{0}'.format(i) for i in range(40)]
+
+
+def room_traffic(count, seed=1):
+    """
+    Events as published to a busy room: mostly chat messages, some votes, pins, status
+    changes and every 10 seconds a hotness update of the pinned board.
+    """
+    rnd = random.Random(seed)
+    events = []
+    for i in range(count):
+        kind = rnd.random()
+        if i % 50 == 49:
+            events.append({'type': 'hotness', 'posts': [
+                {'hotness': round(rnd.uniform(30000, 32000), 7), 'score': rnd.randint(-4, 30),
+                 'id': rnd.randint(1, 100000)} for _ in range(20)]})
+        elif kind < 0.8:
+            user = rnd.choice(USERS)
+            text = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 30)))
+            if rnd.random() < 0.05:
+                text = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+                content = ('<div class="ob"><iframe width="400" height="300" '
+                           'src="https://www.youtube.com/embed/dQw4w9WgXcQ" frameborder="0"></iframe></div>')
+            else:
+                content = text
+            events.append({'type': 'msg', 'author': {
+                'name': user, 'id': USERS.index(user) + 1,
+                'img': '/identicon/image/{0}.png'.format(hashlib.sha1(user.encode('ascii')).hexdigest())},
+                'content': content, 'raw': text, 'id': 100000 + i})
+        elif kind < 0.9:
+            events.append({'type': 'vote', 'content': rnd.randint(-4, 30), 'id': rnd.randint(1, 100000)})
+        elif kind < 0.95:
+            events.append({'type': 'pin', 'score': 1, 'id': rnd.randint(1, 100000), 'author_id': rnd.randint(1, 40)})
+        else:
+            events.append({'type': 'status', 'id': rnd.randint(1, 40), 'status': rnd.randint(0, 4)})
+    return [json.dumps(event).encode('utf-8') for event in events]
+
+
+def measure(messages, offer, **options):
+    sender = PerMessageDeflate.negotiate(offer, **options)
+    # the client inflates with the window the server compresses with
+    receiver = PerMessageDeflate(client_no_context_takeover=sender.server_no_context_takeover,
+                                 client_max_window_bits=sender.server_max_window_bits)
+    wire = 0
+    started = time.process_time()
+    for message in messages:
+        compressed = sender.compress(message)
+        if compressed is None:
+            wire += len(message)
+        else:
+            wire += len(compressed)
+            assert receiver.decompress(compressed) == message
+    elapsed = time.process_time() - started
+    return wire, elapsed / len(messages)
+
+
+def main():
+    messages = room_traffic(20000)
+    raw = sum(len(message) for message in messages)
+    print("{0} messages, {1:.1f} KiB, {2:.0f} B per message\n".format(len(messages), raw / 1024.0,
+                                                                      raw / float(len(messages))))
+    print("{0:>30} {1:>10} {2:>8} {3:>14}".format('mode', 'KiB', 'ratio', 'CPU/message'))
+    print("{0:>30} {1:>10.1f} {2:>8.2f} {3:>12.2f}us".format('uncompressed', raw / 1024.0, 1.0, 0.0))
+    for window_bits in (9, 12, 15):
+        for context_takeover in (True, False):
+            wire, cpu = measure(messages, 'permessage-deflate', window_bits=window_bits,
+                                context_takeover=context_takeover, min_size=64)
+            mode = '{0} bit window, {1}'.format(window_bits, 'takeover' if context_takeover else 'no takeover')
+            print("{0:>30} {1:>10.1f} {2:>8.2f} {3:>12.2f}us".format(mode, wire / 1024.0, wire / float(raw), cpu * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Compare Utf8Validator.validate against walking the DFA one octet at a time, on text frames
+as they occur in room traffic:
+
+    python benchmarks/utf8_validate.py
+"""
+import timeit
+
+from ws4redis.utf8validator import Utf8Validator
+
+FRAMES = {
+    'ascii 40 B': b'--ah-ah-ah-ah-stayin-alive--' + b'x' * 12,
+    'ascii 1 KiB': b'Lorem ipsum dolor sit amet. ' * 37,
+    'mixed 1 KiB': u'Gr\xfc\xdfe aus K\xf6ln ☃ \U0001f600 '.encode('utf-8') * 36,
+    'ascii 64 KiB': b'    def paste(self):\n        return 42\n' * 1724,
+}
+
+
+def main():
+    if not hasattr(Utf8Validator, 'validate_octets'):
+        print("wsaccel's Utf8Validator is installed, nothing to compare")
+        return
+    print("{0:>14} {1:>14} {2:>14} {3:>9}".format('frame', 'octet DFA', 'validate', 'speedup'))
+    for name, frame in sorted(FRAMES.items()):
+        validator = Utf8Validator()
+        number = max(1, 200000 // len(frame))
+
+        def octets():
+            validator.reset()
+            return validator.validate_octets(frame)
+
+        def chunk():
+            validator.reset()
+            return validator.validate(frame)
+
+        assert octets() == chunk()
+        before = min(timeit.repeat(octets, number=number, repeat=3)) / number
+        after = min(timeit.repeat(chunk, number=number, repeat=3)) / number
+        print("{0:>14} {1:>12.2f}us {2:>12.2f}us {3:>8.1f}x".format(name, before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Compare the modes uWSGIWebsocketServer runs websockets in (see WS4REDIS_UWSGI_MODE): blocking
+workers, async cores suspended with uwsgi.wait_fd_read, and gevent. Each mode is load tested with
+ws_loadtest.py on localhost, which needs uwsgi on the PATH and Redis running:
+
+    python benchmarks/uwsgi_modes.py --clients 2000 --rooms 50 --rate 50
+
+Blocking workers hold as many websockets as there are processes, and views wait behind them.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+MODES = ('uwsgi-sync', 'uwsgi-async', 'uwsgi')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=50)
+    parser.add_argument('--duration', type=float, default=20)
+    args = parser.parse_args()
+
+    loadtest = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ws_loadtest.py')
+    print("{0:>12} {1:>8} {2:>10} {3:>10} {4:>10} {5:>12} {6:>10}".format(
+        'mode', 'clients', 'p50 ms', 'p99 ms', 'msg/s', 'KiB/client', 'view ms'))
+    for mode in MODES:
+        output = subprocess.check_output([
+            sys.executable, loadtest, '--server', mode, '--json', '--clients', str(args.clients),
+            '--rooms', str(args.rooms), '--rate', str(args.rate), '--duration', str(args.duration)])
+        # anything printed before the results are failures of single clients
+        output = output.decode('utf-8')
+        results = json.loads(output[output.index('{'):])
+        latency = results['latency_ms']
+        memory = results['memory_per_client']
+        print("{0:>12} {1:>8} {2:>10} {3:>10} {4:>10.0f} {5:>12} {6:>10}".format(
+            'gevent' if mode == 'uwsgi' else mode[6:], results['clients'],
+            '{0:.1f}'.format(latency['p50']) if latency else '-',
+            '{0:.1f}'.format(latency['p99']) if latency else '-',
+            results['delivery_rate'],
+            '{0:.1f}'.format(memory / 1024.0) if memory is not None else '-',
+            '{0:.0f}'.format(results['view_time'] * 1000) if results['view_time'] is not None else 'timeout'))
+
+
+if __name__ == '__main__':
+    main()
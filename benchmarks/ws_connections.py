@@ -0,0 +1,93 @@
+"""
+Measure how many websockets a server process holds, and how cheaply it fans out messages to them.
+
+Run it once against the threaded runserver (./manage.py runserver) and once against the hub
+(python hub_websocket.py 127.0.0.1:8001) to compare connections per core:
+
+    python benchmarks/ws_connections.py --url ws://localhost:8000/ws/room_1?subscribe-broadcast \\
+        --pid <server pid> --connections 2000 --messages 50
+"""
+import argparse
+import os
+import selectors
+import time
+
+from redis import StrictRedis
+from websocket import create_connection
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def process_stats(pid):
+    """ Returns the CPU seconds consumed and the resident memory in bytes of process ``pid`` """
+    with open('/proc/{0}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    with open('/proc/{0}/statm'.format(pid)) as f:
+        rss = int(f.read().split()[1]) * PAGE_SIZE
+    return (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS), rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='ws://localhost:8000/ws/room_1?subscribe-broadcast')
+    parser.add_argument('--channel', default='lanes:broadcast:room_1')
+    parser.add_argument('--redis', default='localhost:6379')
+    parser.add_argument('--pid', type=int, required=True, help='pid of the websocket server process')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20)
+    args = parser.parse_args()
+
+    cpu_before, rss_before = process_stats(args.pid)
+    sockets = []
+    started = time.time()
+    for _ in range(args.connections):
+        try:
+            sockets.append(create_connection(args.url, timeout=10))
+        except Exception as e:
+            print("Connection {0} failed: {1}".format(len(sockets) + 1, e))
+            break
+    connect_time = time.time() - started
+    cpu_connected, rss_connected = process_stats(args.pid)
+    held = len(sockets)
+    print("Held {0} connections, opened in {1:.2f}s".format(held, connect_time))
+    if not held:
+        return
+    print("Server memory per connection: {0:.1f} KiB".format((rss_connected - rss_before) / 1024.0 / held))
+
+    host, port = args.redis.split(':')
+    redis = StrictRedis(host=host, port=int(port))
+    selector = selectors.DefaultSelector()
+    for ws in sockets:
+        selector.register(ws.sock, selectors.EVENT_READ, ws)
+    # drain anything sent on connect, such as persisted messages
+    time.sleep(1)
+    while True:
+        ready = selector.select(0)
+        if not ready:
+            break
+        for key, _ in ready:
+            key.data.recv()
+
+    cpu_start, _ = process_stats(args.pid)
+    started = time.time()
+    for i in range(args.messages):
+        redis.publish(args.channel, '{{"type": "bench", "seq": {0}}}'.format(i))
+    expected = held * args.messages
+    received = 0
+    while received < expected and time.time() - started < 60:
+        for key, _ in selector.select(1.0):
+            if '"bench"' in key.data.recv():
+                received += 1
+    elapsed = time.time() - started
+    cpu_end, _ = process_stats(args.pid)
+    cpu = max(cpu_end - cpu_start, 1.0 / CLOCK_TICKS)
+    print("Delivered {0}/{1} messages in {2:.2f}s ({3:.0f} msg/s)".format(received, expected, elapsed, received / elapsed))
+    print("Server CPU: {0:.2f}s for fan-out, {1:.0f} deliveries per CPU second".format(cpu, received / cpu))
+    print("Server CPU for {0} handshakes: {1:.2f}s".format(held, cpu_connected - cpu_before))
+    for ws in sockets:
+        ws.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+Load test a websocket server with many simulated clients spread over rooms, while room traffic is
+published at a steady rate, and report the latency from publishing to delivery, the messages
+delivered per second, the server's memory per connection and the connections held by Redis.
+
+The server is started on localhost, as the threaded runserver (ws4redis.django_runserver), the hub
+or uWSGI with gevent (``uwsgi-async`` and ``uwsgi-sync`` run uWSGI's other modes, see
+benchmarks/uwsgi_modes.py):
+
+    python benchmarks/ws_loadtest.py --server runserver --clients 2000 --rooms 50 --rate 100
+    python benchmarks/ws_loadtest.py --server hub --clients 5000 --multiplex
+    python benchmarks/ws_loadtest.py --server uwsgi --clients 2000
+
+or an already running one is used with ``--server none --url ws://host:port/ws/ --pid <pid>``.
+
+Messages are published like ``lanes.commands.post_message`` does, with RedisPublisher
+(``--driver publisher``), or by posting to RoomMessageView (``--driver view``) or sending the
+``post`` command over the websocket of the room (``--driver command``) with the session cookies of
+``--cookie sessionid=...``. Both are rate limited to 3 posts per 3s per user, and are written to
+the database. The hub runs commands inside its event loop, so with ``--driver command`` the
+latency includes the fan-out held up by the database writes of the commands. ``--json`` prints the
+results for comparing runs.
+"""
+import argparse
+import json
+import os
+import resource
+import selectors
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib2 import Request, urlopen
+    from urllib import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lanes.settings')
+
+from redis import StrictRedis
+from websocket import create_connection
+from ws_connections import process_stats
+
+SERVERS = {
+    'runserver': ['{python}', 'manage.py', 'runserver', '--noreload', '{host}:{port}'],
+    'hub': ['{python}', 'hub_websocket.py', '{host}:{port}'],
+    'uwsgi': ['uwsgi', '--http-socket', '{host}:{port}', '--http-websockets', '--gevent', '{cores}',
+              '--module', 'wsgi_websocket:application', '--env', 'DJANGO_SETTINGS_MODULE=lanes.settings',
+              '--disable-logging'],
+    # lanes.wsgi on async cores suspended by uwsgi.wait_fd_read, and on plain blocking workers
+    'uwsgi-async': ['uwsgi', '--http-socket', '{host}:{port}', '--http-websockets', '--async', '{cores}',
+                    '--ugreen', '--module', 'lanes.wsgi:application', '--disable-logging'],
+    'uwsgi-sync': ['uwsgi', '--http-socket', '{host}:{port}', '--http-websockets', '--processes', '4',
+                   '--module', 'lanes.wsgi:application', '--disable-logging'],
+}
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def start_server(args):
+    """ Start the server to test and wait until it accepts connections """
+    command = [part.format(python=sys.executable, host=args.host, port=args.port, cores=args.clients + 100)
+               for part in SERVERS[args.server]]
+    server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://{0}:{1}/'.format(args.host, args.port)
+    for _ in range(100):
+        try:
+            urlopen(url, timeout=1)
+            break
+        except IOError as e:
+            if getattr(e, 'code', None):
+                break
+            time.sleep(0.2)
+    return server
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def connect_clients(args):
+    """ Open the clients, client ``i`` listening on room ``i % rooms``, and return them by room """
+    header = ['Cookie: ' + args.cookie[0]] if args.cookie else []
+    rooms = dict((room, []) for room in range(args.first_room, args.first_room + args.rooms))
+    for i in range(args.clients):
+        room = args.first_room + i % args.rooms
+        try:
+            if args.multiplex:
+                ws = create_connection(args.url + 'multiplex', header=header, timeout=10)
+                ws.send(json.dumps({'op': 'subscribe', 'facility': 'room_{0}'.format(room),
+                                    'channels': ['subscribe-broadcast']}))
+            else:
+                ws = create_connection(args.url + 'room_{0}?subscribe-broadcast'.format(room),
+                                       header=header, timeout=10)
+        except Exception as e:
+            print("Client {0} failed to connect: {1}".format(i + 1, e))
+            break
+        rooms[room].append(ws)
+    return rooms
+
+
+class Driver(threading.Thread):
+    """ Publishes ``rate`` messages per second round robin to the rooms, for ``duration`` seconds """
+
+    def __init__(self, args, sent_at):
+        super(Driver, self).__init__()
+        self.daemon = True
+        self.args = args
+        self.sent_at = sent_at
+        self.published = 0
+        self.failed = 0
+        # the websockets the commands are sent on, by cookie and room
+        self.sockets = {}
+
+    def run(self):
+        args = self.args
+        rooms = list(range(args.first_room, args.first_room + args.rooms))
+        started = time.time()
+        while time.time() - started < args.duration:
+            due = started + self.published / float(args.rate)
+            if due > time.time():
+                time.sleep(due - time.time())
+            n = self.published
+            self.published += 1
+            self.sent_at[n] = time.time()
+            try:
+                self.publish(rooms[n % len(rooms)], n)
+            except Exception as e:
+                self.failed += 1
+                print("Publishing {0} failed: {1}".format(n, e))
+
+    def publish(self, room, n):
+        raw = 'bench {0}'.format(n)
+        if self.args.driver == 'view':
+            cookie = self.args.cookie[n % len(self.args.cookie)]
+            url = 'http://{0}:{1}/room/{2}/post/'.format(self.args.host, self.args.port, room)
+            urlopen(Request(url, urlencode({'message': raw}).encode('ascii'), {'Cookie': cookie}), timeout=10)
+            return
+        if self.args.driver == 'command':
+            cookie = self.args.cookie[n % len(self.args.cookie)]
+            if (cookie, room) not in self.sockets:
+                # subscribed to nothing, so only the replies to its commands arrive on it
+                self.sockets[cookie, room] = create_connection(self.args.url + 'room_{0}'.format(room),
+                                                               header=['Cookie: ' + cookie], timeout=10)
+            self.sockets[cookie, room].send(json.dumps({'command': 'post', 'ref': n, 'message': raw}))
+            return
+        from lanes.commands import publish
+        publish(room, {
+            'type': 'msg',
+            'author': {'name': 'bench', 'id': 0, 'img': ''},
+            'content': '<p>{0}</p>'.format(raw),
+            'raw': raw,
+            'id': n,
+        })
+
+
+def get_bench_number(message):
+    """ Return the number of a message published by the Driver, or None """
+    if not isinstance(message, str):
+        message = message.decode('utf-8', 'replace')
+    if '"bench ' not in message:
+        return None
+    try:
+        raw = json.loads(message).get('raw', '')
+    except ValueError:
+        return None
+    return int(raw[6:]) if raw.startswith('bench ') else None
+
+
+def receive(rooms, sent_at, driver, args):
+    """ Receive on all clients until the driver is done and everything has arrived, or timed out """
+    selector = selectors.DefaultSelector()
+    for clients in rooms.values():
+        for ws in clients:
+            selector.register(ws.sock, selectors.EVENT_READ, ws)
+    latencies = []
+    deadline = None
+    while True:
+        if deadline is None and not driver.is_alive():
+            deadline = time.time() + args.drain
+        if deadline is not None and (time.time() > deadline or len(latencies) >= expected(rooms, driver, args)):
+            break
+        for key, _ in selector.select(0.5):
+            try:
+                message = key.data.recv()
+            except Exception:
+                selector.unregister(key.fileobj)
+                continue
+            received_at = time.time()
+            n = get_bench_number(message)
+            if n is not None and n in sent_at:
+                latencies.append(received_at - sent_at[n])
+    return latencies
+
+
+def expected(rooms, driver, args):
+    """ The deliveries expected for what the driver has published so far """
+    sizes = [len(rooms[room]) for room in range(args.first_room, args.first_room + args.rooms)]
+    cycles, rest = divmod(driver.published - driver.failed, len(sizes))
+    return cycles * sum(sizes) + sum(sizes[:rest])
+
+
+def probe_view(args):
+    """ Return the seconds a Django view of the server takes to answer, or None if it doesn't within 10s """
+    started = time.time()
+    try:
+        urlopen('http://{0}:{1}{2}'.format(args.host, args.port, args.probe), timeout=10)
+    except IOError as e:
+        if not getattr(e, 'code', None):
+            return None
+    return time.time() - started
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def redis_clients(redis):
+    """ Returns the connected clients and pubsub channels of the Redis server """
+    return redis.info('clients')['connected_clients'], len(redis.execute_command('PUBSUB', 'CHANNELS'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=sorted(SERVERS) + ['none'], default='runserver')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--url', help='the websocket URL of a running server, defaults to the one started')
+    parser.add_argument('--pid', type=int, help='pid of a running server process')
+    parser.add_argument('--redis', default='localhost:6379')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--first-room', type=int, default=1)
+    parser.add_argument('--multiplex', action='store_true', help='connect to /ws/multiplex')
+    parser.add_argument('--driver', choices=['publisher', 'view', 'command'], default='publisher')
+    parser.add_argument('--cookie', action='append', default=[], help='Cookie header of a logged in user')
+    parser.add_argument('--rate', type=float, default=50, help='messages published per second')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to publish for')
+    parser.add_argument('--drain', type=float, default=10, help='seconds to wait for late deliveries')
+    parser.add_argument('--probe', default='/', help='a Django view timed while the clients are connected')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    if args.driver in ('view', 'command') and not args.cookie:
+        parser.error('--driver {0} requires --cookie'.format(args.driver))
+    if args.driver == 'publisher':
+        import django
+        django.setup()
+    raise_file_limit()
+
+    host, port = args.redis.split(':')
+    redis = StrictRedis(host=host, port=int(port))
+    server = None
+    if args.server != 'none':
+        server = start_server(args)
+        args.pid = server.pid
+    args.url = args.url or 'ws://{0}:{1}/ws/'.format(args.host, args.port)
+    try:
+        results = run(args, redis)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print("Server: {server}, clients held: {clients}/{requested} in {rooms} rooms, connected in {connect_time:.2f}s"
+          .format(**results))
+    if results.get('memory_per_client') is not None:
+        print("Server memory per connection: {0:.1f} KiB, CPU: {1:.2f}s".format(
+            results['memory_per_client'] / 1024.0, results['cpu']))
+    if results['view_time'] is None:
+        print("Django view {0} didn't answer while the clients were connected".format(args.probe))
+    else:
+        print("Django view {0} answered in {1:.0f}ms".format(args.probe, results['view_time'] * 1000))
+    print("Redis clients: {0} -> {1}, pubsub channels: {2} -> {3}".format(
+        results['redis_clients_before'], results['redis_clients'], results['pubsub_channels_before'],
+        results['pubsub_channels']))
+    print("Published {published} messages ({publish_rate:.0f}/s), delivered {delivered}/{expected} "
+          "({delivery_rate:.0f} msg/s)".format(**results))
+    if results['latency_ms']:
+        print("Latency ms: " + ", ".join("p{0} {1:.1f}".format(p, results['latency_ms']['p{0}'.format(p)])
+                                         for p in PERCENTILES) + ", max {0:.1f}".format(results['latency_ms']['max']))
+
+
+def run(args, redis):
+    redis_before = redis_clients(redis)
+    stats_before = process_stats(args.pid) if args.pid else None
+    started = time.time()
+    rooms = connect_clients(args)
+    connect_time = time.time() - started
+    held = sum(len(clients) for clients in rooms.values())
+    # let the server subscribe and send what it sends on connecting
+    time.sleep(1)
+    stats_connected = process_stats(args.pid) if args.pid else None
+    redis_connected = redis_clients(redis)
+    view_time = probe_view(args)
+
+    sent_at = {}
+    driver = Driver(args, sent_at)
+    started = time.time()
+    driver.start()
+    latencies = sorted(receive(rooms, sent_at, driver, args))
+    elapsed = time.time() - started
+    stats_after = process_stats(args.pid) if args.pid else None
+    for ws in list(driver.sockets.values()) + [ws for clients in rooms.values() for ws in clients]:
+        ws.close()
+
+    results = {
+        'server': args.server,
+        'requested': args.clients,
+        'clients': held,
+        'rooms': args.rooms,
+        'multiplex': args.multiplex,
+        'driver': args.driver,
+        'connect_time': connect_time,
+        'redis_clients_before': redis_before[0],
+        'pubsub_channels_before': redis_before[1],
+        'redis_clients': redis_connected[0],
+        'pubsub_channels': redis_connected[1],
+        'published': driver.published,
+        'publish_rate': driver.published / max(elapsed, 1e-6),
+        'expected': expected(rooms, driver, args),
+        'delivered': len(latencies),
+        'delivery_rate': len(latencies) / max(elapsed, 1e-6),
+        'latency_ms': {},
+        'view_time': view_time,
+        'memory_per_client': None,
+        'cpu': None,
+    }
+    if latencies:
+        results['latency_ms'] = dict(('p{0}'.format(p), percentile(latencies, p) * 1000) for p in PERCENTILES)
+        results['latency_ms']['max'] = latencies[-1] * 1000
+    if stats_before and held:
+        results['memory_per_client'] = (stats_connected[1] - stats_before[1]) / float(held)
+        results['cpu'] = stats_after[0] - stats_before[0]
+    return results
+
+
+if __name__ == '__main__':
+    main()
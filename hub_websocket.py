@@ -0,0 +1,11 @@
+import os
+import sys
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lanes.settings')
+
+from ws4redis.hub import WebsocketHub
+
+
+if __name__ == '__main__':
+    host, _, port = (sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1:8001').rpartition(':')
+    WebsocketHub((host or '127.0.0.1', int(port))).serve_forever()
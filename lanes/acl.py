@@ -0,0 +1,225 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from redis import StrictRedis
+
+from ws4redis.publisher import redis_connection_pool
+
+from .models import Organisation, OrgMembership, Room
+
+# Whether a user may read a facility, in one round trip: ARGV[1] is the user id ('' for anonymous
+# users), ARGV[2] Organisation.VISIBILITY_PRIVATE and ARGV[3] Room.PRIVACY_PUBLIC. Mirrors
+# User.can_view, returns -1 if the facility or its org is not cached.
+MAY_READ = '''
+local facility, user = KEYS[1], ARGV[1]
+local org, room = facility, nil
+if string.sub(facility, 1, 5) == 'room_' then
+  room = redis.call('HMGET', 'acl:' .. facility, 'org', 'privacy')
+  if not room[1] then
+    return -1
+  end
+  org = 'org_' .. room[1]
+end
+local visibility = redis.call('HGET', 'acl:' .. org, 'visibility')
+if not visibility then
+  return -1
+end
+if visibility == ARGV[2] and (user == '' or redis.call('SISMEMBER', 'acl:' .. org .. ':members', user) == 0) then
+  return 0
+end
+if room == nil or room[2] == ARGV[3] then
+  return 1
+end
+if user == '' then
+  return 0
+end
+if redis.call('SISMEMBER', 'acl:' .. org .. ':admins', user) == 1 then
+  return 1
+end
+return redis.call('SISMEMBER', 'acl:' .. facility .. ':readers', user)
+'''
+
+
+def get_connection():
+  return StrictRedis(connection_pool=redis_connection_pool)
+
+
+class ACL(object):
+  """ Who may read which room and org, for authorizing websockets without the database
+
+      Each org is a hash of its visibility with sets of its members and admins, each room a hash
+      of its org and privacy with the set of its members, all kept up to date by the signal
+      handlers below. An ACL which is not cached, e.g. after Redis was flushed, is loaded from the
+      database the first time it's asked for.
+  """
+
+  def __init__(self, connection=None):
+    self.connection = connection or get_connection()
+
+  def may_read(self, facility, user_id):
+    """ Whether the user with user_id, None if anonymous, may read facility. Facilities other
+        than rooms and orgs are not restricted.
+    """
+    if facility[:5] != 'room_' and facility[:4] != 'org_':
+      return True
+    allowed = self._may_read(facility, user_id)
+    if allowed == -1:
+      if not self.load(facility):
+        return False
+      allowed = self._may_read(facility, user_id)
+    return allowed == 1
+
+  def _may_read(self, facility, user_id):
+    return self.connection.eval(MAY_READ, 1, facility, '' if user_id is None else user_id,
+                                Organisation.VISIBILITY_PRIVATE, Room.PRIVACY_PUBLIC)
+
+  def load(self, facility):
+    """ Cache the ACL of facility and its org from the database, returns False if it doesn't exist """
+    if facility[:5] == 'room_':
+      try:
+        room = Room.objects.select_related('organisation').get(id=int(facility[5:]))
+      except (ValueError, Room.DoesNotExist):
+        return False
+      self.load_org(room.organisation)
+      self.load_room(room)
+      return True
+    try:
+      self.load_org(Organisation.objects.get(slug=facility[4:]))
+    except Organisation.DoesNotExist:
+      return False
+    return True
+
+  def load_org(self, org):
+    self.set_org(org.slug, org.visibility,
+                 OrgMembership.objects.filter(organisation=org).values_list('user_id', flat=True),
+                 org.admins.values_list('id', flat=True))
+
+  def load_room(self, room):
+    self.set_room(room.id, room.organisation.slug, room.privacy, room.members.values_list('id', flat=True))
+
+  def set_org(self, slug, visibility, member_ids, admin_ids):
+    key = 'acl:org_' + slug
+    pipe = self.connection.pipeline()
+    pipe.hset(key, 'visibility', visibility)
+    self._replace(pipe, key + ':members', member_ids)
+    self._replace(pipe, key + ':admins', admin_ids)
+    pipe.execute()
+
+  def set_room(self, room_id, slug, privacy, member_ids):
+    key = 'acl:room_' + str(room_id)
+    pipe = self.connection.pipeline()
+    pipe.hmset(key, {'org': slug, 'privacy': privacy})
+    self._replace(pipe, key + ':readers', member_ids)
+    pipe.execute()
+
+  def _replace(self, pipe, key, ids):
+    pipe.delete(key)
+    ids = list(ids)
+    if ids:
+      pipe.sadd(key, *ids)
+
+  def update(self, key, mapping):
+    """ Change fields of a cached ACL, unless it isn't cached anyway """
+    if self.connection.exists(key):
+      self.connection.hmset(key, mapping)
+
+  def add(self, key, user_ids):
+    if user_ids:
+      self.connection.sadd(key, *user_ids)
+
+  def remove(self, key, user_ids):
+    if user_ids:
+      self.connection.srem(key, *user_ids)
+
+  def forget(self, facility, *sets):
+    self.connection.delete('acl:' + facility, *('acl:' + facility + ':' + name for name in sets))
+
+
+def on_commit(func, *args):
+  """ Change the ACL once the transaction changing the database commits """
+  transaction.on_commit(lambda: func(*args))
+
+
+@receiver(pre_save, sender=Organisation)
+def org_saving(sender, instance, **kwargs):
+  # the slug is part of the keys, whether it changes is only known beforehand
+  instance._acl_slug = Organisation.objects.filter(id=instance.id).values_list('slug', flat=True).first() \
+      if instance.id else None
+
+
+@receiver(post_save, sender=Organisation)
+def org_saved(sender, instance, created, **kwargs):
+  if created:
+    return
+  acl = ACL()
+  old_slug = getattr(instance, '_acl_slug', None)
+  if old_slug is not None and old_slug != instance.slug:
+    # dropped, the org and its rooms are loaded again under the new slug when asked for
+    on_commit(acl.forget, 'org_' + old_slug, 'members', 'admins')
+    for room_id in Room.objects.filter(organisation=instance).values_list('id', flat=True):
+      on_commit(acl.forget, 'room_' + str(room_id), 'readers')
+  else:
+    on_commit(acl.update, 'acl:org_' + instance.slug, {'visibility': instance.visibility})
+
+
+@receiver(post_delete, sender=Organisation)
+def org_deleted(sender, instance, **kwargs):
+  on_commit(ACL().forget, 'org_' + instance.slug, 'members', 'admins')
+
+
+@receiver(post_save, sender=OrgMembership)
+def membership_saved(sender, instance, created, **kwargs):
+  if created:
+    on_commit(ACL().add, 'acl:org_' + instance.organisation.slug + ':members', [instance.user_id])
+
+
+@receiver(post_delete, sender=OrgMembership)
+def membership_deleted(sender, instance, **kwargs):
+  # the org is gone too if the membership is deleted along with it
+  slug = Organisation.objects.filter(id=instance.organisation_id).values_list('slug', flat=True).first()
+  if slug is not None:
+    on_commit(ACL().remove, 'acl:org_' + slug + ':members', [instance.user_id])
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, created, **kwargs):
+  if not created:
+    on_commit(ACL().update, 'acl:room_' + str(instance.id),
+              {'org': instance.organisation.slug, 'privacy': instance.privacy})
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+  on_commit(ACL().forget, 'room_' + str(instance.id), 'readers')
+
+
+def users_changed(get_key, related_name, instance, action, reverse, model, pk_set):
+  """ Mirror a change of the users of rooms or orgs, whose sets are get_key(room or org) """
+  acl = ACL()
+  if not reverse:
+    if action == 'post_add':
+      on_commit(acl.add, get_key(instance), list(pk_set))
+    elif action == 'post_remove':
+      on_commit(acl.remove, get_key(instance), list(pk_set))
+    elif action == 'post_clear':
+      on_commit(acl.connection.delete, get_key(instance))
+  elif action in ('post_add', 'post_remove'):
+    change = acl.add if action == 'post_add' else acl.remove
+    for obj in model.objects.filter(pk__in=pk_set):
+      on_commit(change, get_key(obj), [instance.pk])
+  elif action == 'pre_clear':
+    # which ones the user is removed from is only known beforehand
+    for obj in model.objects.filter(**{related_name: instance}):
+      on_commit(acl.remove, get_key(obj), [instance.pk])
+
+
+@receiver(m2m_changed, sender=Room.members.through)
+def room_members_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+  users_changed(lambda room: 'acl:room_' + str(room.id) + ':readers', 'members',
+                instance, action, reverse, model, pk_set)
+
+
+@receiver(m2m_changed, sender=Organisation.admins.through)
+def org_admins_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+  users_changed(lambda org: 'acl:org_' + org.slug + ':admins', 'admins',
+                instance, action, reverse, model, pk_set)
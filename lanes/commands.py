@@ -0,0 +1,256 @@
+import json
+import logging
+import time
+
+from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, close_old_connections
+from django.utils import timezone
+
+from ratelimit.utils import is_ratelimited
+from ws4redis.publisher import RedisPublisher
+from ws4redis.redis_store import RedisMessage
+
+from .models import Flag, OrgMembership, Post, PostContent, Room, Vote
+from .pinboard import PinBoard
+from .text import process_text
+
+logger = logging.getLogger('django')
+
+
+def publish(room_id, message):
+  RedisPublisher(facility='room_' + str(room_id), broadcast=True) \
+      .publish_message(RedisMessage(json.dumps(message)))
+
+
+def post_message(room, user, raw, author=None):
+  """ Post raw to room as user, author is the serialized user if the caller already has it """
+  if not raw or raw.strip() == "":
+    raise ValueError("Empty message")
+  processed = process_text(raw)
+  post = Post(room=room, author=user)
+  post.save()
+  PostContent(
+      author=user,
+      post=post,
+      raw=raw,
+      content=processed['text']).save()
+  message = {
+      'type': 'msg',
+      'author': author or {
+          'name': user.username,
+          'id': user.id,
+          'img': user.get_image()
+      },
+      'content': post.content,
+      'raw': raw,
+      'id': post.id
+  }
+  publish(room.id, message)
+  for notified in processed['notified']:
+    notified.notify(post)
+  return post
+
+
+def edit_post(post, user, raw):
+  if not raw or raw.strip() == "":
+    raise ValueError("Empty message")
+  processed = process_text(raw)
+  PostContent(
+      author=user,
+      post=post,
+      raw=raw,
+      content=processed['text']).save()
+  if post.pinned:
+    PinBoard(post.room_id).invalidate()
+  message = {
+      'type': 'edit',
+      'content': processed['text'],
+      'raw': raw,
+      'id': post.id
+  }
+  publish(post.room_id, message)
+  for notified in processed['notified']:
+    notified.notify(post)
+
+
+def vote_post(post, user, value):
+  if value not in [-1, 1]:
+    raise PermissionDenied
+  try:
+    Vote(post=post, user=user, score=value).save()
+  except IntegrityError:
+    # Already a vote for this user on this post
+    raise PermissionDenied
+  score = post.score
+  if score < -4:
+    #unpin
+    post.pinned = False
+    post.save()
+    PinBoard(post.room_id).mark_stale()
+    message = {
+        'type': 'unpin',
+        'id': post.id
+    }
+  else:
+    message = {
+        'type': 'vote',
+        'content': score,
+        'id': post.id
+    }
+  publish(post.room_id, message)
+  PinBoard(post.room_id).invalidate()
+
+
+def pin_post(post, user, pincode=None):
+  # Prevent people who've already voted from re-pinning
+  if post.pinned or Vote.objects.filter(user=user, post=post).exists():
+    raise PermissionDenied
+  post.pinned = True
+  post.pinned_at = timezone.now()
+  post.hotness_score = None  # have reorder_stars rank it
+  post.save()
+  if post.author_id != user.id:
+    Vote(user=user, post=post, score=1).save()
+  PinBoard(post.room_id).invalidate()
+  message = {
+      'type': 'pin',
+      'score': post.score,
+      'id': post.id,
+      'author_id': post.author_id
+  }
+  if pincode is not None:
+    message['pincode'] = pincode
+  publish(post.room_id, message)
+
+
+def flag_post(post, user):
+  try:
+    Flag(post=post, flagger=user).save()
+  except IntegrityError:
+    raise PermissionDenied
+  if post.flag_count > 3 and not post.deleted:
+    pinned = post.pinned
+    post.remove(user)
+    board = PinBoard(post.room_id)
+    board.invalidate()
+    if pinned:
+      board.mark_stale()
+    post.author.ban_for(post.room.organisation, 60 * 30)  # Half an hour
+    message = {
+        'type': 'delete',
+        'id': post.id
+    }
+  else:
+    message = {
+        'type': 'flag',
+        'id': post.id
+    }
+  publish(post.room_id, message)
+
+
+class RoomCommands(object):
+  """ Commands sent by a client over the websocket of a room
+
+      Everything the HTTP views check on each request (room, membership, privacy) is resolved
+      once, when WebsocketWSGIServer.on_receive creates the commands of a websocket with the first
+      message sent to the room, so later commands cost their own queries plus a publish.
+      A command is a JSON object such as {"command": "post", "ref": 1, "message": "hi"}, each is
+      answered with {"type": "reply", "ref": 1, "ok": true} or "ok": false and an "error".
+  """
+
+  ban_check_interval = 60
+
+  def __init__(self, request, room_id):
+    self.request = request
+    self.user = user = request.user
+    self.room = room = Room.objects.select_related('organisation').get(id=room_id)
+    org = room.organisation
+    self.can_view = user.is_member(org) and user.can_view(room)
+    self.can_post = self.can_view and (room.privacy != Room.PRIVACY_PRIVATE or
+                                       room.members.filter(id=user.id).exists())
+    self.is_admin = user.is_admin(org)
+    self.author = {
+        'name': user.username,
+        'id': user.id,
+        'img': user.get_image()
+    }
+    self.ban_expiry = None
+    self.ban_checked = 0
+
+  def is_banned(self):
+    now = time.time()
+    if now - self.ban_checked > self.ban_check_interval:
+      self.ban_expiry = OrgMembership.objects.filter(user=self.user, organisation=self.room.organisation) \
+          .values_list('ban_expiry', flat=True).first()
+      self.ban_checked = now
+    return self.ban_expiry is not None and timezone.now() < self.ban_expiry
+
+  def get_post(self, data, require_owner=False, require_not_owner=False):
+    post = Post.objects.get(id=data.get('id'), room=self.room)
+    if require_owner and not (post.author_id == self.user.id or self.is_admin):
+      raise PermissionDenied
+    if require_not_owner and post.author_id == self.user.id:
+      raise PermissionDenied
+    if post.deleted:
+      raise PermissionDenied
+    return post
+
+  def handle(self, message):
+    """ Run the command in message, returns the reply, or None if message is not a command """
+    if isinstance(message, bytes):
+      message = message.decode('utf-8')
+    if message[:1] != '{':
+      return None
+    try:
+      data = json.loads(message)
+    except ValueError:
+      return None
+    if not isinstance(data, dict) or 'command' not in data:
+      return None
+    reply = {
+        'type': 'reply',
+        'ref': data.get('ref'),
+        'ok': True
+    }
+    handler = getattr(self, 'do_' + str(data['command']), None)
+    # the websocket may have outlived the database connection
+    close_old_connections()
+    try:
+      if handler is None:
+        raise ValueError('Unknown command')
+      if not self.can_view or self.is_banned():
+        raise PermissionDenied
+      handler(data)
+    except PermissionDenied:
+      reply.update(ok=False, error='Permission denied')
+    except (ValueError, Post.DoesNotExist) as excpt:
+      reply.update(ok=False, error=str(excpt) or 'Invalid command')
+    except Exception as excpt:
+      logger.error('Command failed: {}'.format(excpt), exc_info=True)
+      reply.update(ok=False, error='Server error')
+    return json.dumps(reply)
+
+  def do_post(self, data):
+    if not self.can_post:
+      raise PermissionDenied
+    if is_ratelimited(self.request, group='posts', key='user', rate='3/3s', increment=True):
+      raise ValueError('Too Fast!')
+    post_message(self.room, self.user, data.get('message'), self.author)
+
+  def do_edit(self, data):
+    edit_post(self.get_post(data, require_owner=True), self.user, data.get('message'))
+
+  def do_vote(self, data):
+    try:
+      value = int(data.get('value'))
+    except (TypeError, ValueError):
+      raise PermissionDenied
+    vote_post(self.get_post(data, require_not_owner=True), self.user, value)
+
+  def do_pin(self, data):
+    if not self.can_post:
+      raise PermissionDenied
+    pin_post(self.get_post(data), self.user, data.get('pincode'))
+
+  def do_flag(self, data):
+    flag_post(self.get_post(data), self.user)
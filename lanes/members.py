@@ -0,0 +1,88 @@
+from django.core.urlresolvers import reverse
+from redis import StrictRedis
+
+from ws4redis.publisher import redis_connection_pool
+
+from .models import OrgMembership, User
+from .presence import Presence
+
+AVATAR_KEY = 'avatars'
+
+
+def get_connection():
+  return StrictRedis(connection_pool=redis_connection_pool)
+
+
+def forget_avatar(user_id):
+  """ Drop the cached avatar url of a user, call whenever their profile image changes """
+  get_connection().hdel(AVATAR_KEY, user_id)
+
+
+def get_avatars(users):
+  """ Map user ids to avatar urls for (id, hash, profile_image) tuples, in a fixed number of queries
+
+      Uploaded profile pictures need a thumbnail lookup each, so their urls are cached in one
+      Redis hash and fetched with one HMGET, identicon urls are derived from the user's hash
+      without any I/O.
+  """
+  users = list(users)
+  avatars = {}
+  uploaded = [user_id for user_id, user_hash, profile_image in users if profile_image]
+  if uploaded:
+    connection = get_connection()
+    for user_id, url in zip(uploaded, connection.hmget(AVATAR_KEY, uploaded)):
+      if url is not None:
+        avatars[user_id] = url.decode('utf-8')
+    missing = dict((user.id, user.get_image()) for user in
+                   User.objects.filter(id__in=[i for i in uploaded if i not in avatars]))
+    if missing:
+      connection.hmset(AVATAR_KEY, missing)
+      avatars.update(missing)
+  for user_id, user_hash, profile_image in users:
+    if user_id not in avatars:
+      avatars[user_id] = reverse("django_pydenticon:image", kwargs={"data": user_hash + '.png'})
+  return avatars
+
+
+class MemberList(object):
+  """ The members of a room with their status and avatar, in a fixed number of queries
+
+      Members come from a single join against OrgMembership, their statuses from one read of the
+      org's presence hash and their avatars from get_avatars.
+  """
+
+  page_size = 200
+
+  def __init__(self, room):
+    self.room = room
+
+  def get_queryset(self):
+    return OrgMembership.objects \
+        .filter(organisation_id=self.room.organisation_id, user__members=self.room) \
+        .order_by('user__username') \
+        .values_list('user__id', 'user__username', 'user__hash', 'user__profile_image')
+
+  def get_page(self, after=None, limit=page_size):
+    """ Up to limit members with usernames sorting after after, and the cursor of the next page """
+    qs = self.get_queryset()
+    if after is not None:
+      qs = qs.filter(user__username__gt=after)
+    rows = list(qs[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    members = self.serialize(rows)
+    return members, members[-1]['username'] if more else None
+
+  def serialize(self, rows):
+    avatars = get_avatars((user_id, user_hash, profile_image)
+                          for user_id, username, user_hash, profile_image in rows)
+    statuses = Presence(self.room.organisation.slug).get_statuses([row[0] for row in rows])
+    members = []
+    for user_id, username, user_hash, profile_image in rows:
+      members.append({
+          'id': user_id,
+          'username': username,
+          'status': statuses[user_id],
+          'image': avatars[user_id]
+      })
+    return members
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    Post = apps.get_model('lanes', 'Post')
+    Vote = apps.get_model('lanes', 'Vote')
+    Flag = apps.get_model('lanes', 'Flag')
+    PostContent = apps.get_model('lanes', 'PostContent')
+
+    def aggregate(model, expression):
+        qs = model.objects.filter(post=OuterRef('pk')).order_by().values('post') \
+            .annotate(total=expression).values('total')
+        return Coalesce(Subquery(qs, output_field=IntegerField()), 0)
+
+    latest = PostContent.objects.filter(post=OuterRef('pk')).order_by('-created')
+    Post.objects.update(
+        score=aggregate(Vote, Sum('score')),
+        flag_count=aggregate(Flag, Count('id')),
+        revisions=aggregate(PostContent, Count('id')),
+        current_content=Coalesce(Subquery(latest.values('content')[:1]), models.Value('')),
+        current_raw=Coalesce(Subquery(latest.values('raw')[:1]), models.Value('')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lanes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='score',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='flag_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='revisions',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='current_content',
+            field=models.CharField(blank=True, default='', max_length=512),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='current_raw',
+            field=models.CharField(blank=True, default='', max_length=512),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,5 @@
 import base64
 import hashlib
-import json
 import logging
 import math
 import os
@@ -10,8 +9,8 @@ import uuid
 
 from datetime import datetime, timedelta
 
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import F, Q, Sum
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.urlresolvers import reverse
@@ -19,9 +18,6 @@ from django.utils import timezone
 
 from easy_thumbnails.files import get_thumbnailer
 
-from ws4redis.redis_store import RedisMessage
-from ws4redis.publisher import RedisPublisher
-
 from autoslug import AutoSlugField
 
 hasher = hashlib.new('ripemd160')
@@ -78,6 +74,18 @@ def generate_token():
   ) for _ in range(20))
 
 
+def encode_cursor(post):
+  """ An opaque (created, id) keyset cursor pointing at post """
+  td = post.created - epoch
+  return '{}-{}'.format((td.days * 86400 + td.seconds) * 1000000 + td.microseconds, post.id)
+
+
+def decode_cursor(cursor):
+  """ Inverse of encode_cursor, raises ValueError for malformed cursors """
+  micros, post_id = cursor.split('-')
+  return epoch + timedelta(microseconds=int(micros)), int(post_id)
+
+
 def uuid_filename(instance, filename):
     name = base64.b64encode(uuid.uuid4().bytes).decode('utf-8').replace('==','').replace('/','-')
     _, ext = os.path.splitext(filename)
@@ -172,7 +180,8 @@ class User(AbstractUser):
     return Organisation.objects.filter(id__in=memberships)
 
   def get_status(self, org):
-    return OrgMembership.objects.get(user=self, organisation=org).status
+    from .presence import Presence
+    return Presence(org.slug).get_status(self.id)
 
   def notify(self, post):
     if self.is_bot and self.bot.responds_to(post.room):
@@ -182,18 +191,8 @@ class User(AbstractUser):
       Notification(post=post, user=self).save()
 
   def set_status(self, org, status):
-    m = OrgMembership.objects.get(user=self, organisation=org)
-    m.status = status
-    m.save()
-    message = {
-        "type": "status",
-        "id": self.id,
-        "status": m.status,
-        "username": self.username,
-        "img": self.get_image()
-    }
-    RedisPublisher(facility='org_' + org.slug, broadcast=True) \
-        .publish_message(RedisMessage(json.dumps(message)))
+    from .presence import Presence
+    Presence(org.slug).set_status(self.id, status, self)
 
   def can_view(self, room):
     if room.organisation not in self.organisations.all() and \
@@ -307,11 +306,21 @@ class Room(models.Model):
   is_dm = models.BooleanField(default=False)
 
   def get_history(self):
-    posts = Post.objects.filter(room=self).order_by('-created')[:100]
+    posts = Post.objects.filter(room=self).select_related('author').order_by('-created')[:100]
     return posts[::-1]
 
   history = property(get_history)
 
+  HISTORY_PAGE_SIZE = 50
+
+  def get_history_page(self, before=None, limit=HISTORY_PAGE_SIZE):
+    """ Posts older than the decoded cursor before, newest first """
+    qs = Post.objects.filter(room=self).select_related('author').order_by('-created', '-id')
+    if before is not None:
+      created, post_id = before
+      qs = qs.filter(Q(created__lt=created) | Q(created=created, id__lt=post_id))
+    return list(qs[:limit])
+
   def get_pinned(self):
     posts = Post.objects.filter(room=self, pinned=True).order_by('-hotness')[:20]
     return posts[::-1]
@@ -357,6 +366,10 @@ class RoomPrefs(models.Model):
 
 class Post(models.Model):
   """ A chat post """
+
+  # Maintained by Vote, Flag and PostContent, never written by a plain save()
+  DENORMALIZED_FIELDS = ('score', 'flag_count', 'revisions', 'current_content', 'current_raw')
+
   room = models.ForeignKey(Room)
   author = models.ForeignKey(settings.AUTH_USER_MODEL)
   created = models.DateTimeField(auto_now_add=True)
@@ -364,6 +377,37 @@ class Post(models.Model):
   pinned_at = models.DateTimeField(null=True, default=None)
   deleted = models.BooleanField(default=False)
   hotness = models.FloatField(default=10000.0)
+  hotness_score = models.IntegerField(null=True, default=None)  # score hotness was computed from
+  score = models.IntegerField(default=0)
+  flag_count = models.IntegerField(default=0)
+  revisions = models.IntegerField(default=0)
+  current_content = models.CharField(max_length=512, blank=True, default='')
+  current_raw = models.CharField(max_length=512, blank=True, default='')
+
+  class Meta:
+    index_together = (('room', 'created'),)
+
+  def save(self, *args, **kwargs):
+    if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+      # Don't let a stale instance overwrite concurrent votes, flags or edits
+      kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                 if not f.primary_key and f.name not in self.DENORMALIZED_FIELDS]
+    super(Post, self).save(*args, **kwargs)
+
+  def update_counters(self, **updates):
+    """ Atomically apply updates to the denormalized fields, and refresh them on this instance """
+    Post.objects.filter(pk=self.pk).update(**updates)
+    self.refresh_from_db(fields=self.DENORMALIZED_FIELDS)
+
+  def recount(self):
+    """ Recompute the denormalized fields from the votes, flags and contents of the post """
+    latest = PostContent.objects.filter(post=self).order_by('-created').first()
+    self.update_counters(
+        score=self.get_score(),
+        flag_count=self.get_flags(),
+        revisions=PostContent.objects.filter(post=self).count(),
+        current_content=latest.content if latest else '',
+        current_raw=latest.raw if latest else '')
 
   def get_score(self):
     res = 0
@@ -376,30 +420,21 @@ class Post(models.Model):
     return res
 
   def get_flags(self):
-    res = 0
-    try:
-      res = Flag.objects.filter(post=self).aggregate(total=Sum('score')).get('total')
-      if res is None:
-        res = 0
-    except:
-      logger.error("Could not get flags for Post " + str(self.id))
-    return res
+    return Flag.objects.filter(post=self).count()
 
   def get_raw(self):
     if self.deleted:
       return "(deleted)"
-    try:
-      return self.get_history()[0].raw
-    except:
+    if not self.revisions:
       return "(error)"
+    return self.current_raw
 
   def get_content(self):
     if self.deleted:
       return "(deleted)"
-    try:
-      return self.get_history()[0].content
-    except:
+    if not self.revisions:
       return "(error)"
+    return self.current_content
 
   def get_history(self):
     qs = PostContent.objects.filter(post=self).order_by('-created')
@@ -420,17 +455,18 @@ class Post(models.Model):
     content.save()
 
   def is_edited(self):
-    return PostContent.objects.filter(post=self).count() > 1
+    return self.revisions > 1
 
   def update_hotness(self, score=None):
     if score is None:
-      score = self.get_score()
+      score = self.score
     order = math.log(max(abs(score), 1), 10)
     sign = 1 if score > 0 else -1 if score < 0 else 0
     td = self.pinned_at - epoch
     seconds = td.days * 86400 + td.seconds + (float(td.microseconds) / 1000000) - 1134028003
     self.hotness = round(sign * order + seconds / 45000, 7)
-    self.save()
+    self.hotness_score = score
+    self.save(update_fields=['hotness', 'hotness_score'])
 
   def __str__(self):
     return str(self.author) + " in " + str(self.room) + " at " + str(self.created)
@@ -438,7 +474,6 @@ class Post(models.Model):
   content = property(get_content)
   raw = property(get_raw)
   edited = property(is_edited)
-  score = property(get_score)
   history = property(get_history)
 
 
@@ -452,6 +487,21 @@ class Vote(models.Model):
   class Meta:
     unique_together = ('post', 'user',)
 
+  def save(self, *args, **kwargs):
+    with transaction.atomic():
+      created = self._state.adding
+      super(Vote, self).save(*args, **kwargs)
+      if created:
+        self.post.update_counters(score=F('score') + self.score)
+      else:
+        self.post.recount()
+
+  def delete(self, *args, **kwargs):
+    with transaction.atomic():
+      result = super(Vote, self).delete(*args, **kwargs)
+      self.post.recount()
+    return result
+
   def __str__(self):
     return str(self.user) + " on " + str(self.post)
 
@@ -464,6 +514,24 @@ class PostContent(models.Model):
   raw = models.CharField(max_length=512)
   created = models.DateTimeField(auto_now_add=True)
 
+  def save(self, *args, **kwargs):
+    with transaction.atomic():
+      created = self._state.adding
+      super(PostContent, self).save(*args, **kwargs)
+      if created:
+        self.post.update_counters(
+            revisions=F('revisions') + 1,
+            current_content=self.content,
+            current_raw=self.raw)
+      else:
+        self.post.recount()
+
+  def delete(self, *args, **kwargs):
+    with transaction.atomic():
+      result = super(PostContent, self).delete(*args, **kwargs)
+      self.post.recount()
+    return result
+
   def __str__(self):
     return self.content
 
@@ -477,6 +545,19 @@ class Flag(models.Model):
   class Meta:
     unique_together = ('post', 'flagger',)
 
+  def save(self, *args, **kwargs):
+    with transaction.atomic():
+      created = self._state.adding
+      super(Flag, self).save(*args, **kwargs)
+      if created:
+        self.post.update_counters(flag_count=F('flag_count') + 1)
+
+  def delete(self, *args, **kwargs):
+    with transaction.atomic():
+      result = super(Flag, self).delete(*args, **kwargs)
+      self.post.recount()
+    return result
+
 
 class Notification(models.Model):
   """ A notification that needs to be sent - deleted when sent """
@@ -502,3 +583,7 @@ class InvitationRequest(models.Model):
   """ A request for an invitation """
   email = models.EmailField()
   created = models.DateTimeField(auto_now_add=True)
+
+
+# Connect the signal handlers which keep the websocket ACL in Redis up to date
+from . import acl  # noqa
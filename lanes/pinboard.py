@@ -0,0 +1,87 @@
+import json
+
+from redis import StrictRedis
+
+from ws4redis.publisher import redis_connection_pool
+
+from .models import Post, Vote
+
+STALE_KEY = 'pinboard:stale'
+
+
+class PinBoard(object):
+  """ The pinned posts of a room, cached in Redis
+
+      The board itself is the same for everyone and is kept as one JSON blob per room, only the
+      viewer's votes are looked up per request. Anything that changes which posts are pinned, their
+      score or their order must call invalidate() or refresh().
+  """
+
+  size = 20
+  timeout = 60 * 60
+
+  def __init__(self, room_id):
+    self.room_id = room_id
+    self.key = 'pinboard:room_{}'.format(room_id)
+    self.order_key = 'pinboard:order:room_{}'.format(room_id)
+    self.connection = StrictRedis(connection_pool=redis_connection_pool)
+
+  def refresh(self):
+    """ Rebuild the board from the database, cache it and return it """
+    posts = Post.objects.filter(room_id=self.room_id, pinned=True) \
+        .select_related('author').order_by('-hotness')[:self.size]
+    board = [{
+        'author': {
+            'name': post.author.username,
+            'id': post.author.id
+        },
+        'content': post.content,
+        'raw': post.raw,
+        'score': post.score,
+        'hotness': post.hotness,
+        'id': post.id
+    } for post in posts]
+    self.connection.set(self.key, json.dumps(board), ex=self.timeout)
+    return board
+
+  def reorder(self):
+    """ Rebuild the board, returning it if its order moved since the last call, None otherwise """
+    board = self.refresh()
+    order = json.dumps([pin['id'] for pin in board])
+    previous = self.connection.getset(self.order_key, order)
+    if previous is not None and previous.decode('utf-8') == order:
+      return None
+    return board
+
+  def invalidate(self):
+    self.connection.delete(self.key)
+
+  def mark_stale(self):
+    """ Have reorder_stars rebuild the board on its next run, for changes it can't find by itself
+        such as a post which is no longer pinned
+    """
+    self.connection.sadd(STALE_KEY, self.room_id)
+
+  @staticmethod
+  def pop_stale(connection=None):
+    """ The ids of the rooms marked stale since the last call """
+    pipe = (connection or StrictRedis(connection_pool=redis_connection_pool)).pipeline()
+    pipe.smembers(STALE_KEY)
+    pipe.delete(STALE_KEY)
+    return set(int(room_id) for room_id in pipe.execute()[0])
+
+  def get_posts(self):
+    """ Pinned posts, hottest first """
+    board = self.connection.get(self.key)
+    if board is None:
+      return self.refresh()
+    return json.loads(board.decode('utf-8'))
+
+  def for_user(self, user):
+    """ Pinned posts, hottest first, each with the vote user has cast on it """
+    board = self.get_posts()
+    votes = dict(Vote.objects.filter(user=user, post_id__in=[pin['id'] for pin in board])
+                 .values_list('post_id', 'score'))
+    for pin in board:
+      pin['vote'] = votes.get(pin['id'], 0)
+    return board
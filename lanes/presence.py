@@ -0,0 +1,123 @@
+import json
+from collections import defaultdict
+
+from redis import StrictRedis
+
+from ws4redis.publisher import RedisPublisher, redis_connection_pool
+from ws4redis.redis_store import RedisMessage
+
+from .models import OrgMembership
+
+DIRTY_KEY = 'presence:dirty'
+
+# Replace a status, remember it for the write-behind and return the previous one, atomically, so
+# that when many websockets observe the same event only the first one broadcasts the change
+SET_STATUS = '''
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+if old ~= ARGV[2] then
+  redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+  redis.call('SADD', KEYS[2], ARGV[3] .. ':' .. ARGV[1])
+end
+return old
+'''
+
+
+def get_connection():
+  return StrictRedis(connection_pool=redis_connection_pool)
+
+
+class Presence(object):
+  """ The statuses of the members of an org
+
+      Statuses live in one Redis hash per org, which is what websockets, views and member lists
+      read and write. Changes are only recorded in a dirty set, flush() copies them to
+      OrgMembership in bulk, so connecting and disconnecting never touches the database.
+  """
+
+  def __init__(self, slug, connection=None):
+    self.slug = slug
+    self.key = 'presence:org_' + slug
+    self.connection = connection or get_connection()
+
+  def set_status(self, user_id, status, user=None, author=None):
+    """ Set the status of a user and broadcast it to the org if it changed, author is the
+        serialized user if the caller already has it. Returns True if the status changed.
+    """
+    old = self.connection.eval(SET_STATUS, 2, self.key, DIRTY_KEY, user_id, status, self.slug)
+    if old is not None and int(old) == status:
+      return False
+    message = {
+        "type": "status",
+        "id": user_id,
+        "status": status
+    }
+    if author is not None:
+      message.update(username=author['name'], img=author['img'])
+    elif user is not None:
+      message.update(username=user.username, img=user.get_image())
+    RedisPublisher(facility='org_' + self.slug, broadcast=True) \
+        .publish_message(RedisMessage(json.dumps(message)))
+    return True
+
+  def go_online(self, user, author=None):
+    """ Mark a user who connects as online, unless they already chose another status """
+    status = self.get_status(user.id)
+    if status == OrgMembership.STATUS_OFFLINE:
+      self.set_status(user.id, OrgMembership.STATUS_ONLINE, user, author)
+      return OrgMembership.STATUS_ONLINE
+    return status
+
+  def get_status(self, user_id):
+    return self.get_statuses([user_id])[user_id]
+
+  def get_statuses(self, user_ids):
+    """ Map user ids to their status with one round trip to Redis, statuses which are not
+        cached yet are loaded from the database in one query
+    """
+    statuses = {}
+    missing = []
+    for user_id, status in zip(user_ids, self.connection.hmget(self.key, user_ids) if user_ids else []):
+      if status is None:
+        missing.append(user_id)
+      else:
+        statuses[user_id] = int(status)
+    if missing:
+      stored = OrgMembership.objects.filter(organisation__slug=self.slug, user_id__in=missing) \
+          .values_list('user_id', 'status')
+      pipe = self.connection.pipeline(transaction=False)
+      for user_id, status in stored:
+        # don't overwrite a status set while we were reading
+        pipe.hsetnx(self.key, user_id, status)
+        statuses[user_id] = status
+      pipe.execute()
+    for user_id in missing:
+      statuses.setdefault(user_id, OrgMembership.STATUS_OFFLINE)
+    return statuses
+
+  @classmethod
+  def flush(cls, connection=None):
+    """ Write the statuses changed since the last flush to OrgMembership, one UPDATE per org
+        and status. Returns the number of memberships written.
+    """
+    connection = connection or get_connection()
+    pipe = connection.pipeline()
+    pipe.smembers(DIRTY_KEY)
+    pipe.delete(DIRTY_KEY)
+    dirty = pipe.execute()[0]
+    by_org = defaultdict(list)
+    for entry in dirty:
+      slug, user_id = entry.decode('utf-8').rsplit(':', 1)
+      by_org[slug].append(int(user_id))
+    written = 0
+    for slug, user_ids in by_org.items():
+      presence = cls(slug, connection)
+      by_status = defaultdict(list)
+      for user_id, status in zip(user_ids, connection.hmget(presence.key, user_ids)):
+        if status is not None:
+          by_status[int(status)].append(user_id)
+      for status, ids in by_status.items():
+        written += OrgMembership.objects \
+            .filter(organisation__slug=slug, user_id__in=ids) \
+            .exclude(status=status) \
+            .update(status=status)
+    return written
@@ -60,6 +60,10 @@ CELERYBEAT_SCHEDULE = {
         'task': 'lanes.tasks.reorder_stars',
         'schedule': timedelta(seconds=10)
     },
+    'flush_presence': {
+        'task': 'lanes.tasks.flush_presence',
+        'schedule': timedelta(seconds=30)
+    },
     'send_notifications': {
         'task': 'lanes.tasks.send_notifications',
         'schedule': timedelta(seconds=10*60)
@@ -152,6 +156,9 @@ WEBSOCKET_URL = '/ws/'
 WS4REDIS_EXPIRE = 3600
 WS4REDIS_HEARTBEAT = '--ah-ah-ah-ah-stayin-alive--'
 WS4REDIS_PREFIX = 'lanes'
+WS4REDIS_OUTBOX = {
+    'droppable': {'hotness': None, 'status': 'id'},
+}
 WS4REDIS_ALLOWED_CHANNELS = get_allowed_channels
 
 LOGGING = {
@@ -1,7 +1,17 @@
 import logging
 
+from django.core.exceptions import PermissionDenied
+
 logger = logging.getLogger('django')
 
 
 def get_allowed_channels(request, channels):
+  """ Refuse websockets on rooms and orgs the user may not read, according to the ACL in Redis """
+  from .acl import ACL
+  facility = request.path_info.rsplit('/', 1)[-1]
+  user = request.user
+  user_id = user.pk if user and user.is_authenticated() else None
+  if not ACL().may_read(facility, user_id):
+    logger.debug("Can't read " + facility)
+    raise PermissionDenied('Not allowed to read ' + facility)
   return set(channels).intersection(['subscribe-broadcast'])
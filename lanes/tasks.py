@@ -1,5 +1,8 @@
 import requests
 import json
+import time
+
+from django.db.models import F, Q
 
 from ws4redis.redis_store import RedisMessage
 from ws4redis.publisher import RedisPublisher
@@ -7,31 +10,60 @@ from ws4redis.publisher import RedisPublisher
 from .celeryapp import app
 from .models import *
 from .emails import NotificationEmail
+from .pinboard import PinBoard
+from .presence import Presence
 
 
 @app.task(bind=True)
 def reorder_stars(self):
-  # Update hotness for all pinned posts
-  print "Updating post hotness"
-  for post in Post.objects.filter(pinned=True):
+  started = time.time()
+  # Hotness only depends on score and pin time, so only posts pinned or voted on since the last
+  # run need to be ranked again
+  stale = Post.objects.filter(pinned=True) \
+      .filter(Q(hotness_score__isnull=True) | ~Q(hotness_score=F('score')))
+  # Boards also need rebuilding in rooms where a pinned post was unpinned or deleted
+  rooms = PinBoard.pop_stale()
+  ranked = 0
+  for post in stale:
     post.update_hotness()
-  # Push out updates for all rooms
-  for room in Room.objects.all():
-    print "Broadcasting hotness for " + room.name
-    posts = Post.objects.filter(pinned=True, room=room).order_by('-hotness')[:20]
+    rooms.add(post.room_id)
+    ranked += 1
+  # Push out updates for rooms where the order of the pinned posts moved
+  messages = []
+  for room_id in rooms:
+    board = PinBoard(room_id).reorder()
+    if board is None:
+      continue
     message = {
         'type': 'hotness',
         'posts': [
             {
-                'hotness': post.hotness,
-                'score': post.score,
-                'id': post.id
+                'hotness': pin['hotness'],
+                'score': pin['score'],
+                'id': pin['id']
             }
-            for post in posts
+            for pin in board
         ]
     }
-    RedisPublisher(facility='room_' + str(room.id), broadcast=True) \
-        .publish_message(RedisMessage(json.dumps(message)))
+    channel = RedisPublisher.get_broadcast_channel('room_' + str(room_id))
+    messages.append((channel, RedisMessage(json.dumps(message))))
+  # Each run supersedes the last one's order, so it is neither persisted nor kept for replay
+  RedisPublisher().publish_messages(messages, persist=False)
+  metrics = {
+      'ranked': ranked,
+      'rooms': len(rooms),
+      'broadcast': len(messages),
+      'seconds': round(time.time() - started, 3)
+  }
+  print("Ranked {ranked} posts in {rooms} rooms, broadcast to {broadcast} in {seconds}s".format(**metrics))
+  return metrics
+
+
+@app.task(bind=True)
+def flush_presence(self):
+  # Persist statuses which changed in Redis since the last run
+  written = Presence.flush()
+  print("Wrote {} statuses".format(written))
 
 
 @app.task(bind=True)
@@ -46,7 +78,7 @@ def send_notifications(self):
 
 @app.task(bind=True)
 def ping_bot(self, post, user):
-  print "Pinging bot " + user.username
+  print("Pinging bot " + user.username)
   data = {
       'action': 'message',
       'key': user.bot.notify_key,
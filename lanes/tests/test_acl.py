@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import shutil
+import subprocess
+import time
+from unittest import mock, skipUnless
+from django.core.exceptions import PermissionDenied
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+from redis import StrictRedis
+from lanes.acl import ACL, org_saved, org_saving, room_saved
+from lanes.models import Organisation, Room
+from lanes.socket import get_allowed_channels
+
+PORT = 6393
+
+
+class ACLTests(SimpleTestCase):
+
+    def request(self, facility, user_id):
+        request = RequestFactory().get('/ws/' + facility)
+        request.user = mock.Mock(pk=user_id, is_authenticated=lambda: user_id is not None)
+        return request
+
+    def test_other_facilities(self):
+        connection = mock.Mock()
+        self.assertTrue(ACL(connection).may_read('multiplex', None))
+        connection.eval.assert_not_called()
+
+    def test_loads_missing(self):
+        connection = mock.Mock()
+        connection.eval.side_effect = [-1, 1]
+        acl = ACL(connection)
+        with mock.patch.object(acl, 'load', return_value=True) as load:
+            self.assertTrue(acl.may_read('room_3', 7))
+        load.assert_called_once_with('room_3')
+        connection.eval.side_effect = [-1]
+        with mock.patch.object(acl, 'load', return_value=False):
+            self.assertFalse(acl.may_read('room_4', 7))
+
+    def test_allowed_channels(self):
+        with mock.patch('lanes.acl.ACL.may_read', return_value=True) as may_read:
+            channels = get_allowed_channels(self.request('room_3', 7), ['subscribe-broadcast', 'publish-user'])
+        self.assertEqual(channels, {'subscribe-broadcast'})
+        may_read.assert_called_once_with('room_3', 7)
+        with mock.patch('lanes.acl.ACL.may_read', return_value=False):
+            with self.assertRaises(PermissionDenied):
+                get_allowed_channels(self.request('room_3', None), ['subscribe-broadcast'])
+
+    def test_room_moved(self):
+        connection = mock.Mock()
+        room = mock.Mock(id=3, privacy=Room.PRIVACY_PRIVATE)
+        room.organisation.slug = 'other'
+        with mock.patch('lanes.acl.get_connection', return_value=connection), \
+                mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()):
+            room_saved(Room, room, created=False)
+        connection.hmset.assert_called_once_with('acl:room_3', {'org': 'other', 'privacy': Room.PRIVACY_PRIVATE})
+
+    def test_slug_changed(self):
+        connection = mock.Mock()
+        org = mock.Mock(id=5, slug='new', visibility=Organisation.VISIBILITY_LINK)
+        with mock.patch('lanes.acl.get_connection', return_value=connection), \
+                mock.patch('django.db.transaction.on_commit', side_effect=lambda func: func()), \
+                mock.patch.object(Organisation, 'objects') as orgs, \
+                mock.patch.object(Room, 'objects') as rooms:
+            orgs.filter.return_value.values_list.return_value.first.return_value = 'old'
+            rooms.filter.return_value.values_list.return_value = [10, 11]
+            org_saving(Organisation, org)
+            org_saved(Organisation, org, created=False)
+        self.assertEqual(connection.delete.call_args_list, [
+            mock.call('acl:org_old', 'acl:org_old:members', 'acl:org_old:admins'),
+            mock.call('acl:room_10', 'acl:room_10:readers'),
+            mock.call('acl:room_11', 'acl:room_11:readers'),
+        ])
+        connection.hmset.assert_not_called()
+
+
+@skipUnless(shutil.which('redis-server'), 'redis-server is not installed')
+class LocalACLTests(SimpleTestCase):
+    """
+    Evaluate the ACL script on a local redis-server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(LocalACLTests, cls).setUpClass()
+        cls.server = subprocess.Popen(['redis-server', '--port', str(PORT), '--save', '', '--appendonly', 'no'],
+                                      stdout=subprocess.DEVNULL)
+        cls.connection = StrictRedis(port=PORT)
+        for _ in range(50):
+            try:
+                cls.connection.ping()
+                break
+            except Exception:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+        super(LocalACLTests, cls).tearDownClass()
+
+    def setUp(self):
+        self.connection.flushdb()
+        self.acl = ACL(self.connection)
+        # members 1, 2 and the admin 3, 4 is not a member
+        self.acl.set_org('acme', Organisation.VISIBILITY_PRIVATE, [1, 2, 3], [3])
+        self.acl.set_org('open', Organisation.VISIBILITY_PUBLIC, [1], [])
+        self.acl.set_room(10, 'acme', Room.PRIVACY_PRIVATE, [1])
+        self.acl.set_room(11, 'acme', Room.PRIVACY_PUBLIC, [])
+        self.acl.set_room(12, 'open', Room.PRIVACY_PUBLIC, [])
+        self.acl.set_room(13, 'open', Room.PRIVACY_PRIVATE, [4])
+
+    def readers(self, facility):
+        return [user_id for user_id in (None, 1, 2, 3, 4) if self.acl.may_read(facility, user_id)]
+
+    def test_may_read(self):
+        self.assertEqual(self.readers('org_acme'), [1, 2, 3])
+        self.assertEqual(self.readers('org_open'), [None, 1, 2, 3, 4])
+        self.assertEqual(self.readers('room_10'), [1, 3])
+        self.assertEqual(self.readers('room_11'), [1, 2, 3])
+        self.assertEqual(self.readers('room_12'), [None, 1, 2, 3, 4])
+        self.assertEqual(self.readers('room_13'), [4])
+
+    def test_changes(self):
+        self.acl.add('acl:room_10:readers', [2])
+        self.acl.remove('acl:org_acme:members', [1])
+        self.assertEqual(self.readers('room_10'), [2, 3])
+        self.acl.update('acl:room_10', {'privacy': Room.PRIVACY_PUBLIC})
+        self.assertEqual(self.readers('room_10'), [2, 3])
+        self.acl.update('acl:org_acme', {'visibility': Organisation.VISIBILITY_LINK})
+        self.assertEqual(self.readers('room_10'), [None, 1, 2, 3, 4])
+        # moved into acme, whose admin may read it too
+        self.acl.update('acl:room_13', {'org': 'acme', 'privacy': Room.PRIVACY_PRIVATE})
+        self.assertEqual(self.readers('room_13'), [3, 4])
+        # changes to ACLs which aren't cached are left for loading them
+        self.acl.update('acl:room_14', {'privacy': Room.PRIVACY_PUBLIC})
+        self.assertFalse(self.connection.exists('acl:room_14'))
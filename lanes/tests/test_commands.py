@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import timedelta
+from unittest import mock
+from django.test import SimpleTestCase
+from django.utils import timezone
+from lanes.commands import RoomCommands, flag_post, vote_post
+from lanes.models import OrgMembership, Room
+
+
+class StaleBoardTests(SimpleTestCase):
+
+    def setUp(self):
+        for name in ('Vote', 'Flag', 'PinBoard', 'publish'):
+            patcher = mock.patch('lanes.commands.' + name)
+            setattr(self, name.lower(), patcher.start())
+            self.addCleanup(patcher.stop)
+        self.user = mock.Mock(id=1)
+
+    def test_unpin(self):
+        post = mock.Mock(id=9, room_id=3, score=-5, pinned=True)
+        vote_post(post, self.user, -1)
+        self.assertFalse(post.pinned)
+        self.pinboard.assert_called_with(3)
+        self.pinboard.return_value.mark_stale.assert_called_once_with()
+        self.publish.assert_called_once_with(3, {'type': 'unpin', 'id': 9})
+
+    def test_vote(self):
+        post = mock.Mock(id=9, room_id=3, score=2, pinned=True)
+        vote_post(post, self.user, 1)
+        self.pinboard.return_value.mark_stale.assert_not_called()
+
+    def test_delete(self):
+        for pinned in (True, False):
+            post = mock.Mock(id=9, room_id=3, flag_count=4, deleted=False, pinned=pinned)
+            self.pinboard.reset_mock()
+            flag_post(post, self.user)
+            post.remove.assert_called_once_with(self.user)
+            self.assertEqual(self.pinboard.return_value.mark_stale.called, pinned)
+
+
+class RoomCommandsTests(SimpleTestCase):
+
+    def setUp(self):
+        for name in ('close_old_connections', 'post_message', 'is_ratelimited'):
+            patcher = mock.patch('lanes.commands.' + name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.is_ratelimited.return_value = False
+        patcher = mock.patch.object(OrgMembership, 'objects')
+        self.memberships = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.memberships.filter.return_value.values_list.return_value.first.return_value = None
+        self.room = mock.Mock(id=3, privacy=Room.PRIVACY_PUBLIC)
+        self.user = mock.Mock(id=1, username='al')
+        self.user.get_image.return_value = 'a.png'
+
+    def commands(self, can_view=True):
+        self.user.can_view.return_value = can_view
+        with mock.patch.object(Room, 'objects') as rooms:
+            rooms.select_related.return_value.get.return_value = self.room
+            return RoomCommands(mock.Mock(user=self.user), 3)
+
+    def handle(self, commands, data):
+        return json.loads(commands.handle(json.dumps(data)))
+
+    def test_not_a_command(self):
+        commands = self.commands()
+        for message in ('hi', b'{"no": 1}', '{"broken', '[1]'):
+            self.assertIsNone(commands.handle(message))
+
+    def test_success(self):
+        reply = self.handle(self.commands(), {'command': 'post', 'ref': 7, 'message': 'hi'})
+        self.assertEqual(reply, {'type': 'reply', 'ref': 7, 'ok': True})
+        self.post_message.assert_called_once_with(self.room, self.user, 'hi',
+                                                  {'name': 'al', 'id': 1, 'img': 'a.png'})
+        self.close_old_connections.assert_called_once_with()
+
+    def test_unknown_command(self):
+        reply = self.handle(self.commands(), {'command': 'shout', 'ref': 1})
+        self.assertEqual(reply, {'type': 'reply', 'ref': 1, 'ok': False, 'error': 'Unknown command'})
+
+    def test_permission_denied(self):
+        reply = self.handle(self.commands(can_view=False), {'command': 'post', 'ref': 2, 'message': 'hi'})
+        self.assertEqual(reply, {'type': 'reply', 'ref': 2, 'ok': False, 'error': 'Permission denied'})
+        self.post_message.assert_not_called()
+
+    def test_banned(self):
+        commands = self.commands()
+        self.memberships.filter.return_value.values_list.return_value.first.return_value = \
+            timezone.now() + timedelta(minutes=30)
+        reply = self.handle(commands, {'command': 'post', 'ref': 3, 'message': 'hi'})
+        self.assertEqual(reply['error'], 'Permission denied')
+        # the ban is looked up once per interval, not for each command
+        self.handle(commands, {'command': 'post', 'ref': 4, 'message': 'hi'})
+        self.assertEqual(self.memberships.filter.call_count, 1)
+        self.post_message.assert_not_called()
+
+    def test_vote(self):
+        commands = self.commands()
+        with mock.patch('lanes.commands.vote_post') as vote_post, \
+                mock.patch.object(RoomCommands, 'get_post') as get_post:
+            # the value is coerced like the form field PostVoteView reads
+            reply = self.handle(commands, {'command': 'vote', 'ref': 6, 'id': 9, 'value': '-1'})
+            self.assertTrue(reply['ok'])
+            vote_post.assert_called_once_with(get_post.return_value, self.user, -1)
+            for value in ('up', None):
+                reply = self.handle(commands, {'command': 'vote', 'ref': 7, 'id': 9, 'value': value})
+                self.assertEqual(reply['error'], 'Permission denied')
+        self.assertEqual(vote_post.call_count, 1)
+
+    def test_server_error(self):
+        self.post_message.side_effect = RuntimeError('boom')
+        with self.assertLogs('django', 'ERROR'):
+            reply = self.handle(self.commands(), {'command': 'post', 'ref': 5, 'message': 'hi'})
+        self.assertEqual(reply['error'], 'Server error')
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from django.test import TestCase
+from lanes.models import Flag, Organisation, Post, PostContent, Room, User, Vote
+
+
+class CounterTests(TestCase):
+    """
+    Vote, Flag and PostContent keep the denormalized counters of their post up to date.
+    """
+
+    def setUp(self):
+        self.users = [User.objects.create(username='user{}'.format(i), email='user{}@x.com'.format(i))
+                      for i in range(3)]
+        org = Organisation.objects.create(name='Acme')
+        room = Room.objects.create(name='general', topic='', organisation=org, creator=self.users[0])
+        self.post = Post.objects.create(room=room, author=self.users[0])
+
+    def reload(self):
+        return Post.objects.get(id=self.post.id)
+
+    def test_score(self):
+        votes = [Vote.objects.create(post=self.post, user=user, score=score)
+                 for user, score in zip(self.users, (1, 1, -1))]
+        self.assertEqual(self.post.score, 1)
+        self.assertEqual(self.reload().score, 1)
+        votes[2].score = 1
+        votes[2].save()
+        self.assertEqual(self.reload().score, 3)
+        votes[0].delete()
+        self.assertEqual(self.reload().score, 2)
+
+    def test_flag_count(self):
+        flags = [Flag.objects.create(post=self.post, flagger=user) for user in self.users[:2]]
+        self.assertEqual(self.reload().flag_count, 2)
+        flags[0].delete()
+        self.assertEqual(self.reload().flag_count, 1)
+
+    def test_revisions(self):
+        self.assertEqual(self.post.get_content(), '(error)')
+        PostContent.objects.create(post=self.post, author=self.users[0], raw='hi', content='<p>hi</p>')
+        edit = PostContent.objects.create(post=self.post, author=self.users[0], raw='hey', content='<p>hey</p>')
+        post = self.reload()
+        self.assertEqual((post.revisions, post.raw, post.content, post.edited), (2, 'hey', '<p>hey</p>', True))
+        edit.delete()
+        post = self.reload()
+        self.assertEqual((post.revisions, post.raw, post.edited), (1, 'hi', False))
+
+    def test_stale_save(self):
+        stale = self.reload()
+        Vote.objects.create(post=self.post, user=self.users[1], score=1)
+        stale.pinned = True
+        stale.save()
+        post = self.reload()
+        self.assertEqual((post.score, post.pinned), (1, True))
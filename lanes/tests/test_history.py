@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from django.test import SimpleTestCase
+from lanes.models import Post, decode_cursor, encode_cursor, epoch
+
+
+class CursorTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        created = epoch + timedelta(days=17000, seconds=1234, microseconds=567891)
+        post = Post(id=42, created=created)
+        self.assertEqual(decode_cursor(encode_cursor(post)), (created, 42))
+
+    def test_malformed(self):
+        for cursor in ('', '12', 'a-1', '1-b', '1-2-3'):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
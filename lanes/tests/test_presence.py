@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import shutil
+import subprocess
+import time
+from unittest import mock, skipUnless
+from django.test import SimpleTestCase
+from redis import StrictRedis
+from lanes.models import OrgMembership
+from lanes.presence import DIRTY_KEY, Presence
+from ws4redis.redis_store import COUNT_PRESENT, RedisStore
+
+PORT = 6394
+
+
+class PresenceTests(SimpleTestCase):
+
+    def test_broadcast_changes_only(self):
+        connection = mock.Mock()
+        presence = Presence('acme', connection)
+        with mock.patch('lanes.presence.RedisPublisher') as publisher:
+            connection.eval.return_value = str(OrgMembership.STATUS_OFFLINE).encode()
+            self.assertTrue(presence.set_status(7, OrgMembership.STATUS_ONLINE, author={'name': 'al', 'img': 'a.png'}))
+            connection.eval.return_value = str(OrgMembership.STATUS_ONLINE).encode()
+            self.assertFalse(presence.set_status(7, OrgMembership.STATUS_ONLINE))
+        connection.eval.assert_called_with(mock.ANY, 2, 'presence:org_acme', DIRTY_KEY, 7,
+                                           OrgMembership.STATUS_ONLINE, 'acme')
+        publisher.assert_called_once_with(facility='org_acme', broadcast=True)
+        self.assertEqual(publisher.return_value.publish_message.call_count, 1)
+
+    def test_flush(self):
+        connection = mock.Mock()
+        connection.pipeline.return_value.execute.return_value = [{b'acme:1', b'acme:2', b'open:3'}, 1]
+        statuses = {
+            'presence:org_acme': {1: b'4', 2: b'1'},
+            'presence:org_open': {3: None},
+        }
+        connection.hmget.side_effect = lambda key, user_ids: [statuses[key][user_id] for user_id in user_ids]
+        with mock.patch.object(OrgMembership, 'objects') as objects:
+            objects.filter.return_value.exclude.return_value.update.return_value = 1
+            self.assertEqual(Presence.flush(connection), 2)
+        connection.pipeline.return_value.delete.assert_called_once_with(DIRTY_KEY)
+        # one update per org and status, statuses which are gone from the cache are left alone
+        self.assertEqual(sorted(objects.filter.call_args_list, key=lambda call: call[1]['user_id__in']), [
+            mock.call(organisation__slug='acme', user_id__in=[1]),
+            mock.call(organisation__slug='acme', user_id__in=[2]),
+        ])
+
+    def test_count_connections(self):
+        connection = mock.Mock()
+        store = RedisStore(connection)
+        user = mock.Mock(id=7)
+        with mock.patch('time.time', return_value=1000.0):
+            store.set_present(user, True, 'org_acme')
+            store.set_present(user, True, 'org_acme')
+        with mock.patch('time.time', return_value=1000.0 + store._presence_timeout):
+            store.set_present(user, True, 'org_acme')
+            store.set_present(user, False, 'org_acme')
+            store.set_present(user, False, 'org_acme')
+        changes = [call[0][3] for call in connection.eval.call_args_list]
+        # opened, a heartbeat which isn't throttled, closed only once
+        self.assertEqual(changes, [1, 0, -1])
+        connection.eval.assert_called_with(COUNT_PRESENT, 1, 'users_present:org_acme:7', -1,
+                                           store._presence_timeout, 5)
+
+
+@skipUnless(shutil.which('redis-server'), 'redis-server is not installed')
+class LocalPresenceTests(SimpleTestCase):
+    """
+    Count the connections of users on a local redis-server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(LocalPresenceTests, cls).setUpClass()
+        cls.server = subprocess.Popen(['redis-server', '--port', str(PORT), '--save', '', '--appendonly', 'no'],
+                                      stdout=subprocess.DEVNULL)
+        cls.connection = StrictRedis(port=PORT)
+        for _ in range(50):
+            try:
+                cls.connection.ping()
+                break
+            except Exception:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+        super(LocalPresenceTests, cls).tearDownClass()
+
+    def setUp(self):
+        self.connection.flushdb()
+        self.user = mock.Mock(id=7)
+        self.key = RedisStore.get_presence_key(self.user.id, 'org_acme')
+
+    def test_last_tab_closes(self):
+        tabs = [RedisStore(self.connection), RedisStore(self.connection)]
+        for tab in tabs:
+            tab.set_present(self.user, True, 'org_acme')
+        tabs[0].set_present(self.user, False, 'org_acme')
+        self.assertEqual(self.connection.get(self.key), b'1')
+        self.assertGreater(self.connection.ttl(self.key), 5)
+        tabs[1].set_present(self.user, False, 'org_acme')
+        self.assertEqual(self.connection.get(self.key), b'0')
+        self.assertLessEqual(self.connection.ttl(self.key), 5)
+        # a tab opened within the grace period keeps the user present
+        tabs[0].set_present(self.user, True, 'org_acme')
+        self.assertEqual(self.connection.get(self.key), b'1')
+        self.assertGreater(self.connection.ttl(self.key), 5)
+
+    def test_heartbeat_after_expiry(self):
+        tab = RedisStore(self.connection)
+        tab.set_present(self.user, True, 'org_acme')
+        self.connection.delete(self.key)
+        tab._present[self.key] = 0
+        tab.set_present(self.user, True, 'org_acme')
+        self.assertEqual(self.connection.get(self.key), b'1')
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+from django.test import SimpleTestCase
+from lanes.models import Post
+from lanes.tasks import reorder_stars
+
+
+class ReorderStarsTests(SimpleTestCase):
+
+    def test_incremental(self):
+        post = mock.Mock(room_id=1)
+        boards = {1: [{'id': 5, 'score': 3, 'hotness': 1.5}], 2: None}
+        with mock.patch.object(Post, 'objects') as posts, \
+                mock.patch('lanes.tasks.PinBoard') as pinboard, \
+                mock.patch('lanes.tasks.RedisPublisher') as publisher:
+            posts.filter.return_value.filter.return_value = [post]
+            # room 2 lost its pinned post, so no stale post leads to it
+            pinboard.pop_stale.return_value = {2}
+            pinboard.side_effect = lambda room_id: mock.Mock(reorder=mock.Mock(return_value=boards[room_id]))
+            metrics = reorder_stars()
+        post.update_hotness.assert_called_once_with()
+        self.assertEqual(sorted(call[0][0] for call in pinboard.call_args_list), [1, 2])
+        self.assertEqual((metrics['ranked'], metrics['rooms'], metrics['broadcast']), (1, 2, 1))
+        messages = publisher.return_value.publish_messages.call_args[0][0]
+        self.assertEqual([channel for channel, message in messages], [publisher.get_broadcast_channel.return_value])
+        publisher.get_broadcast_channel.assert_called_once_with('room_1')
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from redis import StrictRedis
+from ws4redis.publisher import redis_connection_pool
+from lanes.members import AVATAR_KEY, MemberList
+from lanes.models import Organisation, OrgMembership, Post, PostContent, Room, User, Vote, encode_cursor
+from lanes.presence import DIRTY_KEY, Presence
+
+
+class ViewTestCase(TestCase):
+    """
+    A public room of an org, with the member who is logged in.
+    """
+
+    def setUp(self):
+        self.redis = StrictRedis(connection_pool=redis_connection_pool)
+        self.user = self.create_user('al')
+        self.org = Organisation.objects.create(name='Acme')
+        self.room = Room.objects.create(name='general', topic='', organisation=self.org, creator=self.user,
+                                        privacy=Room.PRIVACY_PUBLIC)
+        self.join(self.user)
+        self.client.force_login(self.user)
+        self.addCleanup(self.redis.delete, AVATAR_KEY, Presence(self.org.slug).key, DIRTY_KEY)
+
+    def create_user(self, username, profile_image=None):
+        return User.objects.create_user(username, username + '@x.com', 'secret', profile_image=profile_image)
+
+    def join(self, user, room=None):
+        if not OrgMembership.objects.filter(user=user, organisation=self.org).exists():
+            OrgMembership.objects.create(user=user, organisation=self.org)
+        (room or self.room).members.add(user)
+
+    def create_posts(self, authors, room=None):
+        posts = []
+        for author in authors:
+            post = Post.objects.create(room=room or self.room, author=author)
+            PostContent.objects.create(post=post, author=author, raw='hi', content='hi')
+            posts.append(post)
+        return posts
+
+    def create_authors(self, count, start=0):
+        """ Half of them with an uploaded profile picture, whose thumbnail url is cached """
+        authors = []
+        for i in range(start, start + count):
+            author = self.create_user('author{}'.format(i), 'profile{}.png'.format(i) if i % 2 else None)
+            self.join(author)
+            if author.profile_image:
+                self.redis.hset(AVATAR_KEY, author.id, '/media/profile{}.png'.format(i))
+            authors.append(author)
+        return authors
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+
+class RoomViewTests(ViewTestCase):
+
+    def test_history_queries(self):
+        url = reverse('room', kwargs={'room_id': self.room.id})
+        authors = self.create_authors(6)
+        self.create_posts(authors[:1])
+        # render once, so that what's cached on the first visit is in place
+        self.client.get(url)
+        single = self.count_queries(url)
+        self.create_posts(authors[1:] * 2)
+        with self.assertNumQueries(single):
+            response = self.client.get(url)
+        self.assertContains(response, '/media/profile5.png')
+        self.assertContains(response, reverse('django_pydenticon:image', kwargs={'data': authors[4].hash + '.png'}))
+
+
+class RoomHistoryViewTests(ViewTestCase):
+
+    def setUp(self):
+        super(RoomHistoryViewTests, self).setUp()
+        self.url = reverse('room_history', kwargs={'room_id': self.room.id})
+
+    def test_latest_page(self):
+        posts = self.create_posts([self.user] * 3)
+        Vote.objects.create(post=posts[1], user=self.user, score=1)
+        page = self.client.get(self.url, {'limit': 2}).json()
+        self.assertEqual([post['id'] for post in page['posts']], [posts[1].id, posts[2].id])
+        self.assertEqual(page['posts'][0]['vote'], 1)
+        self.assertEqual(page['posts'][0]['author']['name'], 'al')
+        self.assertEqual(page['next'], encode_cursor(posts[1]))
+
+    def test_page_through_same_created(self):
+        posts = self.create_posts([self.user] * 5)
+        Post.objects.filter(room=self.room).update(created=posts[0].created)
+        seen = []
+        params = {'limit': 2}
+        while True:
+            page = self.client.get(self.url, params).json()
+            seen = [post['id'] for post in page['posts']] + seen
+            if page['next'] is None:
+                break
+            params['before'] = page['next']
+        # ties on created are broken by id, so nothing is skipped or repeated
+        self.assertEqual(seen, [post.id for post in posts])
+
+    def test_bad_params(self):
+        self.assertTemplateUsed(self.client.get(self.url, {'before': 'nope'}), 'error_500.html')
+        self.assertTemplateUsed(self.client.get(self.url, {'limit': Room.HISTORY_PAGE_SIZE + 1}), 'error_500.html')
+
+    def test_unknown_room(self):
+        response = self.client.get(reverse('room_history', kwargs={'room_id': self.room.id + 1}))
+        self.assertTemplateUsed(response, 'error_404.html')
+
+    def test_private_room(self):
+        self.room.privacy = Room.PRIVACY_PRIVATE
+        self.room.save()
+        outsider = self.create_user('bo')
+        OrgMembership.objects.create(user=outsider, organisation=self.org)
+        self.client.force_login(outsider)
+        # handler403 renders the not found page
+        self.assertTemplateUsed(self.client.get(self.url), 'error_404.html')
+        self.room.members.add(outsider)
+        self.assertEqual(self.client.get(self.url).json()['posts'], [])
+
+    def test_page_queries(self):
+        authors = self.create_authors(6)
+        self.create_posts(authors[:1])
+        self.client.get(self.url)
+        single = self.count_queries(self.url)
+        self.create_posts(authors * 3)
+        with self.assertNumQueries(single):
+            page = self.client.get(self.url, {'limit': 10}).json()
+        self.assertEqual(len(page['posts']), 10)
+
+
+class RoomMembersViewTests(ViewTestCase):
+
+    def setUp(self):
+        super(RoomMembersViewTests, self).setUp()
+        self.url = reverse('room_members', kwargs={'room_id': self.room.id})
+
+    def test_pages(self):
+        self.create_authors(5)
+        members = MemberList(self.room)
+        first, after = members.get_page(limit=4)
+        self.assertEqual([member['username'] for member in first], ['al', 'author0', 'author1', 'author2'])
+        self.assertEqual(after, 'author2')
+        second, after = members.get_page(after, limit=4)
+        self.assertEqual([member['username'] for member in second], ['author3', 'author4'])
+        self.assertIsNone(after)
+        page = self.client.get(self.url, {'after': 'author2'}).json()
+        self.assertEqual(page, {'users': second, 'next': None})
+
+    def test_members_of_room_only(self):
+        outsider = self.create_user('bo')
+        OrgMembership.objects.create(user=outsider, organisation=self.org)
+        self.assertEqual([member['username'] for member in self.client.get(self.url).json()['users']], ['al'])
+
+    def test_statuses(self):
+        away, busy = self.create_authors(2)
+        Presence(self.org.slug).set_status(away.id, OrgMembership.STATUS_AWAY)
+        OrgMembership.objects.filter(user=busy).update(status=OrgMembership.STATUS_BUSY)
+        statuses = dict((member['username'], member['status'])
+                        for member in self.client.get(self.url).json()['users'])
+        # live statuses from the presence hash, the rest from OrgMembership
+        self.assertEqual(statuses, {
+            'al': OrgMembership.STATUS_ONLINE,
+            'author0': OrgMembership.STATUS_AWAY,
+            'author1': OrgMembership.STATUS_BUSY,
+        })
+
+    def test_avatars(self):
+        authors = self.create_authors(2)
+        images = dict((member['id'], member['image']) for member in self.client.get(self.url).json()['users'])
+        self.assertEqual(images[authors[1].id], '/media/profile1.png')
+        self.assertEqual(images[authors[0].id],
+                         reverse('django_pydenticon:image', kwargs={'data': authors[0].hash + '.png'}))
+
+    def test_page_queries(self):
+        self.create_authors(2)
+        # statuses of new members aren't cached yet on either request, so both read OrgMembership
+        few = self.count_queries(self.url)
+        self.create_authors(12, start=2)
+        with self.assertNumQueries(few):
+            page = self.client.get(self.url).json()
+        self.assertEqual(len(page['users']), 15)
+
+    def test_private_room(self):
+        self.room.privacy = Room.PRIVACY_PRIVATE
+        self.room.save()
+        outsider = self.create_user('bo')
+        OrgMembership.objects.create(user=outsider, organisation=self.org)
+        self.client.force_login(outsider)
+        self.assertTemplateUsed(self.client.get(self.url), 'error_404.html')
+        self.room.members.add(outsider)
+        self.assertEqual(len(self.client.get(self.url).json()['users']), 2)
+
+    def test_unknown_room(self):
+        response = self.client.get(reverse('room_members', kwargs={'room_id': self.room.id + 1}))
+        self.assertTemplateUsed(response, 'error_404.html')
@@ -0,0 +1,1031 @@
+# -*- coding: utf-8 -*-
+import importlib
+import json
+import os
+import selectors
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from unittest import mock, skipUnless
+from django.core.exceptions import PermissionDenied
+from django.test import SimpleTestCase
+from django.utils.functional import empty
+from ws4redis import compact, settings as private_settings, stats
+from ws4redis.admission import Admission, TokenBucket, get_refusal_response
+from ws4redis.deflate import PerMessageDeflate
+from django.test.client import RequestFactory
+from ws4redis.exceptions import ServiceUnavailableError, WebSocketError
+from ws4redis.multiplex import Multiplex, parse_control, tag_message
+from ws4redis.publisher import RedisPublisher, buffered_publishing
+from ws4redis.redis_store import RedisMessage, RedisStore
+from ws4redis.sharding import HashRing, ShardedPubSub, Shards
+from ws4redis.tickets import TicketUser, issue_ticket, read_ticket
+from ws4redis.timers import TimerQueue, clock
+from ws4redis.utf8validator import Utf8Validator
+from ws4redis.websocket import Header, WebSocket
+
+
+def reference_mask(mask, payload):
+    payload = bytearray(payload)
+    for i in range(len(payload)):
+        payload[i] ^= bytearray(mask)[i % 4]
+    return bytes(payload)
+
+
+class HeaderTests(SimpleTestCase):
+
+    def test_mask_payload(self):
+        for length in (0, 1, 3, 4, 5, 125, 126, 4097, 65537):
+            header = Header(length=length)
+            header.mask = os.urandom(4)
+            payload = os.urandom(length)
+            masked = header.mask_payload(payload)
+            self.assertEqual(masked, reference_mask(header.mask, payload))
+            self.assertEqual(header.unmask_payload(masked), payload)
+
+
+class Utf8ValidatorTests(SimpleTestCase):
+
+    def test_fragmented_code_point(self):
+        validator = Utf8Validator()
+        self.assertEqual(validator.validate(b'caf\xc3'), (True, False, 4, 4))
+        self.assertEqual(validator.validate(b'\xa9!'), (True, True, 2, 6))
+
+    def test_failure_offset(self):
+        validator = Utf8Validator()
+        self.assertEqual(validator.validate(b'ab\xed'), (True, False, 3, 3))
+        # surrogates are invalid UTF-8, bailing out at their second octet
+        self.assertEqual(validator.validate(b'\xa0\x80'), (False, False, 0, 3))
+        validator.reset()
+        self.assertEqual(validator.validate(b'abc\xff'), (False, False, 3, 3))
+
+
+class PerMessageDeflateTests(SimpleTestCase):
+
+    def test_negotiate(self):
+        deflate = PerMessageDeflate.negotiate('permessage-deflate; client_max_window_bits', window_bits=12)
+        self.assertEqual(deflate.response, 'permessage-deflate; client_max_window_bits=12')
+        deflate = PerMessageDeflate.negotiate(
+            'permessage-deflate; server_max_window_bits=10; client_no_context_takeover')
+        self.assertEqual(deflate.response,
+                         'permessage-deflate; client_no_context_takeover; server_max_window_bits=10')
+        self.assertEqual(deflate.client_max_window_bits, 15)
+        # declined: a window zlib can't produce, unknown parameters, other extensions
+        self.assertIsNone(PerMessageDeflate.negotiate('permessage-deflate; server_max_window_bits=8'))
+        self.assertIsNone(PerMessageDeflate.negotiate('permessage-deflate; foo=1'))
+        self.assertIsNone(PerMessageDeflate.negotiate('x-webkit-deflate-frame'))
+        self.assertEqual(PerMessageDeflate.negotiate(
+            'permessage-deflate; foo=1, permessage-deflate').response, 'permessage-deflate')
+
+    def test_round_trip(self):
+        for context_takeover in (True, False):
+            sender = PerMessageDeflate.negotiate('permessage-deflate', window_bits=9,
+                                                 context_takeover=context_takeover, min_size=10)
+            receiver = PerMessageDeflate(client_no_context_takeover=not context_takeover,
+                                         client_max_window_bits=9)
+            self.assertIsNone(sender.compress(b'short'))
+            for message in (b'{"type": "msg"}' * 20, b'{"type": "vote"}' * 3, os.urandom(2000)):
+                self.assertEqual(receiver.decompress(sender.compress(message)), message)
+
+
+class CompactTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        message = {
+            'type': 'msg', 'seq': 1, 'id': 70000, 'author': {'name': u'zoë', 'id': 3, 'img': '/x.png'},
+            'content': 'x' * 300, 'other': [None, True, False, -1, -200, -70000, 1 << 40, 0.5],
+        }
+        self.assertEqual(compact.unpack(compact.pack(message)), message)
+
+    def test_tagged_keys(self):
+        # a map of three entries, "type" is tag 0 and "id" tag 1
+        self.assertEqual(compact.pack({'type': 'vote', 'id': 5, 'x': 1}), b'\x83\x00\xa4vote\x01\x05\xa1x\x01')
+
+    def test_encode_message(self):
+        self.assertEqual(compact.unpack(compact.encode_message(b'{"type": "flag", "id": 9}')),
+                         {'type': 'flag', 'id': 9})
+        self.assertIsNone(compact.encode_message(b'--heartbeat--'))
+        self.assertIsNone(compact.encode_message(b'{not json'))
+
+
+class OutboxTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.websocket = WebSocket(self.server)
+        patcher = mock.patch.dict(private_settings.WS4REDIS_OUTBOX, {
+            'max_bytes': 20000, 'policy': 'coalesce', 'droppable': {'hotness': None, 'status': 'id'}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.client.close)
+        self.addCleanup(self.server.close)
+
+    def fill(self):
+        # a client which doesn't read
+        while not self.websocket.outbox_size:
+            self.websocket.send('{"type": "msg", "content": "%s"}' % ('x' * 500))
+
+    def receive_all(self):
+        self.client.setblocking(False)
+        data = b''
+        while True:
+            self.websocket.flush()
+            try:
+                chunk = self.client.recv(65536)
+            except BlockingIOError:
+                if not self.websocket.outbox_size:
+                    break
+                continue
+            data += chunk
+        return [payload for opcode, payload in self.split_frames(data)]
+
+    @staticmethod
+    def split_frames(data):
+        frames = []
+        while data:
+            length = data[1] & 0x7f
+            offset = 2
+            if length == 126:
+                length = int.from_bytes(data[2:4], 'big')
+                offset = 4
+            frames.append((data[0] & 0x0f, data[offset:offset + length]))
+            data = data[offset + length:]
+        return frames
+
+    def test_coalesce(self):
+        self.fill()
+        counters = stats.get_counters()
+        self.websocket.send('{"type": "status", "id": 1, "status": 1}')
+        self.websocket.send('{"type": "status", "id": 2, "status": 1}')
+        self.websocket.send('{"type": "status", "id": 1, "status": 2}')
+        self.websocket.send('{"type": "edit", "id": 1, "content": "y"}')
+        self.assertEqual(stats.get_counters().get('outbox.coalesced', 0), counters.get('outbox.coalesced', 0) + 1)
+        messages = self.receive_all()
+        self.assertEqual(messages[-3:], [b'{"type": "status", "id": 2, "status": 1}',
+                                         b'{"type": "status", "id": 1, "status": 2}',
+                                         b'{"type": "edit", "id": 1, "content": "y"}'])
+        self.assertFalse(any(b'"status": 1}' in message and b'"id": 1' in message for message in messages))
+
+    def test_disconnect_slow_consumer(self):
+        self.fill()
+        for _ in range(20):
+            self.websocket.send('{"type": "hotness", "posts": [%s]}' % ', '.join(['1'] * 100))
+        # superseded while waiting
+        self.assertLess(self.websocket.outbox_size, 20000)
+        # the client catches up with what the socket took, but not with the outbox
+        self.client.setblocking(False)
+        received = b''
+        while True:
+            try:
+                received += self.client.recv(65536)
+            except BlockingIOError:
+                break
+        with self.assertRaises(WebSocketError):
+            self.websocket.send('{"type": "msg", "content": "%s"}' % ('x' * 20000))
+        self.assertTrue(self.websocket.closed)
+        self.assertEqual(self.websocket.outbox_size, 0)
+        received += self.client.recv(65536)
+        # the frame written in part is completed, then the connection is closed as a policy violation
+        frames = self.split_frames(received)
+        self.assertTrue(all(opcode == WebSocket.OPCODE_TEXT for opcode, payload in frames[:-1]))
+        self.assertEqual(frames[-1], (WebSocket.OPCODE_CLOSE, struct.pack('!H', 1008) + b'Slow consumer'))
+
+    def test_disconnect_after_partial_frame(self):
+        written = []
+
+        def send(data):
+            # the socket takes a part of the first frame, then whatever comes next
+            sent = 10 if not written else len(data)
+            written.append(bytes(data[:sent]))
+            return sent
+
+        self.websocket.stream.send = send
+        self.websocket.send('{"type": "msg"}')
+        with self.assertRaises(WebSocketError):
+            self.websocket.send('{"type": "msg", "content": "%s"}' % ('x' * 20000))
+        # the close frame follows the rest of the frame begun, the other one is dropped
+        self.assertEqual(self.split_frames(b''.join(written)), [
+            (WebSocket.OPCODE_TEXT, b'{"type": "msg"}'),
+            (WebSocket.OPCODE_CLOSE, struct.pack('!H', 1008) + b'Slow consumer'),
+        ])
+
+
+def client_frame(payload, opcode=WebSocket.OPCODE_TEXT, fin=True):
+    header = Header(length=len(payload))
+    header.mask = os.urandom(4)
+    return Header.encode_header(fin, opcode, header.mask, len(payload), 0) + header.mask_payload(payload)
+
+
+class FrameReaderTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.websocket = WebSocket(self.server)
+        self.addCleanup(self.client.close)
+        self.addCleanup(self.server.close)
+
+    def test_pipelined(self):
+        self.client.sendall(b''.join(client_frame(u'message {0}'.format(i).encode('utf-8')) for i in range(50)))
+        self.assertEqual(self.websocket.receive(), u'message 0')
+        # the rest arrived with the first frame
+        self.assertGreater(self.websocket.buffered, 0)
+        self.assertEqual([self.websocket.receive() for i in range(49)],
+                         [u'message {0}'.format(i) for i in range(1, 50)])
+        self.assertEqual(self.websocket.buffered, 0)
+
+    def test_partial(self):
+        self.server.setblocking(False)
+        large = os.urandom(100000)
+        data = client_frame(b'fragment, ', fin=False) + \
+            client_frame(b'continued', WebSocket.OPCODE_CONTINUATION) + \
+            client_frame(large, WebSocket.OPCODE_BINARY)
+        received = []
+        for offset in range(0, len(data), 7777):
+            self.client.sendall(data[offset:offset + 7777])
+            while True:
+                try:
+                    received.append(self.websocket.receive())
+                except BlockingIOError:
+                    break
+        self.assertEqual(received, [u'fragment, continued', large])
+        self.assertFalse(self.websocket.closed)
+
+    def test_has_frame(self):
+        self.server.setblocking(False)
+        frames = client_frame(b'first') + client_frame(b'second')
+        self.client.sendall(frames[:-3])
+        self.assertEqual(self.websocket.receive(), u'first')
+        # the second frame is buffered only in part
+        self.assertGreater(self.websocket.buffered, 0)
+        self.assertFalse(self.websocket.has_frame())
+        self.client.sendall(frames[-3:])
+        self.assertEqual(self.websocket.receive(), u'second')
+        self.client.sendall(client_frame(b'third') + client_frame(b'fourth'))
+        self.websocket.receive()
+        self.assertTrue(self.websocket.has_frame())
+
+    def test_too_large(self):
+        self.client.sendall(Header.encode_header(True, WebSocket.OPCODE_BINARY, b'', WebSocket.MAX_FRAME_SIZE + 1, 0))
+        self.assertIsNone(self.websocket.receive())
+        self.assertTrue(self.websocket.closed)
+
+    def test_pong_returns_to_loop(self):
+        # a blocking socket must not be read again after a pong, the client may stay silent
+        self.server.settimeout(1)
+        self.client.sendall(client_frame(b'', WebSocket.OPCODE_PONG))
+        with self.assertRaises(BlockingIOError):
+            self.websocket.receive()
+        self.client.sendall(client_frame(b'', WebSocket.OPCODE_PONG) + client_frame(b'after pong'))
+        self.assertEqual(self.websocket.receive(), u'after pong')
+        self.assertEqual(self.websocket.buffered, 0)
+
+
+
+class HubTests(SimpleTestCase):
+    """
+    Drive the handlers of the hub directly, with socket pairs for the clients and the shared pubsub.
+    """
+    HANDSHAKE = ('GET {0} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                 'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n')
+
+    def setUp(self):
+        from ws4redis.hub import WebsocketHub
+        for name, value in (('WS4REDIS_ALLOWED_CHANNELS', None), ('WS4REDIS_HEARTBEAT', '--heartbeat--')):
+            patcher = mock.patch.object(private_settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.hub = WebsocketHub(('127.0.0.1', 0), redis_connection=mock.Mock())
+        self.addCleanup(self.hub._selector.close)
+        self.pubsub = mock.Mock()
+        self.pubsub.connection._sock, redis_side = socket.socketpair()
+        self.addCleanup(self.pubsub.connection._sock.close)
+        self.addCleanup(redis_side.close)
+        self.hub._pubsub = mock.Mock()
+        self.hub._pubsub.subscribe.return_value = self.pubsub
+
+    def connect(self, path='/ws/room_1?subscribe-broadcast'):
+        server, client = socket.socketpair()
+        self.addCleanup(client.close)
+        client.settimeout(1)
+        self.hub._open(server, self.HANDSHAKE.format(path).encode('ascii'), ('127.0.0.1', 0))
+        response = b''
+        while b'\r\n\r\n' not in response:
+            response += client.recv(4096)
+        return server, client, response
+
+    def read_frame(self, client):
+        data = b''
+        while True:
+            decoded = Header.decode_header(bytearray(data))
+            if decoded is not None and len(data) - decoded[1] >= decoded[0].length:
+                header, offset = decoded
+                return header.opcode, data[offset:offset + header.length]
+            data += client.recv(4096)
+
+    def test_handshake(self):
+        server, client, response = self.connect()
+        self.assertTrue(response.startswith(b'HTTP/1.1 101 Switching Protocols'))
+        self.assertIn(b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=', response)
+        self.assertIs(self.hub._connections[server.fileno()].sock, server)
+        self.assertEqual(len(self.hub._listeners), 1)
+
+    def test_refused(self):
+        server, client = socket.socketpair()
+        self.addCleanup(client.close)
+        self.hub._open(server, b'GET /ws/room_1 HTTP/1.1\r\nUpgrade: websocket\r\n\r\n', ('127.0.0.1', 0))
+        self.assertTrue(client.recv(4096).startswith(b'HTTP/1.1 426'))
+        self.assertEqual(self.hub._connections, {})
+        self.assertEqual(self.hub.admission._connections, 0)
+
+    def test_fan_out(self):
+        clients = [self.connect()[1] for _ in range(3)]
+        channel, = self.hub._listeners
+        # one subscription on the shared pubsub for all of them
+        self.hub._pubsub.subscribe.assert_called_once_with(channel)
+        self.pubsub.get_message.side_effect = [
+            {'type': 'subscribe', 'channel': channel.encode(), 'data': 1},
+            {'type': 'message', 'channel': channel.encode(), 'data': b'hello'},
+            None,
+        ]
+        self.hub._dispatch(self.pubsub, self.pubsub.connection._sock)
+        for client in clients:
+            self.assertEqual(self.read_frame(client), (WebSocket.OPCODE_TEXT, b'hello'))
+
+    def test_close(self):
+        (server, client, _), (other, _, _) = self.connect(), self.connect()
+        channel, = self.hub._listeners
+        client.sendall(client_frame(b'\x03\xe8', WebSocket.OPCODE_CLOSE))
+        key = self.hub._selector.get_key(server)
+        # further events of the batch for the closed websocket are skipped
+        self.hub._handle_events([(key, selectors.EVENT_READ), (key, selectors.EVENT_READ | selectors.EVENT_WRITE),
+                                 (key, selectors.EVENT_READ)])
+        self.assertEqual(self.read_frame(client)[0], WebSocket.OPCODE_CLOSE)
+        self.assertEqual(list(self.hub._connections), [other.fileno()])
+        self.assertEqual(self.hub.admission._connections, 1)
+        self.hub._pubsub.unsubscribe.assert_not_called()
+        self.hub._close(self.hub._connections[other.fileno()])
+        self.assertEqual(self.hub._listeners, {})
+        self.hub._pubsub.unsubscribe.assert_called_once_with(channel)
+        self.assertEqual(self.hub.admission._connections, 0)
+
+
+class KeepAliveTests(SimpleTestCase):
+
+    def setUp(self):
+        from ws4redis.wsgi_server import WebsocketWSGIServer
+        self.wsgi_server = WebsocketWSGIServer(redis_connection=mock.Mock())
+        self.server, self.client = socket.socketpair()
+        self.client.setblocking(False)
+        self.websocket = WebSocket(self.server)
+        patcher = mock.patch.multiple(private_settings, WS4REDIS_HEARTBEAT='--heartbeat--', WS4REDIS_KEEPALIVE={
+            'heartbeat': 4, 'ping': 20, 'idle': 60})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.client.close)
+        self.addCleanup(self.server.close)
+
+    def received(self):
+        try:
+            return self.client.recv(4096)
+        except BlockingIOError:
+            return b''
+
+    def test_timer_queue(self):
+        timers = TimerQueue()
+        for deadline, item in ((3.0, 'c'), (1.0, 'a'), (2.0, 'b'), (1.0, 'a2')):
+            timers.schedule(deadline, item)
+        self.assertEqual(timers.timeout(0.5), 0.5)
+        self.assertEqual(timers.expired(2.0), ['a', 'a2', 'b'])
+        self.assertEqual(timers.timeout(4.0), 0.0)
+        self.assertEqual(len(timers), 1)
+
+    def test_heartbeat_only_when_idle(self):
+        now = clock()
+        self.websocket.send('{"type": "msg"}')
+        self.received()
+        self.assertEqual(self.wsgi_server.keep_alive(self.websocket, now + 1), self.websocket.sent_at + 4)
+        self.assertEqual(self.received(), b'')
+        self.wsgi_server.keep_alive(self.websocket, now + 5)
+        self.assertEqual(self.received(), b'\x81\x0d--heartbeat--')
+
+    def test_ping_and_reap(self):
+        self.websocket.received_at -= 25
+        self.websocket.pinged_at -= 25
+        self.websocket.sent_at = clock()
+        self.wsgi_server.keep_alive(self.websocket, clock())
+        self.assertEqual(self.received(), b'\x89\x00')
+        # pinged once per interval
+        self.wsgi_server.keep_alive(self.websocket, clock())
+        self.assertEqual(self.received(), b'')
+        # the pong tells that the client is alive
+        received_at = self.websocket.received_at
+        self.server.setblocking(False)
+        self.client.sendall(client_frame(b'', WebSocket.OPCODE_PONG))
+        with self.assertRaises(BlockingIOError):
+            self.websocket.receive()
+        self.assertGreater(self.websocket.received_at, received_at)
+        self.assertIsNotNone(self.wsgi_server.keep_alive(self.websocket, clock() + 59))
+        self.assertIsNone(self.wsgi_server.keep_alive(self.websocket, clock() + 61))
+        self.assertTrue(self.websocket.closed)
+
+
+class PublishTests(SimpleTestCase):
+
+    def test_one_round_trip(self):
+        connection = mock.Mock()
+        pipe = connection.pipeline.return_value
+        store = RedisStore(connection)
+        store.publish_messages([
+            ('a', RedisMessage('{"type": "one"}')),
+            ('b', RedisMessage('{"type": "two"}')),
+            ('a', RedisMessage('plain')),
+            ('b', RedisMessage('{"type": "three"}')),
+        ], expire=10)
+        self.assertEqual(connection.method_calls, [mock.call.pipeline(transaction=False)])
+        self.assertEqual([name for name, args, kwargs in pipe.method_calls],
+                         ['eval', 'publish', 'setex', 'eval', 'execute'])
+        # consecutive numbered messages are published by one call of the script
+        self.assertEqual(pipe.method_calls[0][1][1:], (
+            6, 'a', 'a:seq', 'a:log', 'b', 'b:seq', 'b:log', store._replay_length,
+            b'{"type": "one"}', 10, b'{"type": "two"}', 10))
+
+    def test_ephemeral(self):
+        connection = mock.Mock()
+        pipe = connection.pipeline.return_value
+        RedisStore(connection).publish_messages([('a', RedisMessage('{"type": "one"}'))], persist=False)
+        self.assertEqual(pipe.method_calls, [mock.call.publish('a', b'{"type": "one"}'), mock.call.execute()])
+
+
+class MultiplexTests(SimpleTestCase):
+
+    def test_tag_message(self):
+        self.assertEqual(tag_message(b'{"type": "x"}', 'room_1'), b'{"type": "x","facility":"room_1"}')
+        self.assertEqual(tag_message(u'{}', 'room_1'), b'{"facility": "room_1", "message": "{}"}')
+        self.assertEqual(tag_message(b'hello', 'room_1'), b'{"facility": "room_1", "message": "hello"}')
+
+    def test_parse_control(self):
+        self.assertEqual(parse_control(b'{"op": "unsubscribe", "facility": "room_1"}'),
+                         {'op': 'unsubscribe', 'facility': 'room_1'})
+        for message in (None, b'', b'--heartbeat--', b'{"op": "send"}', b'{"facility": "../x"}', b'[1]'):
+            self.assertIsNone(parse_control(message))
+
+    def test_outbox_key_per_facility(self):
+        with mock.patch.dict(private_settings.WS4REDIS_OUTBOX, {'droppable': {'hotness': None}}):
+            self.assertEqual(WebSocket.get_outbox_key(tag_message(b'{"type": "hotness"}', 'room_1')),
+                             'room_1:hotness')
+            self.assertEqual(WebSocket.get_outbox_key(b'{"type": "hotness"}'), 'hotness')
+
+    def test_open_facility(self):
+        from ws4redis.wsgi_server import WebsocketWSGIServer
+        server = WebsocketWSGIServer(redis_connection=mock.Mock())
+        subscriber = mock.Mock()
+        subscriber.get_channel_keys.return_value = ([], ['broadcast:room_1'])
+        subscriber.get_missed_messages.return_value = [RedisMessage('{"seq":4,"type":"msg"}')]
+        multiplex = Multiplex(subscriber, subscriber.subscribe_channels, subscriber.unsubscribe_channels)
+        request = RequestFactory().get('/ws/multiplex')
+        request.user = None
+
+        def allowed_channels(request, channels):
+            return channels if request.path == '/ws/room_1' else []
+
+        with mock.patch.object(private_settings, 'WS4REDIS_ALLOWED_CHANNELS', allowed_channels):
+            self.assertEqual(server.on_multiplex(request, multiplex, json.dumps(
+                {'op': 'subscribe', 'facility': 'room_2', 'channels': ['subscribe-broadcast']})),
+                [b'{"type":"refused","facility":"room_2"}'])
+            self.assertEqual(server.on_multiplex(request, multiplex, json.dumps(
+                {'op': 'subscribe', 'facility': 'room_1', 'channels': ['subscribe-broadcast'], 'since': 3})),
+                [b'{"seq":4,"type":"msg","facility":"room_1"}'])
+        subscriber.subscribe_channels.assert_called_once_with(['broadcast:room_1'])
+        self.assertEqual(list(multiplex.facilities), ['room_1'])
+        self.assertEqual(multiplex.deliver('broadcast:room_1', RedisMessage('{"type":"x"}')),
+                         b'{"type":"x","facility":"room_1"}')
+        server.on_multiplex(request, multiplex, b'{"op": "unsubscribe", "facility": "room_1"}')
+        subscriber.unsubscribe_channels.assert_called_once_with(['broadcast:room_1'])
+        self.assertIsNone(multiplex.deliver('broadcast:room_1', RedisMessage('{"type":"x"}')))
+
+
+class AdmissionTests(SimpleTestCase):
+    limits = {'max_connections': 3, 'max_per_user': 2, 'handshake_rate': 1, 'handshake_burst': 2,
+              'retry_after': 5, 'retry_jitter': 1.0}
+
+    def request(self, user_id):
+        request = RequestFactory().get('/ws/room_1')
+        request.user = mock.Mock(pk=user_id, is_authenticated=lambda: user_id is not None)
+        return request
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, burst=2)
+        now = clock()
+        self.assertEqual([bucket.take(now) for _ in range(3)], [True, True, False])
+        self.assertTrue(bucket.take(now + 0.5))
+        self.assertFalse(bucket.take(now + 0.5))
+
+    def test_limits(self):
+        admission = Admission(self.limits)
+        counters = stats.get_counters()
+        tickets = [admission.enter(self.request(1)), admission.enter(self.request(1))]
+        with self.assertRaises(ServiceUnavailableError) as refused:
+            admission.enter(self.request(1))
+        self.assertTrue(5 <= refused.exception.retry_after <= 10)
+        tickets.append(admission.enter(self.request(None)))
+        with self.assertRaises(ServiceUnavailableError):
+            admission.enter(self.request(2))
+        admission.leave(tickets.pop(0))
+        tickets.append(admission.enter(self.request(1)))
+        self.assertEqual(stats.get_counters().get('handshakes.rejected.user', 0),
+                         counters.get('handshakes.rejected.user', 0) + 1)
+        self.assertEqual(stats.get_counters().get('handshakes.rejected.process', 0),
+                         counters.get('handshakes.rejected.process', 0) + 1)
+
+    def test_handshake_rate(self):
+        admission = Admission(dict(self.limits, max_connections=None))
+        admission.check_handshake()
+        admission.check_handshake()
+        with self.assertRaises(ServiceUnavailableError):
+            admission.check_handshake()
+
+    def test_refusal_response(self):
+        response = get_refusal_response(ServiceUnavailableError('Handshake refused: rate', 7))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertEqual(response['Set-Cookie'], 'ws4redis_retry_after=7; Max-Age=7; Path=/')
+
+    def test_server_refuses(self):
+        from ws4redis.wsgi_server import WebsocketWSGIServer
+        server = WebsocketWSGIServer(redis_connection=mock.Mock())
+        server.admission = Admission(dict(self.limits, max_connections=0))
+        environ = RequestFactory().get('/ws/room_1', SERVER_PROTOCOL='HTTP/1.1', HTTP_UPGRADE='websocket').environ
+        start_response = mock.Mock()
+        server(environ, start_response)
+        status, headers = start_response.call_args[0]
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertIn('Retry-After', dict(headers))
+
+
+class TicketTests(SimpleTestCase):
+    author = {'name': 'alice', 'id': 7, 'img': '/media/alice.png'}
+
+    def get_ticket(self):
+        return issue_ticket(mock.Mock(pk=7), ['org_acme', 'room_3'], author=self.author)
+
+    def test_read_ticket(self):
+        claims = read_ticket(self.get_ticket())
+        self.assertEqual(claims['user'], 7)
+        self.assertEqual(claims['facilities'], ['org_acme', 'room_3'])
+        self.assertEqual(claims['author'], self.author)
+        self.assertIsNone(read_ticket(None))
+        self.assertIsNone(read_ticket(self.get_ticket()[:-1] + 'x'))
+        with self.settings(SECRET_KEY='another'):
+            forged = self.get_ticket()
+        self.assertIsNone(read_ticket(forged))
+
+    def test_expired(self):
+        ticket = self.get_ticket()
+        with mock.patch('time.time', return_value=time.time() + private_settings.WS4REDIS_TICKET_TTL + 1):
+            self.assertIsNone(read_ticket(ticket))
+
+    def test_user_is_not_loaded(self):
+        user = TicketUser(read_ticket(self.get_ticket()))
+        self.assertTrue(user and user.is_authenticated())
+        self.assertEqual((user.pk, user.id), (7, 7))
+        self.assertIs(user._wrapped, empty)
+
+    def test_server_authorizes_from_ticket(self):
+        from ws4redis.wsgi_server import WebsocketWSGIServer
+        server = WebsocketWSGIServer(redis_connection=mock.Mock())
+        request = RequestFactory().get('/ws/multiplex', {'ticket': self.get_ticket()})
+        with mock.patch('django.contrib.sessions.backends.base.SessionBase.load') as load:
+            server.process_request(request)
+        load.assert_not_called()
+        self.assertIsNone(request.session)
+        self.assertEqual(request.user.pk, 7)
+        # the ACL would allow any room, only the ticket restricts them
+        with mock.patch('lanes.acl.ACL.may_read', return_value=True):
+            self.assertEqual(server.get_allowed_channels(request, []), [])
+            request.path_info = '/ws/room_3'
+            server.get_allowed_channels(request, [])
+            request.path_info = '/ws/room_4'
+            with self.assertRaises(PermissionDenied):
+                server.get_allowed_channels(request, [])
+
+
+class uWSGIModeTests(SimpleTestCase):
+
+    def setUp(self):
+        self.uwsgi = mock.Mock(opt={'async': b'100'})
+        patcher = mock.patch.dict(sys.modules, {'uwsgi': self.uwsgi})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # imported afresh with the fake uwsgi module of each test
+        sys.modules.pop('ws4redis.uwsgi_runserver', None)
+        self.addCleanup(sys.modules.pop, 'ws4redis.uwsgi_runserver', None)
+        self.uwsgi_runserver = importlib.import_module('ws4redis.uwsgi_runserver')
+
+    def test_mode(self):
+        self.assertEqual(self.uwsgi_runserver.get_mode(), 'async')
+        self.uwsgi.opt = {'gevent': b'1000'}
+        self.assertEqual(self.uwsgi_runserver.get_mode(), 'gevent')
+        self.uwsgi.opt = {}
+        self.assertEqual(self.uwsgi_runserver.get_mode(), 'sync')
+        with mock.patch.object(private_settings, 'WS4REDIS_UWSGI_MODE', 'gevent'):
+            self.assertEqual(self.uwsgi_runserver.get_mode(), 'gevent')
+
+    def test_suspend(self):
+        server = self.uwsgi_runserver.uWSGIWebsocketServer(redis_connection=mock.Mock())
+        self.uwsgi.ready_fd.return_value = 7
+        self.assertEqual(server.select([5, 7], [], [], 2.5), ([7], [], []))
+        self.assertEqual(self.uwsgi.wait_fd_read.call_args_list, [mock.call(5, 3), mock.call(7, 3)])
+        self.uwsgi.suspend.assert_called_once_with()
+        self.uwsgi.ready_fd.return_value = -1
+        self.assertEqual(server.select([5], [], [], None), ([], [], []))
+        self.assertEqual(self.uwsgi.wait_fd_read.call_args, mock.call(5, 0))
+
+
+NODES = [{'host': 'localhost', 'port': port, 'db': 0} for port in (6390, 6391, 6392)]
+
+
+class SubscriptionRegistryTests(SimpleTestCase):
+
+    def setUp(self):
+        from ws4redis.subscriber import SubscriptionRegistry
+        self.registry = SubscriptionRegistry(mock.Mock())
+        self.registry._pubsub = mock.Mock()
+        self.subscribers = [mock.Mock(), mock.Mock()]
+        for subscriber in self.subscribers:
+            self.registry.subscribe(subscriber, ['lanes:broadcast:room_1'])
+
+    def test_hand_over(self):
+        first, second = self.subscribers
+        self.assertTrue(self.registry.claim_reader(first))
+        self.assertFalse(self.registry.claim_reader(second))
+        self.registry.hand_over(second)
+        second.wakeup.assert_not_called()
+        # the reader busy with its own client wakes up another one to take over
+        self.registry.hand_over(first)
+        second.wakeup.assert_called_once_with()
+        first.wakeup.assert_not_called()
+        self.assertTrue(self.registry.claim_reader(second))
+        self.assertFalse(self.registry.claim_reader(first))
+
+    def test_reader_term(self):
+        first, second = self.subscribers
+        with mock.patch('ws4redis.subscriber.clock', return_value=100.0):
+            self.assertTrue(self.registry.claim_reader(first))
+        with mock.patch('ws4redis.subscriber.clock', return_value=100.0 + self.registry.reader_term / 2):
+            self.assertTrue(self.registry.claim_reader(first))
+            self.assertFalse(self.registry.claim_reader(second))
+        # the reader's loop hasn't come around for a whole term
+        with mock.patch('ws4redis.subscriber.clock', return_value=101.0 + self.registry.reader_term):
+            self.assertTrue(self.registry.claim_reader(second))
+            self.assertFalse(self.registry.claim_reader(first))
+
+    def test_subscribed_twice(self):
+        first, second = self.subscribers
+        channel = 'lanes:broadcast:room_2'
+        self.registry.subscribe(first, [channel])
+        self.registry.subscribe(first, [channel])
+        self.registry.unsubscribe_channels(first, [channel])
+        self.registry._pubsub.unsubscribe.assert_not_called()
+        self.registry._pubsub.subscribe.assert_called_with(channel)
+        self.assertEqual(self.registry._pubsub.subscribe.call_count, 2)
+        # still delivered, once
+        pubsub = mock.Mock()
+        pubsub.get_message.side_effect = [{'type': 'message', 'channel': channel.encode(), 'data': b'hi'}, None]
+        self.registry._dispatch(pubsub)
+        first.deliver.assert_called_once_with([b'message', channel.encode(), b'hi'])
+        self.registry.unsubscribe_channels(first, [channel])
+        self.registry._pubsub.unsubscribe.assert_called_once_with(channel)
+        # the other subscriber never listened on it
+        self.registry.unsubscribe_channels(second, ['lanes:broadcast:room_1', channel])
+        self.assertEqual(self.registry._pubsub.unsubscribe.call_count, 1)
+
+
+class ShardingTests(SimpleTestCase):
+
+    def test_ring_is_stable(self):
+        facilities = ['room_{0}'.format(i) for i in range(1000)]
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((facility, ring.get_node(facility)) for facility in facilities)
+        self.assertEqual(before, dict((facility, HashRing(['c', 'a', 'b']).get_node(facility))
+                                      for facility in facilities))
+        self.assertTrue(all(250 < list(before.values()).count(node) < 420 for node in 'abc'))
+        # a new node only takes over facilities, roughly its share of them
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        moved = [facility for facility in facilities if ring.get_node(facility) != before[facility]]
+        self.assertTrue(150 < len(moved) < 350)
+        self.assertTrue(all(ring.get_node(facility) == 'd' for facility in moved))
+
+    def test_channels_of_facility_share_node(self):
+        shards = Shards(NODES)
+        nodes = set(shards.get_node(channel) for channel in (
+            'lanes:broadcast:room_7', 'lanes:user:alice:room_7', 'lanes:session:abc:room_7'))
+        self.assertEqual(len(nodes), 1)
+
+    def test_publish_per_node(self):
+        shards = Shards(NODES)
+        connections = dict((node, mock.Mock()) for node in shards.nodes)
+        shards._connections = connections
+        store = RedisStore(mock.Mock())
+        store._shards = shards
+        channels = ['lanes:broadcast:room_{0}'.format(i) for i in range(20)]
+        store.publish_messages([(channel, RedisMessage('plain')) for channel in channels], persist=False)
+        for node, connection in connections.items():
+            published = [call[1][0] for call in connection.pipeline.return_value.method_calls if call[0] == 'publish']
+            self.assertEqual(published, [channel for channel in channels if shards.get_node(channel) == node])
+            self.assertEqual(connection.pipeline.call_count, 1 if published else 0)
+
+    def test_publish_to_previous_node(self):
+        shards = Shards(NODES, previous=NODES[:2])
+        for i in range(100):
+            channel = 'lanes:broadcast:room_{0}'.format(i)
+            nodes = shards.get_publish_nodes(channel)
+            self.assertEqual(nodes[0], shards.get_node(channel))
+            if nodes[0] == 'localhost:6392/0':
+                self.assertEqual(len(nodes), 2)
+            else:
+                self.assertEqual(nodes, (shards.get_node(channel),))
+
+    def test_reader_watches_new_node(self):
+        from ws4redis.subscriber import SubscriptionRegistry
+        registry = SubscriptionRegistry(mock.Mock())
+        registry._pubsub = mock.Mock()
+        pubsub = registry._pubsub.get_pubsub.return_value
+        pubsub.connection = None
+        reader = mock.Mock()
+        self.assertTrue(registry.claim_reader(reader))
+        # the first subscription on a node connects its pubsub, which the reader is woken to watch
+        registry.subscribe(mock.Mock(), ['lanes:broadcast:room_1'])
+        reader.wakeup.assert_called_once_with()
+        pubsub.connection = mock.Mock()
+        registry.subscribe(mock.Mock(), ['lanes:broadcast:room_2'])
+        reader.wakeup.assert_called_once_with()
+
+    def test_sequence_read_from_facility_node(self):
+        shards = Shards(NODES)
+        connections = dict((node, mock.Mock()) for node in shards.nodes)
+        shards.get_connection = connections.get
+        channel = next('lanes:broadcast:room_{0}'.format(i) for i in range(100)
+                       if shards.get_node('lanes:broadcast:room_{0}'.format(i)) != shards.get_node('seq'))
+        store = RedisStore(mock.Mock())
+        store._shards = shards
+        store._publishers = {channel}
+        connections[shards.get_node(channel)].mget.return_value = [b'7']
+        self.assertEqual(store.get_sequence(), 7)
+        connections[shards.get_node(channel)].mget.assert_called_once_with([channel + ':seq'])
+
+    def test_copy_to_previous_node(self):
+        shards = Shards(NODES, previous=NODES[:2])
+        channel = next(channel for channel in ('lanes:broadcast:room_{0}'.format(i) for i in range(100))
+                       if len(shards.get_publish_nodes(channel)) == 2)
+        node, previous = shards.get_publish_nodes(channel)
+        shards._connections = connections = {node: mock.Mock(), previous: mock.Mock()}
+        connections[previous].mget.return_value = [b'41']
+        connections[node].pipeline.return_value.execute.return_value = [None, [42]]
+        store = RedisStore(mock.Mock())
+        store._shards = shards
+        store.publish_messages([(channel, RedisMessage('{"type":"x"}'))], expire=10)
+        # the new node continues the numbering of the previous one, and numbers the message alone
+        seed, publish, execute = connections[node].pipeline.return_value.method_calls
+        self.assertEqual(seed[1][1:], (1, channel + ':seq', b'41'))
+        self.assertEqual(publish[1][3:], (channel + ':seq', channel + ':log', store._replay_length, b'{"type":"x"}', 10))
+        copy, execute = connections[previous].pipeline.return_value.method_calls
+        self.assertEqual(copy[1][3:], (channel + ':seq', channel + ':log', store._replay_length,
+                                       b'{"seq":42,"type":"x"}', 42, 10))
+
+
+@skipUnless(shutil.which('redis-server'), "redis-server is not installed")
+class LocalShardsTests(SimpleTestCase):
+    """
+    Publish and subscribe across several local redis-server processes.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(LocalShardsTests, cls).setUpClass()
+        cls.servers = [subprocess.Popen(['redis-server', '--port', str(node['port']), '--save', '',
+                                         '--appendonly', 'no'], stdout=subprocess.DEVNULL)
+                       for node in NODES]
+        cls.shards = Shards(NODES)
+        for node in cls.shards.nodes:
+            for _ in range(50):
+                try:
+                    cls.shards.get_connection(node).ping()
+                    break
+                except Exception:
+                    time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.terminate()
+            server.wait()
+        super(LocalShardsTests, cls).tearDownClass()
+
+    def test_publish_and_subscribe(self):
+        channels = ['lanes:broadcast:room_{0}'.format(i) for i in range(12)]
+        pubsub = ShardedPubSub(self.shards.get_connection(self.shards.nodes[0]), self.shards)
+        for channel in channels:
+            pubsub.subscribe(channel)
+        store = RedisStore(mock.Mock())
+        store._shards = self.shards
+        store.publish_messages([(channel, RedisMessage('{"type":"x"}')) for channel in channels])
+        received = set()
+        deadline = time.time() + 5
+        while len(received) < len(channels) and time.time() < deadline:
+            # get_message of redis 2.10 takes no timeout, it returns None unless a message is pending
+            messages = [node_pubsub.get_message() if node_pubsub.connection else None for node_pubsub in pubsub]
+            for message in messages:
+                if message and message['type'] == 'message':
+                    received.add(message['channel'].decode())
+            if not any(messages):
+                time.sleep(0.01)
+        self.assertEqual(received, set(channels))
+        for channel in channels:
+            self.assertEqual(store.get_messages_since(channel, 0)[0], 1)
+            # nothing of a channel is stored on the other nodes
+            for node in self.shards.nodes:
+                if node != self.shards.get_node(channel):
+                    self.assertIsNone(self.shards.get_connection(node).get(channel + ':seq'))
+
+    def test_sequence_of_facility(self):
+        # a room stored on another node than the one "seq" hashes to
+        channel = next('lanes:broadcast:room_{0}'.format(i) for i in range(200, 300)
+                       if self.shards.get_node('lanes:broadcast:room_{0}'.format(i)) != self.shards.get_node('seq'))
+        store = RedisStore(mock.Mock())
+        store._shards = self.shards
+        store.publish_messages([(channel, RedisMessage('{"type":"x"}'))] * 3)
+        store._publishers = {channel}
+        self.assertEqual(store.get_sequence(), 3)
+
+    def test_rebalance_keeps_sequence(self):
+        channels = ['lanes:broadcast:room_{0}'.format(i) for i in range(100, 112)]
+        before = RedisStore(mock.Mock())
+        before._shards = Shards(NODES[:2])
+        before.publish_messages([(channel, RedisMessage('{"type":"x"}')) for channel in channels])
+        during = RedisStore(mock.Mock())
+        during._shards = Shards(NODES, previous=NODES[:2])
+        during.publish_messages([(channel, RedisMessage('{"type":"y"}')) for channel in channels])
+        for channel in channels:
+            logs = [during._shards.get_connection(node).lrange(channel + ':log', 0, -1)
+                    for node in during._shards.get_publish_nodes(channel)]
+            # both nodes hold the same message with the same sequence number
+            self.assertEqual(logs[0][-1], b'{"seq":2,"type":"y"}')
+            self.assertEqual(set(log[-1] for log in logs), {logs[0][-1]})
+
+
+SERVER_PORT = 6395
+
+
+def allowed_channels(request, channels):
+    if request.path_info.rsplit('/', 1)[-1] == 'secret':
+        raise PermissionDenied('Not allowed to read secret')
+    return channels
+
+
+@skipUnless(shutil.which('redis-server'), "redis-server is not installed")
+class LocalServerTests(SimpleTestCase):
+    """
+    Talk to the websocket server loop of runserver through a websocket client, on a local
+    redis-server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(LocalServerTests, cls).setUpClass()
+        from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer
+        from redis import ConnectionPool, StrictRedis
+        from six.moves import socketserver
+        from ws4redis.django_runserver import WebsocketRunServer
+        from ws4redis.subscriber import SubscriptionRegistry
+        cls.redis = subprocess.Popen(['redis-server', '--port', str(SERVER_PORT), '--save', '', '--appendonly', 'no'],
+                                     stdout=subprocess.DEVNULL)
+        cls.connection = StrictRedis(port=SERVER_PORT)
+        for _ in range(50):
+            try:
+                cls.connection.ping()
+                break
+            except Exception:
+                time.sleep(0.1)
+        cls.patchers = [
+            mock.patch('ws4redis.publisher.redis_connection_pool', ConnectionPool(port=SERVER_PORT)),
+            mock.patch.object(private_settings, 'WS4REDIS_ALLOWED_CHANNELS', allowed_channels),
+            # the shared subscription of the process is created anew on this redis-server
+            mock.patch.object(SubscriptionRegistry, '_instance', None),
+        ]
+        for patcher in cls.patchers:
+            patcher.start()
+        httpd_class = type('WSGIServer', (socketserver.ThreadingMixIn, WSGIServer), {'daemon_threads': True})
+        cls.httpd = httpd_class(('localhost', 0), WSGIRequestHandler)
+        cls.server = WebsocketRunServer(cls.connection)
+        cls.httpd.set_app(cls.server)
+        cls.thread = threading.Thread(target=cls.httpd.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = 'ws://localhost:{0}/ws/'.format(cls.httpd.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+        for patcher in reversed(cls.patchers):
+            patcher.stop()
+        cls.redis.terminate()
+        cls.redis.wait()
+        super(LocalServerTests, cls).tearDownClass()
+
+    def setUp(self):
+        self.connection.flushdb()
+        self.publisher = RedisPublisher(facility='unittest', broadcast=True)
+
+    def connect(self, path):
+        from websocket import create_connection
+        ws = create_connection(self.url + path, timeout=5)
+        self.addCleanup(ws.close)
+        return ws
+
+    def wait_subscribed(self, facility):
+        """ The server subscribes after answering the handshake, so a client may get ahead of it """
+        channel = self.publisher.get_broadcast_channel(facility)
+        for _ in range(50):
+            if self.connection.execute_command('PUBSUB', 'CHANNELS', channel):
+                return
+            time.sleep(0.01)
+
+    def test_resume(self):
+        for name in ('zero', 'one', 'two'):
+            self.publisher.publish_message(RedisMessage('{"type":"%s"}' % name))
+        self.assertEqual(self.publisher.get_sequence(), 3)
+        ws = self.connect('unittest?subscribe-broadcast&since=1')
+        self.assertEqual(ws.recv(), '{"seq":2,"type":"one"}')
+        self.assertEqual(ws.recv(), '{"seq":3,"type":"two"}')
+        self.publisher.publish_message(RedisMessage('{"type":"three"}'))
+        self.assertEqual(ws.recv(), '{"seq":4,"type":"three"}')
+
+    def test_replayed_message_also_live(self):
+        get_missed_messages = self.server.get_missed_messages
+
+        def publish_then_fetch(request, subscriber):
+            # published once subscribed but before the missed messages are fetched
+            self.publisher.publish_message(RedisMessage('{"type":"late"}'))
+            return get_missed_messages(request, subscriber)
+
+        with mock.patch.object(self.server, 'get_missed_messages', publish_then_fetch):
+            ws = self.connect('unittest?subscribe-broadcast&since=0')
+            # both copies carry the same number, by which ws4redis.js drops the second one
+            self.assertEqual(ws.recv(), '{"seq":1,"type":"late"}')
+            self.assertEqual(ws.recv(), '{"seq":1,"type":"late"}')
+
+    def test_gap(self):
+        with mock.patch.object(RedisStore, '_replay_length', 2):
+            for _ in range(4):
+                self.publisher.publish_message(RedisMessage('{"type":"x"}'))
+        # messages 2 and 3 have been trimmed from the log
+        ws = self.connect('unittest?subscribe-broadcast&since=1')
+        self.assertEqual(ws.recv(), '{"seq":4,"type":"gap"}')
+        ws = self.connect('unittest?subscribe-broadcast&since=2')
+        self.assertEqual(ws.recv(), '{"seq":3,"type":"x"}')
+
+    def test_buffered_publishing(self):
+        ws = self.connect('unittest?subscribe-broadcast')
+        self.wait_subscribed('unittest')
+        with buffered_publishing():
+            self.publisher.publish_message(RedisMessage('{"type":"one"}'))
+            self.publisher.publish_message(RedisMessage('{"type":"hotness"}'), persist=False)
+            self.publisher.publish_messages([(self.publisher.get_broadcast_channel('unittest'),
+                                              RedisMessage('{"type":"two"}'))])
+            self.assertEqual(self.publisher.get_sequence(), 0)
+        self.assertEqual([ws.recv() for _ in range(3)],
+                         ['{"seq":1,"type":"one"}', '{"type":"hotness"}', '{"seq":2,"type":"two"}'])
+        # the ephemeral message is neither numbered nor kept for replay
+        self.assertEqual(self.publisher.get_sequence(), 2)
+        ws = self.connect('unittest?subscribe-broadcast&since=0')
+        self.assertEqual([ws.recv() for _ in range(2)], ['{"seq":1,"type":"one"}', '{"seq":2,"type":"two"}'])
+
+    def test_multiplex(self):
+        ws = self.connect('multiplex')
+        ws.send('{"op": "subscribe", "facility": "unittest", "channels": ["subscribe-broadcast"]}')
+        ws.send('{"op": "subscribe", "facility": "other", '
+                '"channels": ["subscribe-broadcast", "publish-broadcast", "echo"]}')
+        ws.send('{"op": "subscribe", "facility": "secret", "channels": ["subscribe-broadcast"]}')
+        self.assertEqual(ws.recv(), '{"type":"refused","facility":"secret"}')
+        ws.send('{"op": "send", "facility": "other", "message": "hello"}')
+        self.assertEqual(json.loads(ws.recv()), {'facility': 'other', 'message': 'hello'})
+        self.publisher.publish_message(RedisMessage('{"type":"one"}'))
+        self.assertEqual(ws.recv(), '{"seq":1,"type":"one","facility":"unittest"}')
+        ws.send('{"op": "unsubscribe", "facility": "unittest"}')
+        # answered once the unsubscribe has been handled
+        ws.send('{"op": "send", "facility": "other", "message": "unsubscribed"}')
+        self.assertEqual(json.loads(ws.recv())['message'], 'unsubscribed')
+        self.publisher.publish_message(RedisMessage('{"type":"two"}'))
+        ws.send('{"op": "send", "facility": "other", "message": "done"}')
+        self.assertEqual(json.loads(ws.recv())['message'], 'done')
+        # a facility which isn't open is ignored
+        ws.send('{"op": "send", "facility": "secret", "message": "hello"}')
+        ws.send('{"op": "send", "facility": "other", "message": "last"}')
+        self.assertEqual(json.loads(ws.recv())['message'], 'last')
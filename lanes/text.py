@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import re
+import collections
+
+from cgi import escape
+from urllib.parse import urlparse
+
+from .models import Post, User
+
+url_dot_test = re.compile(r'.+\..+')
+lf_youtube = re.compile(r'(.*)v=([A-Za-z0-9]*)')
+reply_test = re.compile(r'^(:[0-9]+ )')
+
+
+def valid_link(text, is_onebox=False):
+  if len(text.split(" ")) != 1 or '"' in text or "'" in text:
+    return False
+  url = urlparse(text)
+  if url.scheme in ['http', 'https'] and len(re.findall(url_dot_test, url.netloc)) > 0:
+    # Is a valid link, now find out what kind
+    if not is_onebox:
+      return True
+    if url.path.lower().split(".")[-1] in ["jpg", "jpeg", "png", "gif"]:
+      return onebox('<a href="{0}" rel="nofollow" target="_blank"><img src="{0}" alt="" onload="scrolldown()"></a>'.format(text))
+    elif url.netloc in ["www.youtube.com", "youtube.com", "youtu.be"]:
+      slug = url.path[1:] if url.netloc == "youtu.be" else re.search(lf_youtube, url.query).group(2)
+      return onebox('<iframe width="400" height="300" src="https://www.youtube.com/embed/{}" frameborder="0"></iframe>'.format(slug))
+    else:
+      return False
+  else:
+    return False
+
+
+def link_formatter(match_obj):
+  link = match_obj.group(2).strip()
+  if valid_link(link):
+    return r'[{}]({})'.format(match_obj.group(1), match_obj.group(2))
+  return r'<a href="{}" rel="nofollow">{}</a>'.format(link, match_obj.group(1))
+
+
+md_rules = collections.OrderedDict()
+md_rules[re.compile(r'\[([^\[]+)\]\(([^\)]+)\)')] = link_formatter    # links
+md_rules[re.compile(r'(\*\*|__)(.*?)\1')] = r'<strong>\2</strong>'    # bold
+md_rules[re.compile(r'(\*|_)(.*?)\1')] = r'<em>\2</em>'               # emphasis
+md_rules[re.compile(r'\-\-\-(.*?)\-\-\-')] = r'<del>\1</del>'         # del
+md_rules[re.compile(r'^&gt; (.*)')] = r'<blockquote>\1</blockquote>'  # quote
+md_rules[re.compile(r'`(.*?)`')] = r'<code>\1</code>'                 # inline code
+
+
+def onebox(text):
+  return '<div class="ob">' + text + '</div>'
+
+
+def process_text(text):
+  # Check that message is not blank
+  if text.strip() == "":
+    raise
+  # strip reply if there is one
+  reply = re.search(reply_test, text)
+  reply_prefix = ""
+  notified = set()
+  if reply is not None:
+    reply_prefix = reply.group(0)
+    text = text[len(reply_prefix):]
+    try:
+      notified.add(Post.objects.get(id=int(reply_prefix.strip(': '))).author)
+    except:
+      pass
+  # Check for anyone else that's pinged
+  words = text.split(' ')
+  for word in words:
+    if len(word) > 1 and word[0] == '@':
+      try:
+        notified.add(User.objects.get(username=word[1:]))
+      except:
+        pass
+  # Check for entire block indented by 4 spaces
+  is_code = True
+  code = ""
+  for line in text.split("\n"):
+    if line[0:4] == "    ":
+      code += line[4:] + "\n"
+    else:
+      is_code = False
+      break
+  if is_code:
+    result = "<pre>{}</pre>".format(escape(code).replace("'", "&#39;"))
+  else:
+    # Check for oneboxes
+    link = valid_link(text, is_onebox=True)
+    if link is not False:
+      result = link
+    else:
+      text = escape(text).replace("'", "&#39;").replace("\n", "<br>")
+      # Apply Markdown rules
+      for regex, replacement in md_rules.items():
+        text = re.sub(regex, replacement, text)
+      result = text
+  return {
+      'text': reply_prefix + result.strip(),
+      'notified': notified
+  }
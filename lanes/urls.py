@@ -37,6 +37,8 @@ urlpatterns = [
     url(r'^c/(?P<slug>[\w-]+)/bot/(?P<username>[\w-]+)/delete/$', BotDeleteView.as_view(), name='bot_delete'),
 
     url(r'^room/(?P<room_id>\d+)/$', RoomView.as_view(), name='room'),
+    url(r'^room/(?P<room_id>\d+)/history/$', RoomHistoryView.as_view(), name='room_history'),
+    url(r'^room/(?P<room_id>\d+)/members/$', RoomMembersView.as_view(), name='room_members'),
     url(r'^room/(?P<room_id>\d+)/post/$', RoomMessageView.as_view(), name='room_post'),
     url(r'^room/(?P<room_id>\d+)/pin/$', RoomPinView.as_view(), name='room_pin'),
     url(r'^room/(?P<room_id>\d+)/edit/$', RoomEditView.as_view(), name='room_edit'),
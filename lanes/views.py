@@ -1,13 +1,10 @@
 # -*- coding: utf-8 -*-
 import json
 import re
-import collections
 import logging
 
-from cgi import escape
-from urllib.parse import urlparse
-
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404
 from django.conf import settings
 from django.contrib.auth import get_user_model, authenticate, login, logout
 from django.contrib.auth.mixins import LoginRequiredMixin, AccessMixin
@@ -22,111 +19,22 @@ from django.views.decorators.csrf import csrf_exempt
 from ratelimit.mixins import RatelimitMixin
 from ws4redis.redis_store import RedisMessage
 from ws4redis.publisher import RedisPublisher
+from ws4redis.tickets import issue_ticket
 
 from .models import *
 from .forms import *
 from .utils import is_email_public
 from .emails import *
+from .commands import edit_post, flag_post, pin_post, post_message, vote_post
+from .members import MemberList, forget_avatar, get_avatars
+from .pinboard import PinBoard
 
 logger = logging.getLogger('django')
 User = get_user_model()
 
-url_dot_test = re.compile(r'.+\..+')
-lf_youtube = re.compile(r'(.*)v=([A-Za-z0-9]*)')
-reply_test = re.compile(r'^(:[0-9]+ )')
 username_test = re.compile("^([a-z][0-9]+)+$")
 
 
-def valid_link(text, is_onebox=False):
-  if len(text.split(" ")) != 1 or '"' in text or "'" in text:
-    return False
-  url = urlparse(text)
-  if url.scheme in ['http', 'https'] and len(re.findall(url_dot_test, url.netloc)) > 0:
-    # Is a valid link, now find out what kind
-    if not is_onebox:
-      return True
-    if url.path.lower().split(".")[-1] in ["jpg", "jpeg", "png", "gif"]:
-      return onebox('<a href="{0}" rel="nofollow" target="_blank"><img src="{0}" alt="" onload="scrolldown()"></a>'.format(text))
-    elif url.netloc in ["www.youtube.com", "youtube.com", "youtu.be"]:
-      slug = url.path[1:] if url.netloc == "youtu.be" else re.search(lf_youtube, url.query).group(2)
-      return onebox('<iframe width="400" height="300" src="https://www.youtube.com/embed/{}" frameborder="0"></iframe>'.format(slug))
-    else:
-      return False
-  else:
-    return False
-
-
-def link_formatter(match_obj):
-  link = match_obj.group(2).strip()
-  if valid_link(link):
-    return r'[{}]({})'.format(match_obj.group(1), match_obj.group(2))
-  return r'<a href="{}" rel="nofollow">{}</a>'.format(link, match_obj.group(1))
-
-
-md_rules = collections.OrderedDict()
-md_rules[re.compile(r'\[([^\[]+)\]\(([^\)]+)\)')] = link_formatter    # links
-md_rules[re.compile(r'(\*\*|__)(.*?)\1')] = r'<strong>\2</strong>'    # bold
-md_rules[re.compile(r'(\*|_)(.*?)\1')] = r'<em>\2</em>'               # emphasis
-md_rules[re.compile(r'\-\-\-(.*?)\-\-\-')] = r'<del>\1</del>'         # del
-md_rules[re.compile(r'^&gt; (.*)')] = r'<blockquote>\1</blockquote>'  # quote
-md_rules[re.compile(r'`(.*?)`')] = r'<code>\1</code>'                 # inline code
-
-
-def onebox(text):
-  return '<div class="ob">' + text + '</div>'
-
-
-def process_text(text):
-  # Check that message is not blank
-  if text.strip() == "":
-    raise
-  # strip reply if there is one
-  reply = re.search(reply_test, text)
-  reply_prefix = ""
-  notified = set()
-  if reply is not None:
-    reply_prefix = reply.group(0)
-    text = text[len(reply_prefix):]
-    try:
-      notified.add(Post.objects.get(id=int(reply_prefix.strip(': '))).author)
-    except:
-      pass
-  # Check for anyone else that's pinged
-  words = text.split(' ')
-  for word in words:
-    if len(word) > 1 and word[0] == '@':
-      try:
-        notified.add(User.objects.get(username=word[1:]))
-      except:
-        pass
-  # Check for entire block indented by 4 spaces
-  is_code = True
-  code = ""
-  for line in text.split("\n"):
-    if line[0:4] == "    ":
-      code += line[4:] + "\n"
-    else:
-      is_code = False
-      break
-  if is_code:
-    result = "<pre>{}</pre>".format(escape(code).replace("'", "&#39;"))
-  else:
-    # Check for oneboxes
-    link = valid_link(text, is_onebox=True)
-    if link is not False:
-      result = link
-    else:
-      text = escape(text).replace("'", "&#39;").replace("\n", "<br>")
-      # Apply Markdown rules
-      for regex, replacement in md_rules.items():
-        text = re.sub(regex, replacement, text)
-      result = text
-  return {
-      'text': reply_prefix + result.strip(),
-      'notified': notified
-  }
-
-
 def ratelimit(request, ex):
   return JsonResponse({
       'error': True,
@@ -228,6 +136,21 @@ class RoomPostMixin(LoginOrMaybeBotMixin, RatelimitMixin, View):
     return self.generate_response(request)
 
 
+def get_ticket(user, facilities):
+  """ The ticket for the page's websocket to open facilities without loading the session """
+  return issue_ticket(user, facilities, author={
+      'name': user.username,
+      'id': user.id,
+      'img': user.get_image()
+  })
+
+
+def get_author_avatars(posts):
+  """ Map the ids of the authors of posts, fetched along with their author, to their avatar urls """
+  authors = dict((post.author_id, post.author) for post in posts)
+  return get_avatars((author.id, author.hash, author.profile_image) for author in authors.values())
+
+
 class RoomView(LoginRequiredMixin, TemplateView):
   template_name = 'room.html'
 
@@ -252,28 +175,16 @@ class RoomView(LoginRequiredMixin, TemplateView):
     elif self.request.user not in room.members.all():
       logger.debug("Added " + str(self.request.user) + " to " + str(room))
       room.members.add(self.request.user)
-    pinned = []
-    for post in room.pinned:
-      vote = 0
-      try:
-        vote = Vote.objects.get(post=post, user=self.request.user).score
-      except:
-        pass
-      pinned.append({
-          "post": post,
-          "vote": vote
-      })
-    users = room.members.all()
-    online = []
-    for u in users:
-      online.append({
-          "username": u.username,
-          "email": u.email,
-          "id": u.id,
-          "status": u.get_status(room.organisation),
-          "image": u.get_image()
-      })
-    status = OrgMembership.objects.get(user=self.request.user, organisation=room.organisation).status
+    # Read before anything is rendered, the socket replays whatever is published after it
+    sequence = RedisPublisher(facility='room_' + str(room.id), broadcast=True).get_sequence()
+    # The template prepends pins one by one, so hand them over coolest first
+    pinned = PinBoard(room.id).for_user(self.request.user)[::-1]
+    online, members_next = MemberList(room).get_page()
+    history = room.history
+    avatars = get_author_avatars(history)
+    for post in history:
+      post.author_image = avatars[post.author_id]
+    status = self.request.user.get_status(room.organisation)
     if status == OrgMembership.STATUS_OFFLINE:
       # Just joining, so set to Online
       status = OrgMembership.STATUS_ONLINE
@@ -285,12 +196,83 @@ class RoomView(LoginRequiredMixin, TemplateView):
                    status=status,
                    can_participate=self.request.user.is_member(room.organisation),
                    is_owner=self.request.user in room.owners.all(),
+                   history=history,
                    pinned=pinned,
                    prefs=RoomPrefs.objects.get_or_create(room=room, user=self.request.user)[0],
-                   users=online)
+                   users=online,
+                   members_next=members_next,
+                   sequence=sequence,
+                   ticket=get_ticket(self.request.user, ['org_' + room.organisation.slug, 'room_' + str(room.id)]))
     return context
 
 
+class RoomHistoryView(LoginRequiredMixin, View):
+  """ endpoint to page back through the history of a room
+      /room/<id>/history/                  - latest posts
+      /room/<id>/history/?before=<cursor>  - posts older than cursor
+  """
+
+  def get(self, request, *args, **kwargs):
+    room = get_object_or_404(Room, id=kwargs['room_id'])
+    if not request.user.is_member(room.organisation) or not request.user.can_view(room):
+      raise PermissionDenied
+    if request.user.is_banned(room.organisation):
+      raise PermissionDenied
+    try:
+      before = decode_cursor(request.GET['before']) if 'before' in request.GET else None
+      limit = int(request.GET.get('limit', Room.HISTORY_PAGE_SIZE))
+    except ValueError:
+      raise SuspiciousOperation
+    if not 0 < limit <= Room.HISTORY_PAGE_SIZE:
+      raise SuspiciousOperation
+    posts = room.get_history_page(before, limit + 1)
+    more = len(posts) > limit
+    posts = posts[:limit]
+    votes = dict(Vote.objects.filter(user=request.user, post__in=posts).values_list('post_id', 'score'))
+    avatars = get_author_avatars(posts)
+    res = []
+    for post in reversed(posts):
+      author = post.author
+      res.append({
+          'author': {
+              'name': author.username,
+              'id': author.id,
+              'img': avatars[author.id]
+          },
+          'content': post.content,
+          'raw': post.raw,
+          'edited': post.edited,
+          'deleted': post.deleted,
+          'pinned': post.pinned,
+          'score': post.score,
+          'vote': votes.get(post.id, 0),
+          'created': post.created.isoformat(),
+          'id': post.id
+      })
+    return JsonResponse({
+        'posts': res,
+        'next': encode_cursor(posts[-1]) if more else None
+    })
+
+
+class RoomMembersView(LoginRequiredMixin, View):
+  """ endpoint to lazy load the member list of large rooms
+      /room/<id>/members/?after=<username>
+  """
+
+  def get(self, request, *args, **kwargs):
+    room = get_object_or_404(Room, id=kwargs['room_id'])
+    if not request.user.is_member(room.organisation) or not request.user.can_view(room):
+      raise PermissionDenied
+    if request.user.is_banned(room.organisation):
+      raise PermissionDenied
+    members, after = MemberList(room).get_page(request.GET.get('after'))
+    return JsonResponse({
+        'users': members,
+        'next': after
+    })
+
+
 class DMView(RoomView):
 
   def get_room(self):
@@ -336,24 +318,8 @@ class RoomPrefsView(RoomPostMixin):
 class RoomPinView(RoomPostMixin):
 
   def generate_response(self, request):
-    post = Post.objects.get(id=request.POST.get('id'))
-    # Prevent people who've already voted from re-pinning
-    if post.pinned or Vote.objects.filter(user=self.request.user, post=post).count() > 0:
-      raise PermissionDenied
-    post.pinned = True
-    post.pinned_at = timezone.now()
-    post.save()
-    if post.author != self.request.user:
-      Vote(user=self.request.user, post=post, score=1).save()
-    message = {
-        'type': 'pin',
-        'score': post.score,
-        'id': post.id,
-        'author_id': post.author.id
-    }
-    if 'pincode' in request.POST:
-      message['pincode'] = request.POST.get('pincode')
-    self.publisher.publish_message(RedisMessage(json.dumps(message)))
+    post = Post.objects.get(id=request.POST.get('id'), room=self.room)
+    pin_post(post, request.user, request.POST.get('pincode'))
     return HttpResponse('OK')
 
 
@@ -362,30 +328,7 @@ class RoomMessageView(RoomPostMixin):
   allow_bots = True
 
   def generate_response(self, request):
-    post = Post(room=self.room, author=request.user)
-    post.save()
-    raw = request.POST.get('message')
-    processed = process_text(raw)
-    content = PostContent(
-        author=request.user,
-        post=post,
-        raw=raw,
-        content=processed['text'])
-    content.save()
-    message = {
-        'type': 'msg',
-        'author': {
-            'name': request.user.username,
-            'id': request.user.id,
-            'img': request.user.get_image()
-        },
-        'content': post.content,
-        'raw': raw,
-        'id': post.id
-    }
-    self.publisher.publish_message(RedisMessage(json.dumps(message)))
-    for user in processed['notified']:
-      user.notify(post)
+    post_message(self.room, request.user, request.POST.get('message'))
     return HttpResponse('OK')
 
 
@@ -418,7 +361,7 @@ class OrgMixin(LoginRequiredMixin):
     user = self.request.user
     is_member = self.org in user.organisations.all()
     if is_member:
-      status = OrgMembership.objects.get(user=self.request.user, organisation=self.org).status
+      status = self.request.user.get_status(self.org)
       if status == OrgMembership.STATUS_OFFLINE:
         # Just joining, so set to online
         status = OrgMembership.STATUS_ONLINE
@@ -507,27 +450,10 @@ class PostMixin(LoginRequiredMixin):
 class PostEditView(PostMixin, View):
 
   def post(self, request, *args, **kwargs):
-    raw = request.POST.get('message')
     try:
-        processed, notified = process_text(raw)
-    except:
-        return HttpResponse('Not OK')
-    content = PostContent(
-        author=request.user,
-        post=self.msg,
-        raw=raw,
-        content=processed['text'])
-    content.save()
-    message = {
-        'type': 'edit',
-        'content': processed,
-        'raw': raw,
-        'id': self.msg.id
-    }
-    RedisPublisher(facility='room_' + str(self.msg.room.id), broadcast=True) \
-        .publish_mressage(RedisMessage(json.dumps(message)))
-    for user in processed['notified']:
-      user.notify(self.msg)
+      edit_post(self.msg, request.user, request.POST.get('message'))
+    except ValueError:
+      return HttpResponse('Not OK')
     return HttpResponse('OK')
 
 
@@ -535,24 +461,7 @@ class PostFlagView(PostMixin, View):
   require_owner = False
 
   def post(self, request, *args, **kwargs):
-    try:
-      Flag(post=self.msg, flagger=request.user).save()
-    except:
-      raise PermissionDenied
-    if self.msg.get_flags() > 3 and not self.msg.deleted:
-      self.msg.remove(request.user)
-      self.msg.author.ban_for(self.msg.room.organisation, 60 * 30)  # Half an hour
-      message = {
-          'type': 'delete',
-          'id': self.msg.id
-      }
-    else:
-      message = {
-          'type': 'flag',
-          'id': self.msg.id
-      }
-    RedisPublisher(facility='room_' + str(self.msg.room.id), broadcast=True) \
-        .publish_message(RedisMessage(json.dumps(message)))
+    flag_post(self.msg, request.user)
     return HttpResponse('OK')
 
 
@@ -562,38 +471,11 @@ class PostVoteView(PostMixin, View):
   require_not_owner = True
 
   def post(self, request, *args, **kwargs):
-    post = self.msg
-    value = int(request.POST.get('value'))
-    if value not in [-1, 1]:
-      raise PermissionDenied
     try:
-      vote = Vote(post=post,
-          user=request.user,
-          score=value)
-      vote.save()
-    except:
-      # Already a vote for this user on this post
+      value = int(request.POST.get('value'))
+    except (TypeError, ValueError):
       raise PermissionDenied
-    score = post.score
-    post.update_hotness()
-    if score < -4:
-      #unpin
-      post.pinned = False
-      post.save()
-      message = {
-          'type': 'unpin',
-          'id': post.id
-      }
-      RedisPublisher(facility='room_' + str(post.room.id), broadcast=True) \
-          .publish_message(RedisMessage(json.dumps(message)))
-    else:
-      message = {
-          'type': 'vote',
-          'content': score,
-          'id': post.id
-      }
-      RedisPublisher(facility='room_' + str(post.room.id), broadcast=True) \
-          .publish_message(RedisMessage(json.dumps(message)))
+    vote_post(self.msg, request.user, value)
     return HttpResponse('OK')
 
 
@@ -614,7 +496,12 @@ class PostHistoryView(PostMixin, TemplateView):
   def post(self, request, *args, **kwargs):
     if self.msg.deleted:
       raise PermissionDenied
+    pinned = self.msg.pinned
     self.msg.remove(request.user)
+    if pinned:
+      board = PinBoard(self.msg.room_id)
+      board.invalidate()
+      board.mark_stale()
     message = {
         'type': 'delete',
         'id': self.msg.id
@@ -720,6 +607,8 @@ class OrgView(OrgMixin, TemplateView):
       context.update(rooms=rs)
     else:
       context.update(rooms=rooms)
+    if context['is_member']:
+      context.update(ticket=get_ticket(self.request.user, ['org_' + self.org.slug]))
     return context
 
 
@@ -913,7 +802,9 @@ class UserPictureView(LoginRequiredMixin, UpdateView):
   def form_valid(self, form):
     if self.object.id != self.request.user.id:
       raise PermissionDenied
-    return super(UserPictureView, self).form_valid(form)
+    response = super(UserPictureView, self).form_valid(form)
+    forget_avatar(self.object.id)
+    return response
 
 
 
@@ -946,16 +837,9 @@ class OrgStatusView(OrgMixin, View):
 
   def post(self, request, *args, **kwargs):
     status = int(request.POST.get('status'))
-    membership = OrgMembership.objects.get(user=self.request.user, organisation=self.org)
-    membership.status = status
-    membership.save()
-    message = {
-        "type": "status",
-        "id": request.user.id,
-        "status": membership.status
-    }
-    RedisPublisher(facility='org_' + self.org.slug, broadcast=True) \
-        .publish_message(RedisMessage(json.dumps(message)))
+    if status not in dict(OrgMembership.STATUS_CHOICES):
+      raise PermissionDenied
+    request.user.set_status(self.org, status)
     return HttpResponse('OK')
 
 
@@ -1,5 +1,19 @@
 import os
 
+try:
+  import uwsgi
+except ImportError:
+  uwsgi = None
+
+if uwsgi is not None and 'gevent' in uwsgi.opt:
+  # with uWSGI's gevent loop engine, make sockets cooperative before Redis or Django open any
+  from gevent import monkey
+  monkey.patch_all()
+  # psycopg2 talks to Postgres in C, where the patched sockets don't reach: without a wait
+  # callback each query would block every greenlet of the process
+  from psycogreen.gevent import patch_psycopg
+  patch_psycopg()
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lanes.settings')
 
 from django.conf import settings
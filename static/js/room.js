@@ -25,7 +25,9 @@ jQuery(document).ready(function($) {
 
   window.receiveMessage = function(msg) {
     console.log(msg);
-    var msg = JSON.parse(msg);
+    if (typeof msg === 'string') {
+      msg = JSON.parse(msg);
+    }
     switch(msg.type){
       case "msg":
         appendFastMessage(msg);
@@ -100,15 +102,44 @@ jQuery(document).ready(function($) {
         break;
       case "flag":
         $(".msg-" + msg.id).addClass('flagged');
+        break;
+      case "gap":
+        // missed more messages while disconnected than the server keeps
+        location.reload();
+        break;
+      case "reply":
+        var callback = pending_commands[msg.ref];
+        delete pending_commands[msg.ref];
+        if (!msg.ok) {
+          showError(msg.error);
+        } else if (callback) {
+          callback();
+        }
     }
   };
 
   var loading = true;
+  var command_ref = 0;
+  var pending_commands = {};
 
-  var sock = WS4Redis({
-    uri: sock_uri,
-    receive_message: receiveMessage,
-    heartbeat_msg: hb
+  // Send a command over the websocket of the room, falling back to the ajax request while it is
+  // not connected
+  function sendCommand(command, data, request) {
+    if (!sock.is_connected()) {
+      $.ajax(request);
+      return;
+    }
+    data.command = command;
+    data.ref = ++command_ref;
+    if (request.success) {
+      pending_commands[data.ref] = request.success;
+    }
+    sock.send_message(JSON.stringify(data));
+  }
+
+  var sock = wsock.subscribe('room_' + room_id, {
+    since: sock_since,
+    receive_message: receiveMessage
   });
 
   var temp_vol = volume;
@@ -122,6 +153,7 @@ jQuery(document).ready(function($) {
     $("#shout").attr("disabled","disabled").addClass("disabled");
   }
   loading = false;
+  loadMembers(members_next);
 
   $("#shout").keydown(function(ev) {
     if (ev.keyCode === 13 && !ev.shiftKey) {
@@ -133,7 +165,7 @@ jQuery(document).ready(function($) {
       var message = shout.val();
       if (message.trim() !== ""){
         if(editing) {
-          $.ajax({
+          sendCommand('edit', {id: edit_id, message: message}, {
             method: "post",
             url: "/post/" + edit_id + "/edit/",
             data: {
@@ -142,7 +174,7 @@ jQuery(document).ready(function($) {
           });
           stopEdit();
         } else {
-          $.ajax({
+          sendCommand('post', {message: message}, {
             method: "post",
             url: "/room/" + room_id + "/post/",
             data: {
@@ -453,7 +485,7 @@ jQuery(document).ready(function($) {
     var controls = $('<div class="controls"></div>');
     var flag = $('<i class="fa fa-flag-o flag"></i>');
     flag.on('click', function(){
-      $.ajax({
+      sendCommand('flag', {id: id}, {
         method: "post",
         url: "/post/" + id + "/flag/"
       });
@@ -479,7 +511,7 @@ jQuery(document).ready(function($) {
     pin.on('click', function(){
       var code = Math.random().toString(36);
       pincodes.push(code);
-      $.ajax({
+      sendCommand('pin', {id: id, pincode: code}, {
         method: "post",
         url: "/room/" + room_id + "/pin/",
         data: {
@@ -575,8 +607,34 @@ jQuery(document).ready(function($) {
     }
   }
 
-  function submitVote (value, id, el) {
+  function loadMembers (after) {
+    // Large rooms only render the first page of members, fetch the rest in the background
+    if (after === null) {
+      return;
+    }
     $.ajax({
+      method: 'get',
+      url: '/room/' + room_id + '/members/',
+      data: {
+        after: after
+      },
+      success: function(data){
+        data.users.forEach(function(u){
+          if ($('.user-' + u.id).length > 0) {
+            return;
+          }
+          var user = $('<div class="user user-' + u.id + '"></div>').text(u.username);
+          user.prepend($('<img alt="" class="profile-picture">').attr('src', u.image));
+          user.append('<div class="online-marker status-' + u.status + '"></div>');
+          $('#users').append(user);
+        });
+        loadMembers(data.next);
+      }
+    });
+  }
+
+  function submitVote (value, id, el) {
+    sendCommand('vote', {id: parseInt(id, 10), value: value}, {
         method: 'post',
         url: "/post/" + id + "/vote/",
         data: {
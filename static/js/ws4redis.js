@@ -5,12 +5,33 @@
  * options.disconnected -> Callback called after the websocket is disconnected.
  * options.receive_message -> Callback called when a message is received from the websocket.
  * options.heartbeat_msg -> String to identify the heartbeat message.
+ * options.compact -> Offer the binary ws4redis.compact.v1 subprotocol. If the server accepts,
+ *   JSON messages are decoded before being passed to receive_message as objects.
+ * options.since -> Sequence number of the last message already known to the page, the messages
+ *   published afterwards are replayed on connecting. Reconnects resume from the last message received.
+ * options.multiplex -> The URI is the multiplexed websocket, facilities are opened on it with
+ *   subscribe(facility, options), which takes channels, since and receive_message and returns an
+ *   object with send_message, unsubscribe and is_connected.
+ * options.lazy -> Don't connect before the first call of subscribe, so that a page which doesn't
+ *   subscribe to any facility doesn't open a websocket.
+ * A server refusing the handshake under load tells when to retry, which is honored instead of the
+ * usual backoff.
  * $ -> JQuery instance.
  */
 function WS4Redis(options, $) {
 	'use strict';
 	var opts, ws, deferred, timer, attempts = 1, must_reconnect = true;
 	var heartbeat_interval = null, missed_heartbeats = 0;
+	var last_seq = null, seq_regex = /^\{"seq":(\d+),("type":"gap")?/;
+	// the facilities opened on a multiplexed websocket, each with the last sequence number received
+	var facilities = {}, facility_regex = /,"facility":"([^"]*)"\}$/;
+	var COMPACT_PROTOCOL = 'ws4redis.compact.v1';
+	// browsers hide the response to a refused handshake, its Retry-After is also set as this cookie
+	var retry_cookie_regex = /(?:^|;\s*)ws4redis_retry_after=(\d+)/;
+	// the map key tags of the compact protocol, a copy of ws4redis/compact.py KEYS
+	var COMPACT_KEYS = ['type', 'id', 'seq', 'author', 'name', 'img', 'content', 'raw', 'score', 'hotness',
+		'posts', 'status', 'username', 'author_id', 'pincode', 'ref', 'ok', 'error', 'vote',
+		'message', 'facility'];
 
 	if (this === undefined)
 		return new WS4Redis(options, $);
@@ -18,8 +39,10 @@ function WS4Redis(options, $) {
 		throw new Error('No Websocket URI in options');
 	if ($ === undefined)
 		$ = jQuery;
-	opts = $.extend({ heartbeat_msg: null }, options);
-	connect(opts.uri);
+	opts = $.extend({ heartbeat_msg: null, since: null, compact: false, multiplex: false, lazy: false }, options);
+	last_seq = opts.since;
+	if (!opts.lazy)
+		connect(resume_uri());
 
 	function connect(uri) {
 		try {
@@ -34,7 +57,12 @@ function WS4Redis(options, $) {
 			
 			console.log("Connecting to " + uri + " ...");
 			deferred = $.Deferred();
-			ws = new WebSocket(uri);
+			if (opts.compact && window.TextDecoder !== undefined) {
+				ws = new WebSocket(uri, [COMPACT_PROTOCOL]);
+				ws.binaryType = 'arraybuffer';
+			} else {
+				ws = new WebSocket(uri);
+			}
 			ws.onopen = on_open;
 			ws.onmessage = on_message;
 			ws.onerror = on_error;
@@ -50,14 +78,28 @@ function WS4Redis(options, $) {
 		if (must_reconnect && !timer) {
 			// try to reconnect
 			console.log('Reconnecting...');
-			var interval = generate_inteval(attempts);
+			var interval = retry_after();
+			if (interval === null)
+				interval = generate_inteval(attempts);
 			timer = setTimeout(function() {
 				attempts++;
-				connect(ws.url);
+				connect(resume_uri());
 			}, interval);
 		}
 	}
 	
+	// the milliseconds to wait as requested by the server, which already added jitter
+	function retry_after() {
+		var match = retry_cookie_regex.exec(document.cookie);
+		return match ? parseInt(match[1], 10) * 1000 : null;
+	}
+
+	function resume_uri() {
+		if (last_seq === null)
+			return opts.uri;
+		return opts.uri + (opts.uri.indexOf('?') < 0 ? '?' : '&') + 'since=' + last_seq;
+	}
+
 	function send_heartbeat() {
 		try {
 			missed_heartbeats++;
@@ -83,6 +125,8 @@ function WS4Redis(options, $) {
 			missed_heartbeats = 0;
 			heartbeat_interval = setInterval(send_heartbeat, 5000);
 		}
+		// (re-)open the facilities, resuming each from its last message
+		$.each(facilities, send_subscribe);
 		if ($.type(opts.connected) === 'function') {
 			opts.connected();
 		}
@@ -102,12 +146,116 @@ function WS4Redis(options, $) {
 	}
 
 	function on_message(evt) {
-		if (opts.heartbeat_msg && evt.data === opts.heartbeat_msg) {
-			// reset the counter for missed heartbeats
-			missed_heartbeats = 0;
-		} else if ($.type(opts.receive_message) === 'function') {
-			return opts.receive_message(evt.data);
+		// the server only sends heartbeats while it has nothing else to send,
+		// so any message resets the counter for missed heartbeats
+		missed_heartbeats = 0;
+		if (opts.heartbeat_msg && evt.data === opts.heartbeat_msg)
+			return;
+		var data = evt.data, seq = null, gap = false, facility = null, target = opts;
+		if (data instanceof ArrayBuffer) {
+			data = decode_compact(data);
+			if (data.seq !== undefined) {
+				seq = data.seq;
+				gap = data.type === 'gap';
+			}
+			facility = data.facility;
+		} else {
+			var match = seq_regex.exec(data);
+			if (match) {
+				seq = parseInt(match[1], 10);
+				gap = !!match[2];
+			}
+			if (opts.multiplex && (match = facility_regex.exec(data)))
+				facility = match[1];
+		}
+		if (opts.multiplex) {
+			target = facilities[facility];
+			if (target === undefined)
+				return;
+			if (seq !== null) {
+				if (!gap && target.last_seq !== null && seq <= target.last_seq)
+					return;
+				target.last_seq = seq;
+			}
+		} else if (seq !== null) {
+			// replayed messages may also arrive live, a gap restarts the count
+			if (!gap && last_seq !== null && seq <= last_seq)
+				return;
+			last_seq = seq;
+		}
+		if ($.type(target.receive_message) === 'function') {
+			return target.receive_message(data);
+		}
+	}
+
+	function send_subscribe(facility, state) {
+		ws.send(JSON.stringify({
+			op: 'subscribe',
+			facility: facility,
+			channels: state.channels,
+			since: state.last_seq
+		}));
+	}
+
+	// decode a message of the compact protocol, which is MessagePack with tagged map keys
+	function decode_compact(buffer) {
+		var view = new DataView(buffer), bytes = new Uint8Array(buffer), offset = 0;
+		var utf8 = new TextDecoder('utf-8');
+
+		function uint(size) {
+			var value = size === 1 ? view.getUint8(offset) : size === 2 ? view.getUint16(offset) : view.getUint32(offset);
+			offset += size;
+			return value;
+		}
+
+		function read() {
+			var code = bytes[offset++], size, i, result, value;
+			if (code < 0x80)
+				return code;
+			if (code >= 0xe0)
+				return code - 0x100;
+			if (code <= 0x8f || code === 0xde || code === 0xdf) {
+				size = code <= 0x8f ? code & 0x0f : uint(code === 0xde ? 2 : 4);
+				result = {};
+				for (i = 0; i < size; i++) {
+					var key = read();
+					value = read();
+					result[typeof key === 'number' ? COMPACT_KEYS[key] : key] = value;
+				}
+				return result;
+			}
+			if (code <= 0x9f || code === 0xdc || code === 0xdd) {
+				size = code <= 0x9f ? code & 0x0f : uint(code === 0xdc ? 2 : 4);
+				result = [];
+				for (i = 0; i < size; i++)
+					result.push(read());
+				return result;
+			}
+			if (code <= 0xbf || (code >= 0xd9 && code <= 0xdb)) {
+				size = code <= 0xbf ? code & 0x1f : uint(1 << (code - 0xd9));
+				value = utf8.decode(bytes.subarray(offset, offset + size));
+				offset += size;
+				return value;
+			}
+			switch (code) {
+				case 0xc0: return null;
+				case 0xc2: return false;
+				case 0xc3: return true;
+				case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+				case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+				case 0xcc: return uint(1);
+				case 0xcd: return uint(2);
+				case 0xce: return uint(4);
+				case 0xcf: value = view.getUint32(offset) * 4294967296 + view.getUint32(offset + 4); offset += 8; return value;
+				case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+				case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+				case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+				case 0xd3: value = view.getInt32(offset) * 4294967296 + view.getUint32(offset + 4); offset += 8; return value;
+			}
+			throw new Error('Unsupported type ' + code);
 		}
+
+		return read();
 	}
 
 	// this code is borrowed from http://blog.johnryding.com/post/78544969349/
@@ -130,9 +278,30 @@ function WS4Redis(options, $) {
 	this.send_message = function(message) {
 		ws.send(message);
 	};
+
+	this.subscribe = function(facility, options) {
+		var state = $.extend({ channels: ['subscribe-broadcast'], since: null, receive_message: null }, options);
+		state.last_seq = state.since;
+		facilities[facility] = state;
+		if (!ws)
+			connect(resume_uri());
+		else if (is_connected())
+			send_subscribe(facility, state);
+		return {
+			send_message: function(message) {
+				ws.send(JSON.stringify({ op: 'send', facility: facility, message: message }));
+			},
+			unsubscribe: function() {
+				delete facilities[facility];
+				if (is_connected())
+					ws.send(JSON.stringify({ op: 'unsubscribe', facility: facility }));
+			},
+			is_connected: is_connected
+		};
+	};
 	
 	this.get_state = function() {
-		return ws.readyState;	
+		return ws ? ws.readyState : WebSocket.CLOSED;
 	};
 	
 	function is_connecting() {
@@ -155,7 +324,7 @@ function WS4Redis(options, $) {
 	this.close = function () {
 		clearInterval(heartbeat_interval);
 		must_reconnect = false;
-		if (!is_closing() || !is_closed()) {
+		if (ws && (!is_closing() || !is_closed())) {
 			ws.close();
 		}
 	}
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for the websockets of a process, configured by ``WS4REDIS_ADMISSION``. Each open
+websocket holds a worker (or a slot of the hub), subscriptions and a session, so that after a
+deploy a storm of reconnecting clients is better turned away early with a hint when to come back.
+"""
+import math
+import random
+import threading
+from collections import Counter
+from django import http
+from ws4redis import settings, stats
+from ws4redis.exceptions import ServiceUnavailableError
+from ws4redis.timers import clock
+
+# the cookie carrying the Retry-After hint to ws4redis.js, which can't read refused handshakes
+RETRY_COOKIE = 'ws4redis_retry_after'
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` events per second on average, and bursts of up to ``burst`` events.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = clock()
+
+    def take(self, now=None):
+        """
+        Take a token if one is available, returns whether it was.
+        """
+        if now is None:
+            now = clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class Admission(object):
+    """
+    Counts the websockets open in this process, overall and per user, and refuses handshakes
+    beyond the limits by raising ``ServiceUnavailableError``.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = settings.WS4REDIS_ADMISSION if limits is None else limits
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._users = Counter()
+        rate = self.limits['handshake_rate']
+        self._bucket = rate and TokenBucket(rate, self.limits['handshake_burst'] or rate)
+
+    def get_retry_after(self):
+        """
+        Return the seconds a refused client shall wait, jittered to spread its retries.
+        """
+        retry_after = self.limits['retry_after']
+        return int(math.ceil(retry_after * (1 + random.random() * self.limits['retry_jitter'])))
+
+    def refuse(self, reason):
+        stats.incr('handshakes.rejected')
+        stats.incr('handshakes.rejected.' + reason)
+        raise ServiceUnavailableError('Handshake refused: {0}'.format(reason), self.get_retry_after())
+
+    def check_handshake(self):
+        """
+        Called for each handshake before the client is authenticated. Refuses it if handshakes
+        arrive too fast, or the process is full anyway.
+        """
+        with self._lock:
+            if self._bucket and not self._bucket.take():
+                self.refuse('rate')
+            max_connections = self.limits['max_connections']
+            if max_connections is not None and self._connections >= max_connections:
+                self.refuse('process')
+
+    def enter(self, request):
+        """
+        Count a websocket of the authenticated ``request`` as open, unless a limit refuses it.
+        Returns the ticket to pass to ``leave`` once the websocket has been closed.
+        """
+        user = getattr(request, 'user', None)
+        user_id = user.pk if user and user.is_authenticated() else None
+        with self._lock:
+            max_connections = self.limits['max_connections']
+            if max_connections is not None and self._connections >= max_connections:
+                self.refuse('process')
+            max_per_user = self.limits['max_per_user']
+            if user_id is not None and max_per_user is not None and self._users[user_id] >= max_per_user:
+                self.refuse('user')
+            self._connections += 1
+            if user_id is not None:
+                self._users[user_id] += 1
+        return (user_id,)
+
+    def leave(self, ticket):
+        if ticket is None:
+            return
+        user_id = ticket[0]
+        with self._lock:
+            self._connections -= 1
+            if user_id is not None:
+                self._users[user_id] -= 1
+                if self._users[user_id] <= 0:
+                    del self._users[user_id]
+
+
+def get_refusal_response(excpt):
+    """
+    Return the ``503`` response to a handshake refused with ``ServiceUnavailableError``.
+    """
+    response = http.HttpResponse(status=503, content=str(excpt))
+    response['Retry-After'] = str(excpt.retry_after)
+    # set as a header, the servers send only these with a refused handshake
+    response['Set-Cookie'] = '{0}={1}; Max-Age={1}; Path=/'.format(RETRY_COOKIE, excpt.retry_after)
+    return response
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+A compact binary encoding of JSON messages, negotiated as the websocket subprotocol
+``ws4redis.compact.v1``. Messages are encoded as MessagePack, with the map keys listed in ``KEYS``
+replaced by their index, so that keys repeated on every event cost a single byte.
+"""
+import json
+import struct
+from functools import lru_cache
+
+PROTOCOL = 'ws4redis.compact.v1'
+
+# the index of a key is its tag on the wire, append only, static/js/ws4redis.js has a copy
+KEYS = ('type', 'id', 'seq', 'author', 'name', 'img', 'content', 'raw', 'score', 'hotness',
+        'posts', 'status', 'username', 'author_id', 'pincode', 'ref', 'ok', 'error', 'vote',
+        'message', 'facility')
+TAGS = dict((key, tag) for tag, key in enumerate(KEYS))
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -0x20 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj <= 0xff:
+            out += struct.pack('>BB', 0xcc, obj)
+        elif 0 <= obj <= 0xffff:
+            out += struct.pack('>BH', 0xcd, obj)
+        elif 0 <= obj <= 0xffffffff:
+            out += struct.pack('>BI', 0xce, obj)
+        elif -0x80000000 <= obj < 0:
+            out += struct.pack('>Bi', 0xd2, obj)
+        elif 0 <= obj <= 0xffffffffffffffff:
+            out += struct.pack('>BQ', 0xcf, obj)
+        else:
+            out += struct.pack('>Bq', 0xd3, obj)
+    elif isinstance(obj, float):
+        out += struct.pack('>Bd', 0xcb, obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        size = len(data)
+        if size < 0x20:
+            out.append(0xa0 | size)
+        elif size <= 0xff:
+            out += struct.pack('>BB', 0xd9, size)
+        elif size <= 0xffff:
+            out += struct.pack('>BH', 0xda, size)
+        else:
+            out += struct.pack('>BI', 0xdb, size)
+        out += data
+    elif isinstance(obj, (list, tuple)):
+        size = len(obj)
+        if size < 0x10:
+            out.append(0x90 | size)
+        elif size <= 0xffff:
+            out += struct.pack('>BH', 0xdc, size)
+        else:
+            out += struct.pack('>BI', 0xdd, size)
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        size = len(obj)
+        if size < 0x10:
+            out.append(0x80 | size)
+        elif size <= 0xffff:
+            out += struct.pack('>BH', 0xde, size)
+        else:
+            out += struct.pack('>BI', 0xdf, size)
+        for key, value in obj.items():
+            tag = TAGS.get(key)
+            if tag is None:
+                _pack(key, out)
+            else:
+                out.append(tag)
+            _pack(value, out)
+    else:
+        raise TypeError('Cannot encode {0!r}'.format(obj))
+
+
+def pack(obj):
+    """
+    Encode a JSON compatible object.
+    """
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _unpack(data, offset):
+    code = data[offset]
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    if code >= 0xe0:
+        return code - 0x100, offset
+    if code <= 0x8f or code in (0xde, 0xdf):
+        if code <= 0x8f:
+            size = code & 0x0f
+        else:
+            fmt = '>H' if code == 0xde else '>I'
+            size = struct.unpack_from(fmt, data, offset)[0]
+            offset += struct.calcsize(fmt)
+        result = {}
+        for _ in range(size):
+            key, offset = _unpack(data, offset)
+            if isinstance(key, int):
+                key = KEYS[key]
+            result[key], offset = _unpack(data, offset)
+        return result, offset
+    if code <= 0x9f or code in (0xdc, 0xdd):
+        if code <= 0x9f:
+            size = code & 0x0f
+        else:
+            fmt = '>H' if code == 0xdc else '>I'
+            size = struct.unpack_from(fmt, data, offset)[0]
+            offset += struct.calcsize(fmt)
+        result = []
+        for _ in range(size):
+            item, offset = _unpack(data, offset)
+            result.append(item)
+        return result, offset
+    if code <= 0xbf or code in (0xd9, 0xda, 0xdb):
+        if code <= 0xbf:
+            size = code & 0x1f
+        else:
+            fmt = {0xd9: '>B', 0xda: '>H', 0xdb: '>I'}[code]
+            size = struct.unpack_from(fmt, data, offset)[0]
+            offset += struct.calcsize(fmt)
+        return bytes(data[offset:offset + size]).decode('utf-8'), offset + size
+    if code == 0xc0:
+        return None, offset
+    if code in (0xc2, 0xc3):
+        return code == 0xc3, offset
+    fmt = {0xca: '>f', 0xcb: '>d', 0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+           0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q'}.get(code)
+    if fmt is None:
+        raise ValueError('Unsupported type 0x{0:02x}'.format(code))
+    return struct.unpack_from(fmt, data, offset)[0], offset + struct.calcsize(fmt)
+
+
+def unpack(data):
+    """
+    Decode a message encoded by ``pack``.
+    """
+    obj, offset = _unpack(data, 0)
+    if offset != len(data):
+        raise ValueError('Extra data after message')
+    return obj
+
+
+@lru_cache(maxsize=256)
+def encode_message(message):
+    """
+    Encode a message received from Redis, which is a JSON object, for a websocket which
+    negotiated the compact protocol. Returns None for anything else, which is then sent as is.
+    Each published message is encoded once for all websockets of a process.
+    """
+    if message[:1] not in (b'{', '{'):
+        return None
+    try:
+        obj = json.loads(message if isinstance(message, str) else message.decode('utf-8'))
+    except ValueError:
+        return None
+    if not isinstance(obj, dict):
+        return None
+    return pack(obj)
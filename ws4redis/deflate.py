@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+The permessage-deflate extension of RFC 7692.
+"""
+import zlib
+from ws4redis.exceptions import WebSocketError, FrameTooLargeException
+
+# every message compressed with Z_SYNC_FLUSH ends with an empty stored block, which is stripped
+# off on the wire and appended again before inflating
+TAIL = b'\x00\x00\xff\xff'
+
+
+def parse_extensions(header):
+    """
+    Parse a ``Sec-WebSocket-Extensions`` header into a list of ``(name, params)`` tuples,
+    where ``params`` is a list of ``(name, value)`` tuples and value is None if not given.
+    """
+    extensions = []
+    for offer in header.split(','):
+        parts = [part.strip() for part in offer.split(';')]
+        if not parts[0]:
+            continue
+        params = []
+        for param in parts[1:]:
+            name, sep, value = param.partition('=')
+            value = value.strip().strip('"') if sep else None
+            params.append((name.strip().lower(), value))
+        extensions.append((parts[0].lower(), params))
+    return extensions
+
+
+class PerMessageDeflate(object):
+    """
+    The negotiated state of permessage-deflate on one websocket: a compressor for the messages
+    sent to the client and a decompressor for those received from it.
+    """
+    __slots__ = ('server_no_context_takeover', 'client_no_context_takeover', 'server_max_window_bits',
+                 'client_max_window_bits', 'mem_level', 'min_size', 'max_message_size', 'response',
+                 '_compressor', '_decompressor')
+
+    NAME = 'permessage-deflate'
+    # RSV1 of RFC 6455, set on the first frame of a compressed message
+    COMPRESSED_MASK = 0x40
+
+    def __init__(self, server_no_context_takeover=False, client_no_context_takeover=False,
+                 server_max_window_bits=15, client_max_window_bits=15, mem_level=8, min_size=0,
+                 max_message_size=1 << 20, response=''):
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.mem_level = mem_level
+        self.min_size = min_size
+        self.max_message_size = max_message_size
+        self.response = response
+        self._compressor = None
+        self._decompressor = None
+
+    @classmethod
+    def negotiate(cls, header, window_bits=15, context_takeover=True, mem_level=8, min_size=0,
+                  max_message_size=1 << 20):
+        """
+        Accept the first acceptable permessage-deflate offer in the client's
+        ``Sec-WebSocket-Extensions`` header. ``window_bits`` limits the LZ77 window in both
+        directions, and thus the memory held per connection. Returns None if there is nothing
+        acceptable on offer, otherwise a ``PerMessageDeflate`` whose ``response`` is the value
+        of the ``Sec-WebSocket-Extensions`` header to answer with.
+        """
+        window_bits = max(9, min(15, window_bits))
+        for name, params in parse_extensions(header or ''):
+            if name != cls.NAME:
+                continue
+            offer = dict(params)
+            if len(offer) != len(params) or not set(offer).issubset((
+                    'server_no_context_takeover', 'client_no_context_takeover',
+                    'server_max_window_bits', 'client_max_window_bits')):
+                continue
+            try:
+                server_bits = cls._window_bits(offer, 'server_max_window_bits', window_bits)
+                client_bits = cls._window_bits(offer, 'client_max_window_bits', window_bits)
+            except ValueError:
+                continue
+            if server_bits < 9:
+                # zlib can't deflate with a window of 256 bytes
+                continue
+            response = [cls.NAME]
+            server_no_context_takeover = 'server_no_context_takeover' in offer or not context_takeover
+            if server_no_context_takeover:
+                response.append('server_no_context_takeover')
+            client_no_context_takeover = 'client_no_context_takeover' in offer
+            if client_no_context_takeover:
+                response.append('client_no_context_takeover')
+            if 'server_max_window_bits' in offer:
+                response.append('server_max_window_bits={0}'.format(server_bits))
+            if 'client_max_window_bits' in offer:
+                response.append('client_max_window_bits={0}'.format(client_bits))
+            else:
+                # the client didn't agree to limit its window
+                client_bits = 15
+            return cls(server_no_context_takeover, client_no_context_takeover, server_bits,
+                       max(9, client_bits), mem_level, min_size, max_message_size,
+                       '; '.join(response))
+        return None
+
+    @staticmethod
+    def _window_bits(offer, param, limit):
+        if param not in offer:
+            return limit
+        if offer[param] is None:
+            if param == 'server_max_window_bits':
+                raise ValueError('server_max_window_bits requires a value')
+            return limit
+        if not offer[param].isdigit() or not 8 <= int(offer[param]) <= 15:
+            raise ValueError('Invalid {0}: {1}'.format(param, offer[param]))
+        return min(limit, int(offer[param]))
+
+    def compress(self, payload):
+        """
+        Deflate the payload of an outgoing message. Returns None if it is not worth compressing.
+        """
+        if len(payload) < self.min_size:
+            return None
+        if self._compressor is None or self.server_no_context_takeover:
+            self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                                -self.server_max_window_bits, self.mem_level)
+        data = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-4] if data.endswith(TAIL) else data
+
+    def decompress(self, payload):
+        """
+        Inflate the payload of an incoming compressed message.
+        """
+        if self._decompressor is None or self.client_no_context_takeover:
+            self._decompressor = zlib.decompressobj(-self.client_max_window_bits)
+        try:
+            data = self._decompressor.decompress(bytes(payload) + TAIL, self.max_message_size)
+        except zlib.error as excpt:
+            raise WebSocketError('Invalid compressed message: {0}'.format(excpt))
+        if self._decompressor.unconsumed_tail:
+            raise FrameTooLargeException('Decompressed message exceeds {0} bytes'.format(self.max_message_size))
+        return data
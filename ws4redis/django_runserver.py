@@ -11,6 +11,8 @@ from django.conf import settings
 from django.core.management.commands import runserver
 from django.utils.six.moves import socketserver
 from django.utils.encoding import force_str
+from ws4redis import compact, settings as private_settings
+from ws4redis.deflate import PerMessageDeflate
 from ws4redis.websocket import WebSocket
 from ws4redis.wsgi_server import WebsocketWSGIServer, HandshakeError, UpgradeRequiredError
 
@@ -21,9 +23,10 @@ class WebsocketRunServer(WebsocketWSGIServer):
     WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
     WS_VERSIONS = ('13', '8', '7')
 
-    def upgrade_websocket(self, environ, start_response):
+    def get_handshake_headers(self, environ):
         """
-        Attempt to upgrade the socket environ['wsgi.input'] into a websocket enabled connection.
+        Validate the client's handshake and return the headers of the ``101 Switching Protocols``
+        response.
         """
         websocket_version = environ.get('HTTP_SEC_WEBSOCKET_VERSION', '')
         if not websocket_version:
@@ -51,12 +54,47 @@ class WebsocketRunServer(WebsocketWSGIServer):
             ('Sec-WebSocket-Accept', sec_ws_accept),
             ('Sec-WebSocket-Version', str(websocket_version))
         ]
-        if environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL') is not None:
-            headers.append(('Sec-WebSocket-Protocol', environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL')))
+        return headers
+
+    def negotiate_protocol(self, environ, headers):
+        """
+        Select the subprotocol among those offered by the client, preferring the compact
+        encoding, by adding it to the response ``headers``. Returns the encoder for messages
+        sent in the selected subprotocol, or None to send them as they are.
+        """
+        offered = [protocol.strip() for protocol in environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL', '').split(',')]
+        offered = [protocol for protocol in offered if protocol]
+        if not offered:
+            return None
+        if private_settings.WS4REDIS_COMPACT_PROTOCOL and compact.PROTOCOL in offered:
+            headers.append(('Sec-WebSocket-Protocol', compact.PROTOCOL))
+            return compact.encode_message
+        headers.append(('Sec-WebSocket-Protocol', offered[0]))
+        return None
+
+    def negotiate_deflate(self, environ, headers):
+        """
+        Accept permessage-deflate if the client offers it, by adding the extension to the
+        response ``headers``. Returns the negotiated ``PerMessageDeflate`` or None.
+        """
+        if not private_settings.WS4REDIS_PERMESSAGE_DEFLATE:
+            return None
+        deflate = PerMessageDeflate.negotiate(environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS'),
+                                              **private_settings.WS4REDIS_PERMESSAGE_DEFLATE_OPTIONS)
+        if deflate is not None:
+            headers.append(('Sec-WebSocket-Extensions', deflate.response))
+        return deflate
 
+    def upgrade_websocket(self, environ, start_response):
+        """
+        Attempt to upgrade the socket environ['wsgi.input'] into a websocket enabled connection.
+        """
+        headers = self.get_handshake_headers(environ)
+        deflate = self.negotiate_deflate(environ, headers)
+        encoder = self.negotiate_protocol(environ, headers)
         start_response(force_str('101 Switching Protocols'), headers)
         six.get_method_self(start_response).finish_content()
-        return WebSocket(environ['wsgi.input'])
+        return WebSocket(environ['wsgi.input'], deflate, encoder)
 
     def select(self, rlist, wlist, xlist, timeout=None):
         return select.select(rlist, wlist, xlist, timeout)
@@ -25,3 +25,13 @@ class UpgradeRequiredError(HandshakeError):
     """
     Raised if protocol must be upgraded.
     """
+
+
+class ServiceUnavailableError(HandshakeError):
+    """
+    Raised if a handshake is refused to shed load. The client shall retry after ``retry_after``
+    seconds.
+    """
+    def __init__(self, message, retry_after):
+        super(ServiceUnavailableError, self).__init__(message)
+        self.retry_after = retry_after
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+import sys
+import socket
+import functools
+import selectors
+from collections import defaultdict
+from urllib.parse import unquote_to_bytes
+from redis.exceptions import ConnectionError
+from six.moves import http_client
+from django import http
+from django.core.exceptions import PermissionDenied
+from django.utils.encoding import force_str
+from ws4redis import stats
+from ws4redis.django_runserver import WebsocketRunServer
+from ws4redis.admission import get_refusal_response
+from ws4redis.exceptions import HandshakeError, UpgradeRequiredError, ServiceUnavailableError
+from ws4redis.multiplex import MULTIPLEX_FACILITY, Multiplex
+from ws4redis.redis_store import RedisMessage
+from ws4redis.sharding import ShardedPubSub, get_shards
+from ws4redis.timers import TimerQueue, clock
+from ws4redis.websocket import WebSocket
+
+import logging
+
+logger = logging.getLogger("django")
+
+
+class HubConnection(object):
+    """
+    The state of a single websocket served by the hub.
+    """
+    __slots__ = ('sock', 'fd', 'websocket', 'request', 'subscriber', 'name', 'channels',
+                 'echo_message', 'recvmsg', 'writing', 'multiplex', 'ticket')
+
+    def __init__(self, sock, websocket, request, subscriber, name, channels, echo_message):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.websocket = websocket
+        self.request = request
+        self.subscriber = subscriber
+        self.name = name
+        self.channels = channels
+        self.echo_message = echo_message
+        self.recvmsg = None
+        self.writing = False
+        self.multiplex = None
+        self.ticket = None
+
+
+class WebsocketHub(WebsocketRunServer):
+    """
+    Event driven websocket server. Instead of pinning one worker per open websocket, a single
+    selector loop multiplexes all websockets of this process, shares one Redis pubsub connection
+    per node between them and fans out each published message in memory to the local subscribers.
+
+    Everything runs on the thread of the loop, including ``on_receive``: while a command sent over a
+    websocket writes to the database and publishes, no other websocket of the process is read or
+    written. Commands must stay short, ``benchmarks/ws_loadtest.py --driver command`` measures what
+    they cost the fan-out.
+    """
+    MAX_HANDSHAKE_SIZE = 8192
+    SOCKET_TIMEOUT = 1.0
+    STATS_INTERVAL = 10.0
+
+    def __init__(self, address, redis_connection=None):
+        super(WebsocketHub, self).__init__(redis_connection)
+        self.address = address
+        self._selector = selectors.DefaultSelector()
+        self._handshakes = {}
+        self._connections = {}
+        self._listeners = defaultdict(set)
+        self._pubsub = None
+        # the sockets of the pubsub connections registered with the selector
+        self._pubsub_socks = {}
+        # when each websocket is to be kept alive next
+        self._timers = TimerQueue()
+
+    def serve_forever(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.listen(1024)
+        listener.setblocking(False)
+        self._selector.register(listener, selectors.EVENT_READ, self._accept)
+        self._pubsub = ShardedPubSub(self._redis_connection, get_shards())
+        self._pubsub.default.subscribe(self.Subscriber.expired_channel)
+        self._watch_pubsub(self._pubsub.default)
+        logger.info('Websocket hub listening on {0}:{1}'.format(*self.address))
+        while True:
+            timeout = self._timers.timeout()
+            if timeout is None or timeout > self.STATS_INTERVAL:
+                timeout = self.STATS_INTERVAL
+            self._handle_events(self._selector.select(timeout))
+            now = clock()
+            for conn in self._timers.expired(now):
+                # the entry of a closed websocket is dropped once it expires
+                if self._connections.get(conn.fd) is conn:
+                    self._keep_alive(conn, now)
+            stats.flush(self._redis_connection, self.STATS_INTERVAL)
+
+    def _handle_events(self, ready):
+        """
+        Handle a batch of sockets returned by the selector. A websocket closed while handling an
+        earlier socket of the batch is skipped, and so is a new one which got its descriptor.
+        """
+        for key, events in ready:
+            if events & selectors.EVENT_WRITE:
+                conn = self._connections.get(key.fd)
+                if conn is None or conn.sock is not key.fileobj:
+                    continue
+                self._flush(conn)
+                if self._connections.get(key.fd) is not conn:
+                    continue
+            if events & selectors.EVENT_READ:
+                key.data(key.fileobj)
+
+    def upgrade_websocket(self, environ, start_response):
+        """
+        Upgrade the raw client socket environ['wsgi.input'] into a websocket enabled connection.
+        """
+        headers = self.get_handshake_headers(environ)
+        deflate = self.negotiate_deflate(environ, headers)
+        encoder = self.negotiate_protocol(environ, headers)
+        start_response(force_str('101 Switching Protocols'), headers)
+        return WebSocket(environ['wsgi.input'], deflate, encoder)
+
+    def get_environ(self, sock, data, client_address):
+        """
+        Build a WSGI environment from the raw HTTP request head sent by the client.
+        """
+        lines = data.split(b'\r\n\r\n', 1)[0].decode('iso-8859-1').split('\r\n')
+        try:
+            method, target, protocol = lines[0].split(' ', 2)
+        except ValueError:
+            raise HandshakeError('Malformed request line: {0}'.format(lines[0]))
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(path).decode('iso-8859-1'),
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': protocol,
+            'SERVER_NAME': self.address[0],
+            'SERVER_PORT': str(self.address[1]),
+            'REMOTE_ADDR': client_address[0],
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': sock,
+        }
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                environ[name] += ',' + value.strip()
+            else:
+                environ[name] = value.strip()
+        return environ
+
+    def _accept(self, listener):
+        try:
+            sock, client_address = listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        self._handshakes[sock] = (client_address, b'')
+        self._selector.register(sock, selectors.EVENT_READ, self._read_handshake)
+
+    def _read_handshake(self, sock):
+        if sock not in self._handshakes:
+            # closed while handling an earlier socket of the batch
+            return
+        client_address, data = self._handshakes[sock]
+        try:
+            chunk = sock.recv(4096)
+        except BlockingIOError:
+            return
+        except socket.error:
+            chunk = b''
+        data += chunk
+        if chunk and b'\r\n\r\n' not in data and len(data) < self.MAX_HANDSHAKE_SIZE:
+            self._handshakes[sock] = (client_address, data)
+            return
+        del self._handshakes[sock]
+        self._selector.unregister(sock)
+        if not chunk or b'\r\n\r\n' not in data:
+            sock.close()
+            return
+        # the response to the handshake is written with a blocking call, bounded by a short timeout
+        sock.settimeout(self.SOCKET_TIMEOUT)
+        self._open(sock, data, client_address)
+
+    def _open(self, sock, data, client_address):
+        request = None
+        ticket = None
+        subscriber = self.Subscriber(self._redis_connection)
+        try:
+            environ = self.get_environ(sock, data, client_address)
+            request, channels, echo_message = self.prepare_request(environ)
+            ticket = self.admission.enter(request)
+            websocket = self.upgrade_websocket(environ, self._start_response(sock))
+        except UpgradeRequiredError as excpt:
+            logger.info('Websocket upgrade required')
+            response = http.HttpResponseBadRequest(status=426, content=excpt)
+        except ServiceUnavailableError as excpt:
+            logger.info('{0}, retry after {1}s'.format(excpt, excpt.retry_after))
+            response = get_refusal_response(excpt)
+        except HandshakeError as excpt:
+            logger.warning('HandshakeError: {}'.format(excpt), exc_info=sys.exc_info())
+            response = http.HttpResponseBadRequest(content=excpt)
+        except PermissionDenied as excpt:
+            logger.warning('PermissionDenied: {}'.format(excpt), exc_info=sys.exc_info())
+            response = http.HttpResponseForbidden(content=excpt)
+        except Exception as excpt:
+            logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
+            response = http.HttpResponseServerError(content=excpt)
+        else:
+            name = request.path.split('/')[-1]
+            channels = subscriber.set_channels(request, channels)
+            # frames are read as they arrive and written as the socket takes them
+            sock.setblocking(False)
+            conn = HubConnection(sock, websocket, request, subscriber, name, channels, echo_message)
+            conn.ticket = ticket
+            if name == MULTIPLEX_FACILITY:
+                conn.multiplex = Multiplex(subscriber, lambda keys: self._subscribe_keys(conn, keys),
+                                           lambda keys: self._unsubscribe_keys(conn, keys))
+            self._connections[conn.fd] = conn
+            self._selector.register(sock, selectors.EVENT_READ, self._receive)
+            self._timers.schedule(self.keep_alive(websocket, clock()), conn)
+            for channel in channels:
+                self._subscribe(channel, conn)
+            try:
+                self.on_open(request, subscriber, name)
+                for message in self.get_missed_messages(request, subscriber):
+                    self._send(conn, message)
+            except Exception as excpt:
+                logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
+                self._close(conn)
+            return
+        self.admission.leave(ticket)
+        self.on_close(request, subscriber)
+        self._refuse(sock, response)
+
+    def _start_response(self, sock):
+        def start_response(status, headers):
+            lines = ['HTTP/1.1 {0}'.format(status)]
+            lines.extend('{0}: {1}'.format(k, v) for k, v in headers)
+            sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1'))
+        return start_response
+
+    def _refuse(self, sock, response):
+        status_text = http_client.responses.get(response.status_code, 'UNKNOWN STATUS CODE')
+        headers = list(response._headers.values())
+        headers.extend([('Content-Length', str(len(response.content))), ('Connection', 'close')])
+        try:
+            self._start_response(sock)('{0} {1}'.format(response.status_code, status_text), headers)
+            sock.sendall(response.content)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+    def _receive(self, sock):
+        conn = self._connections.get(sock.fileno())
+        if conn is None or conn.sock is not sock:
+            # closed while handling an earlier socket of the batch
+            return
+        # handle every complete message received, until the socket would block
+        while conn.fd in self._connections:
+            try:
+                recv = conn.websocket.receive()
+            except BlockingIOError:
+                return
+            except socket.error as excpt:
+                logger.info('WebSocketError: {}'.format(excpt))
+                self._close(conn)
+                return
+            if conn.websocket.closed:
+                self._close(conn)
+                return
+            if conn.multiplex is not None:
+                self._receive_multiplexed(conn, recv)
+                continue
+            try:
+                reply = self.on_receive(conn.request, conn.subscriber, conn.name, recv)
+            except Exception as excpt:
+                logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
+                reply = None
+            if reply:
+                self._send(conn, reply)
+                continue
+            conn.recvmsg = RedisMessage(recv)
+            if conn.recvmsg:
+                conn.subscriber.publish_message(conn.recvmsg)
+
+    def _receive_multiplexed(self, conn, recv):
+        try:
+            messages = self.on_multiplex(conn.request, conn.multiplex, recv)
+        except Exception as excpt:
+            logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
+            return
+        for message in messages:
+            self._send(conn, message)
+
+    def _send(self, conn, message):
+        try:
+            conn.websocket.send(message)
+        except socket.error:
+            self._close(conn)
+            return
+        self._watch_outbox(conn)
+
+    def _watch_outbox(self, conn):
+        if conn.websocket.outbox_size and not conn.writing:
+            # a slow client, write the rest once its socket takes more
+            conn.writing = True
+            self._selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self._receive)
+
+    def _flush(self, conn):
+        try:
+            conn.websocket.flush()
+        except socket.error:
+            self._close(conn)
+            return
+        if not conn.websocket.outbox_size:
+            conn.writing = False
+            self._selector.modify(conn.sock, selectors.EVENT_READ, self._receive)
+
+    def _close(self, conn):
+        if self._connections.pop(conn.fd, None) is None:
+            return
+        self._selector.unregister(conn.sock)
+        for channel in conn.channels:
+            self._unsubscribe(channel, conn)
+        for request, name in self.get_facilities(conn.request, conn.name, conn.multiplex):
+            try:
+                self.on_close(request, conn.subscriber, name)
+            except Exception as excpt:
+                logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
+        self.admission.leave(conn.ticket)
+        if not conn.websocket.closed:
+            conn.websocket.close(code=1001, message='Websocket Closed')
+        conn.sock.close()
+
+    def _subscribe_keys(self, conn, keys):
+        conn.channels = conn.channels + list(keys)
+        for channel in keys:
+            self._subscribe(channel, conn)
+
+    def _unsubscribe_keys(self, conn, keys):
+        conn.channels = [channel for channel in conn.channels if channel not in keys]
+        for channel in keys:
+            self._unsubscribe(channel, conn)
+
+    def _subscribe(self, channel, conn):
+        listeners = self._listeners[channel]
+        if not listeners:
+            pubsub = self._pubsub.subscribe(channel)
+            if pubsub not in self._pubsub_socks:
+                self._watch_pubsub(pubsub)
+        listeners.add(conn)
+
+    def _unsubscribe(self, channel, conn):
+        listeners = self._listeners.get(channel)
+        if listeners is None:
+            return
+        listeners.discard(conn)
+        if not listeners:
+            del self._listeners[channel]
+            self._pubsub.unsubscribe(channel)
+
+    def _watch_pubsub(self, pubsub):
+        """
+        (Re-)register the socket of a shared pubsub connection with the selector.
+        """
+        sock = self._pubsub_socks.pop(pubsub, None)
+        if sock is not None:
+            self._selector.unregister(sock)
+        if pubsub.connection._sock is None:
+            # reconnecting also resubscribes all channels
+            pubsub.connection.connect()
+        sock = self._pubsub_socks[pubsub] = pubsub.connection._sock
+        self._selector.register(sock, selectors.EVENT_READ, functools.partial(self._dispatch, pubsub))
+
+    def _dispatch(self, pubsub, sock):
+        """
+        Drain all pending messages from a shared pubsub connection and fan them out to the
+        websockets subscribed to their channel.
+        """
+        while True:
+            try:
+                message = pubsub.get_message()
+            except ConnectionError as excpt:
+                logger.warning('Lost connection to Redis: {}'.format(excpt))
+                pubsub.connection.disconnect()
+                self._watch_pubsub(pubsub)
+                return
+            if message is None:
+                return
+            if message['type'] != 'message':
+                continue
+            channel = message['channel']
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            if channel == self.Subscriber.expired_channel:
+                names = set()
+                for conn in self._connections.values():
+                    names.update(name for request, name in self.get_facilities(None, conn.name, conn.multiplex))
+                for name in names:
+                    self.on_expired(message['data'], name)
+                continue
+            sendmsg = RedisMessage(message['data'])
+            if not sendmsg:
+                continue
+            for conn in list(self._listeners.get(channel, ())):
+                if conn.multiplex is not None:
+                    tagged = conn.multiplex.deliver(channel, sendmsg)
+                    if tagged:
+                        self._send(conn, tagged)
+                elif conn.echo_message or sendmsg != conn.recvmsg:
+                    self._send(conn, sendmsg)
+
+    def _keep_alive(self, conn, now):
+        try:
+            deadline = self.keep_alive(conn.websocket, now)
+        except socket.error:
+            deadline = None
+        if deadline is None:
+            self._close(conn)
+            return
+        self._watch_outbox(conn)
+        self._timers.schedule(deadline, conn)
+        for request, name in self.get_facilities(conn.request, conn.name, conn.multiplex):
+            try:
+                self.on_heartbeat(request, conn.subscriber, name)
+            except Exception as excpt:
+                logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
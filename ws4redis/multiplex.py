@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Many facilities on one websocket. A client connecting to ``<WEBSOCKET_URL>multiplex`` opens and
+closes facilities with control messages, instead of opening a websocket for each of them:
+
+    {"op": "subscribe", "facility": "room_1", "channels": ["subscribe-broadcast"], "since": 12}
+    {"op": "unsubscribe", "facility": "room_1"}
+    {"op": "send", "facility": "room_1", "message": "..."}
+
+Each facility is authorized and opened as if it had its own websocket. Messages sent to the client
+are tagged with the facility they belong to: JSON objects get ``facility`` as their last member,
+anything else is wrapped as ``{"facility": ..., "message": ...}``.
+"""
+import copy
+import json
+import re
+from functools import lru_cache
+from django.http import QueryDict
+
+MULTIPLEX_FACILITY = 'multiplex'
+
+# facilities a single websocket may have open at once
+MAX_FACILITIES = 32
+
+_FACILITY_RE = re.compile(r'^[\w.-]{1,64}$')
+
+
+class Facility(object):
+    """
+    A facility opened on a multiplexed websocket.
+    """
+    __slots__ = ('name', 'request', 'channels', 'publishers', 'echo_message', 'recvmsg')
+
+    def __init__(self, name, request, channels, publishers, echo_message):
+        self.name = name
+        self.request = request
+        self.channels = channels
+        self.publishers = publishers
+        self.echo_message = echo_message
+        self.recvmsg = None
+
+
+class Multiplex(object):
+    """
+    The facilities open on a multiplexed websocket. ``subscribe`` and ``unsubscribe`` are called
+    with the channel keys of facilities as they are opened and closed.
+    """
+
+    def __init__(self, subscriber, subscribe, unsubscribe):
+        self.subscriber = subscriber
+        self.facilities = {}
+        self._channels = {}
+        self._subscribe = subscribe
+        self._unsubscribe = unsubscribe
+
+    def add(self, facility):
+        self.facilities[facility.name] = facility
+        for channel in facility.channels:
+            self._channels[channel] = facility
+        self._subscribe(facility.channels)
+
+    def remove(self, name):
+        facility = self.facilities.pop(name, None)
+        if facility is not None:
+            for channel in facility.channels:
+                self._channels.pop(channel, None)
+            self._unsubscribe(facility.channels)
+        return facility
+
+    def deliver(self, channel, message):
+        """
+        Return ``message`` received on ``channel`` tagged for the client, or None if it isn't
+        for the client.
+        """
+        facility = self._channels.get(channel)
+        if facility is None or (message == facility.recvmsg and not facility.echo_message):
+            return None
+        return tag_message(message, facility.name)
+
+
+def parse_control(message):
+    """
+    Return the control message received on a multiplexed websocket as a dict, or None if it
+    isn't a valid one.
+    """
+    if isinstance(message, bytes):
+        message = message.decode('utf-8')
+    if not message or message[:1] != '{':
+        return None
+    try:
+        control = json.loads(message)
+    except ValueError:
+        return None
+    if not isinstance(control, dict) or not _FACILITY_RE.match(str(control.get('facility', ''))):
+        return None
+    return control
+
+
+def get_facility_request(request, name, channels):
+    """
+    A copy of the request of a multiplexed websocket, as if it had been made to open a websocket on
+    facility ``name`` for ``channels``, for the checks and hooks which apply per facility.
+    """
+    facility_request = copy.copy(request)
+    facility_request.path = request.path.rsplit('/', 1)[0] + '/' + name
+    facility_request.path_info = request.path_info.rsplit('/', 1)[0] + '/' + name
+    facility_request.GET = QueryDict('&'.join(channels))
+    return facility_request
+
+
+@lru_cache(maxsize=256)
+def tag_message(message, facility):
+    """
+    Tag a message for the client of a multiplexed websocket with the ``facility`` it belongs to.
+    Each published message is tagged once for all websockets of a process.
+    """
+    if not isinstance(message, bytes):
+        message = message.encode('utf-8')
+    message = message.rstrip()
+    if message[:1] == b'{' and message[-1:] == b'}' and message[1:-1].strip():
+        return message[:-1] + b',"facility":' + json.dumps(facility).encode('utf-8') + b'}'
+    return json.dumps({'facility': facility, 'message': message.decode('utf-8')}).encode('utf-8')
@@ -1,4 +1,6 @@
 #-*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
 from redis import ConnectionPool, StrictRedis
 from ws4redis import settings
 from ws4redis.redis_store import RedisStore
@@ -9,6 +11,27 @@ redis_connection_pool = ConnectionPool(**settings.WS4REDIS_CONNECTION)
 
 logger = logging.getLogger("django")
 
+_buffer = threading.local()
+
+
+@contextmanager
+def buffered_publishing():
+    """
+    Buffer the messages published by RedisPublishers of this thread within the block and publish
+    them, in their order, with a single round trip once it ends. Nothing is published if the block
+    raises. Nested blocks publish along with the outermost one.
+    """
+    if getattr(_buffer, 'entries', None) is not None:
+        yield
+        return
+    _buffer.entries = []
+    try:
+        yield
+        entries = _buffer.entries
+    finally:
+        _buffer.entries = None
+    RedisStore(StrictRedis(connection_pool=redis_connection_pool))._publish(entries)
+
 
 class RedisPublisher(RedisStore):
     def __init__(self, **kwargs):
@@ -20,6 +43,13 @@ class RedisPublisher(RedisStore):
         for key in self._get_message_channels(**kwargs):
             self._publishers.add(key)
 
+    def _publish(self, entries):
+        buffered = getattr(_buffer, 'entries', None)
+        if buffered is None:
+            super(RedisPublisher, self)._publish(entries)
+        else:
+            buffered.extend(entries)
+
     def fetch_message(self, request, facility, audience='any'):
         """
         Fetch the first message available for the given ``facility`` and ``audience``, if it has
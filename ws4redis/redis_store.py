@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import six
 import warnings
+import time
+from collections import OrderedDict
 from ws4redis import settings
+from ws4redis.sharding import get_shards
 
 import logging
 
@@ -14,6 +17,107 @@ or as a group.
 """
 SELF = type('SELF_TYPE', (object,), {})()
 
+"""
+Number messages published on channels, append them to the channels' replay logs and publish them,
+atomically, so that subscribers receive the messages of a channel in the order of their sequence
+numbers. Each message has three keys, its channel, the channel's sequence number and replay log,
+and two arguments after the replay length, the message and its expiry. The sequence number is
+prepended to the message, which must be a JSON object.
+"""
+PUBLISH_SEQUENCED = '''
+local seqs = {}
+for i = 1, #KEYS / 3 do
+  local channel, log, expire = KEYS[3 * i - 2], KEYS[3 * i], tonumber(ARGV[2 * i + 1])
+  local seq = redis.call('INCR', KEYS[3 * i - 1])
+  local message = '{"seq":' .. seq .. ',' .. string.sub(ARGV[2 * i], 2)
+  redis.call('RPUSH', log, message)
+  redis.call('LTRIM', log, -tonumber(ARGV[1]), -1)
+  if expire > 0 then
+    redis.call('SETEX', channel, expire, message)
+    redis.call('EXPIRE', log, expire)
+  end
+  redis.call('PUBLISH', channel, message)
+  seqs[i] = seq
+end
+return seqs
+'''
+
+"""
+While rebalancing, copy messages numbered on the node a channel lives on to the node it lived on
+before, with their sequence numbers. Each message has the same three keys as for
+PUBLISH_SEQUENCED, and three arguments after the replay length, the numbered message, its sequence
+number and its expiry.
+"""
+COPY_SEQUENCED = '''
+for i = 1, #KEYS / 3 do
+  local channel, log, expire = KEYS[3 * i - 2], KEYS[3 * i], tonumber(ARGV[3 * i + 1])
+  local message, seq = ARGV[3 * i - 1], tonumber(ARGV[3 * i])
+  if seq > (tonumber(redis.call('GET', KEYS[3 * i - 1])) or 0) then
+    redis.call('SET', KEYS[3 * i - 1], seq)
+  end
+  redis.call('RPUSH', log, message)
+  redis.call('LTRIM', log, -tonumber(ARGV[1]), -1)
+  if expire > 0 then
+    redis.call('SETEX', channel, expire, message)
+    redis.call('EXPIRE', log, expire)
+  end
+  redis.call('PUBLISH', channel, message)
+end
+'''
+
+"""
+Raise the sequence numbers of channels to at least the numbers passed as arguments, one per key,
+so that a node a channel moved to continues the numbering of the node it lived on before.
+"""
+SEED_SEQUENCES = '''
+for i, key in ipairs(KEYS) do
+  if tonumber(ARGV[i]) > (tonumber(redis.call('GET', key)) or 0) then
+    redis.call('SET', key, ARGV[i])
+  end
+end
+'''
+
+"""
+Return the current sequence number of a channel, whether the replay log still holds every message
+published after the sequence number passed in, and if so these messages.
+"""
+FETCH_SINCE = '''
+local seq = tonumber(redis.call('GET', KEYS[1])) or 0
+local missed = seq - tonumber(ARGV[1])
+if missed < 0 or missed > redis.call('LLEN', KEYS[2]) then
+  return {seq, 0}
+end
+local result = {seq, 1}
+if missed > 0 then
+  for _, message in ipairs(redis.call('LRANGE', KEYS[2], -missed, -1)) do
+    table.insert(result, message)
+  end
+end
+return result
+'''
+
+"""
+Count the open connections of a user to a facility in their presence key, which expires unless
+it is refreshed. ARGV[1] is the change of the count, 1 for a connection opening, 0 for a heartbeat
+and -1 for a connection closing, ARGV[2] the presence timeout and ARGV[3] the grace period after
+the last connection closed. Returns the number of open connections.
+"""
+COUNT_PRESENT = '''
+local change = tonumber(ARGV[1])
+local count = redis.call('INCRBY', KEYS[1], change)
+if count < 1 then
+  if change < 0 then
+    redis.call('SET', KEYS[1], 0, 'EX', ARGV[3])
+    return 0
+  end
+  -- the key expired while the connection was open
+  count = 1
+  redis.call('SET', KEYS[1], count)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return count
+'''
+
 
 def _wrap_users(users, request):
     """
@@ -100,45 +204,215 @@ class RedisStore(object):
     datastore.
     """
     _expire = settings.WS4REDIS_EXPIRE
+    _replay_length = settings.WS4REDIS_REPLAY_LENGTH
+    _presence_timeout = settings.WS4REDIS_PRESENCE_TIMEOUT
 
     def __init__(self, connection):
         self._connection = connection
+        self._shards = get_shards()
         self._publishers = set()
+        self._present = {}
 
-    def publish_message(self, message, expire=None):
+    def publish_message(self, message, expire=None, persist=True):
         """
         Publish a ``message`` on the subscribed channel on the Redis datastore.
         ``expire`` sets the time in seconds, on how long the message shall additionally of being
         published, also be persisted in the Redis datastore. If unset, it defaults to the
-        configuration settings ``WS4REDIS_EXPIRE``.
+        configuration settings ``WS4REDIS_EXPIRE``. Ephemeral messages, published with
+        ``persist=False``, are neither persisted nor numbered and kept for replay.
+        """
+        self.publish_messages([(channel, message) for channel in self._publishers], expire, persist)
+
+    def publish_messages(self, messages, expire=None, persist=True):
+        """
+        Publish ``(channel, message)`` pairs, in their order and with a single round trip to Redis.
+        Channels are full channel names, such as returned by ``get_broadcast_channel``.
         """
         if expire is None:
             expire = self._expire
-        if not isinstance(message, RedisMessage):
-            raise ValueError('message object is not of type RedisMessage')
-        for channel in self._publishers:
-            self._connection.publish(channel, message)
-            if expire > 0:
-                self._connection.setex(channel, expire, message)
+        entries = []
+        for channel, message in messages:
+            if not isinstance(message, RedisMessage):
+                raise ValueError('message object is not of type RedisMessage')
+            entries.append((channel, message, expire, persist))
+        self._publish(entries)
+
+    def _publish(self, entries):
+        """
+        Publish ``(channel, message, expire, persist)`` entries, with a pipeline per node their
+        channels live on. While rebalancing, messages are numbered only on the node a channel
+        lives on, and then copied to the node it lived on before.
+        """
+        if not entries:
+            return
+        if self._shards is None:
+            self._publish_on(self._connection, entries)
+            return
+        nodes, copies = OrderedDict(), OrderedDict()
+        for entry in entries:
+            publish_nodes = self._shards.get_publish_nodes(entry[0])
+            node_entries = nodes.setdefault(publish_nodes[0], [])
+            for previous in publish_nodes[1:]:
+                copies.setdefault(previous, []).append((publish_nodes[0], len(node_entries)))
+            node_entries.append(entry)
+        seeds = self._get_seeds(nodes, copies)
+        numbered = dict((node, self._publish_on(self._shards.get_connection(node), node_entries,
+                                                seeds=seeds.get(node), numbered=bool(copies)))
+                        for node, node_entries in nodes.items())
+        for previous, positions in copies.items():
+            self._publish_on(self._shards.get_connection(previous),
+                             [nodes[node][index] for node, index in positions],
+                             copies=[numbered[node][index] for node, index in positions])
+
+    def _get_seeds(self, nodes, copies):
+        """
+        Return the sequence numbers the channels being moved reached on the nodes they lived on
+        before, as lists of ``(key, seq)`` per node they live on now.
+        """
+        seeds = {}
+        for previous, positions in copies.items():
+            positions = [(node, index) for node, index in positions if self._is_numbered(nodes[node][index])]
+            if not positions:
+                continue
+            keys = [nodes[node][index][0] + ':seq' for node, index in positions]
+            for (node, index), key, seq in zip(positions, keys, self._shards.get_connection(previous).mget(keys)):
+                if seq is not None:
+                    seeds.setdefault(node, []).append((key, seq))
+        return seeds
+
+    def _is_numbered(self, entry):
+        channel, message, expire, persist = entry
+        return persist and self._replay_length > 0 and message[:2] == b'{"'
+
+    def _publish_on(self, connection, entries, seeds=None, copies=None, numbered=False):
+        """
+        Publish entries in a pipeline on ``connection``. Consecutive messages to be numbered are
+        published by a single call of PUBLISH_SEQUENCED. If ``numbered``, returns ``(seq, message)``
+        for each entry as it was numbered, or None.
+
+        While rebalancing, the sequence numbers are first raised to ``seeds``, and on the node a
+        channel lived on before, the messages are passed as numbered elsewhere in ``copies``.
+        """
+        pipe = connection.pipeline(transaction=False)
+        commands = 0
+        if seeds:
+            pipe.eval(SEED_SEQUENCES, len(seeds), *([key for key, seq in seeds] + [seq for key, seq in seeds]))
+            commands += 1
+        script = PUBLISH_SEQUENCED if copies is None else COPY_SEQUENCED
+        # the positions of the scripts in the pipeline, with the entries they number
+        batches = []
+        keys, args, batch = [], [self._replay_length], []
+        for index, entry in enumerate(entries):
+            channel, message, expire, persist = entry
+            if self._is_numbered(entry):
+                keys.extend((channel, channel + ':seq', channel + ':log'))
+                if copies is None:
+                    args.extend((message, expire))
+                else:
+                    seq, copy = copies[index]
+                    args.extend((copy, seq, expire))
+                batch.append(index)
+                continue
+            if keys:
+                batches.append((commands, batch))
+                pipe.eval(script, len(keys), *(keys + args))
+                keys, args, batch = [], [self._replay_length], []
+                commands += 1
+            pipe.publish(channel, message)
+            commands += 1
+            if persist and expire > 0:
+                pipe.setex(channel, expire, message)
+                commands += 1
+        if keys:
+            batches.append((commands, batch))
+            pipe.eval(script, len(keys), *(keys + args))
+        results = pipe.execute()
+        if not numbered:
+            return None
+        numbered = [None] * len(entries)
+        for position, batch in batches:
+            for index, seq in zip(batch, results[position]):
+                # as PUBLISH_SEQUENCED numbered it
+                numbered[index] = (seq, b'{"seq":' + str(seq).encode() + b',' + entries[index][1][1:])
+        return numbered
+
+    def get_sequence(self):
+        """
+        Return the sequence number of the last message published on the channels of this store.
+        A client resuming from this number receives everything published afterwards.
+        """
+        if not self._publishers:
+            return 0
+        channels = list(self._publishers)
+        # the channels of a store share their facility, and so their node
+        connection = self._get_connection(channels[0])
+        return max(int(seq or 0) for seq in connection.mget([channel + ':seq' for channel in channels]))
 
-    def set_present(self, user, present):
+    def get_messages_since(self, channel, since):
+        """
+        Return the sequence number of the last message published on ``channel`` and the messages
+        published after the sequence number ``since``, oldest first. If some of these messages
+        have already been dropped from the replay log, None is returned instead of the messages.
         """
-        Set a user as present
+        result = self._get_connection(channel).eval(FETCH_SINCE, 2, channel + ':seq', channel + ':log', since)
+        if not result[1]:
+            return result[0], None
+        return result[0], [RedisMessage(message) for message in result[2:]]
+
+    def _get_connection(self, channel):
         """
-        key = "users_present:" + str(user.id)
+        Return the connection to the node ``channel`` lives on.
+        """
+        if self._shards is None:
+            return self._connection
+        return self._shards.get_connection(self._shards.get_node(channel))
+
+    def set_present(self, user, present, facility=None):
+        """
+        Set a user as present. While present, this must be repeated as a heartbeat, otherwise
+        the user's presence times out after ``WS4REDIS_PRESENCE_TIMEOUT`` seconds. Heartbeats
+        arriving more often than every third of that time are not forwarded to Redis.
+        Connections are counted per user, so that the user stays present until the last one of
+        them is closed.
+        """
+        key = self.get_presence_key(user.id, facility)
+        now = time.time()
         if present:
-            self._connection.set(key, 1)
-        else:
+            last = self._present.get(key)
+            if last is not None and now - last < self._presence_timeout / 3.0:
+                return
+            self._present[key] = now
+            self._connection.eval(COUNT_PRESENT, 1, key, 0 if last is not None else 1,
+                                  self._presence_timeout, 5)
+        elif self._present.pop(key, None) is not None:
             # Give a short timeout, so that if the user is
             # loading another room there isn't a flicker in status
-            self._connection.setex(key, 5, 1)
+            self._connection.eval(COUNT_PRESENT, 1, key, -1, self._presence_timeout, 5)
 
-    def get_present(self, user):
+    def get_present(self, user, facility=None):
         """
-        Get the list of user ids that are present
+        Get whether the user is present
         """
-        key = "users_present:" + str(user.id)
-        return self._connection.get(key)
+        return self._connection.get(self.get_presence_key(user.id, facility))
+
+    def get_present_many(self, user_ids, facility=None):
+        """
+        Get the ids of those users which are present, with one round trip to Redis
+        """
+        if not user_ids:
+            return set()
+        keys = [self.get_presence_key(user_id, facility) for user_id in user_ids]
+        return set(user_id for user_id, present in zip(user_ids, self._connection.mget(keys)) if present)
+
+    @staticmethod
+    def get_presence_key(user_id, facility=None):
+        if facility:
+            return 'users_present:{0}:{1}'.format(facility, user_id)
+        return 'users_present:{0}'.format(user_id)
+
+    @classmethod
+    def get_broadcast_channel(cls, facility):
+        return '{prefix}broadcast:{facility}'.format(prefix=cls.get_prefix(), facility=facility)
 
     @staticmethod
     def get_prefix():
@@ -10,6 +10,19 @@ WS4REDIS_CONNECTION = getattr(settings, 'WS4REDIS_CONNECTION', {
     'password': None,
 })
 
+"""
+The Redis nodes to spread websocket channels over, as a list of connection settings like
+WS4REDIS_CONNECTION. Each channel is assigned, along with its sequence number and replay log, to
+a node by consistent hashing of its facility. Other data stays on WS4REDIS_CONNECTION.
+
+While nodes are added or removed, set WS4REDIS_PREVIOUS_SHARDS to the former list on all
+processes, until every process runs with the new list and all websockets have reconnected:
+messages are then also published to the node a facility used to live on.
+"""
+WS4REDIS_SHARDS = getattr(settings, 'WS4REDIS_SHARDS', [WS4REDIS_CONNECTION])
+
+WS4REDIS_PREVIOUS_SHARDS = getattr(settings, 'WS4REDIS_PREVIOUS_SHARDS', None)
+
 """
 A string to prefix elements in the Redis datastore, to avoid naming conflicts with other services.
 """
@@ -20,6 +33,13 @@ The time in seconds, items shall be persisted by the Redis datastore.
 """
 WS4REDIS_EXPIRE = getattr(settings, 'WS4REDIS_EXPIRE', 3600)
 
+"""
+The number of messages kept per channel, so that a client reconnecting with ``?since=<seq>``
+receives the messages it missed. Messages which are JSON objects are numbered per channel, with
+the sequence number as their first member ``seq``. Set to 0 to disable numbering and replay.
+"""
+WS4REDIS_REPLAY_LENGTH = getattr(settings, 'WS4REDIS_REPLAY_LENGTH', 500)
+
 """
 Replace the subscriber class by a customized version.
 """
@@ -29,11 +49,96 @@ WS4REDIS_SUBSCRIBER = getattr(settings, 'WS4REDIS_SUBSCRIBER', 'ws4redis.subscri
 This set the magic string to recognize heartbeat messages. If set, this message string is ignored
 by the server and also shall be ignored on the client.
 
-If WS4REDIS_HEARTBEAT is not None, the server sends at least every 4 seconds a heartbeat message.
-It is then up to the client to decide, what to do with these messages.
+If WS4REDIS_HEARTBEAT is not None, the server sends a heartbeat message to each websocket it
+hasn't sent anything else to for WS4REDIS_KEEPALIVE['heartbeat'] seconds. It is then up to the
+client to decide, what to do with these messages.
 """
 WS4REDIS_HEARTBEAT = getattr(settings, 'WS4REDIS_HEARTBEAT', None)
 
+"""
+Timeouts in seconds for keeping websockets alive. Websockets which haven't been sent anything for
+``heartbeat`` seconds are sent WS4REDIS_HEARTBEAT. Clients which haven't been heard from for
+``ping`` seconds are pinged, which browsers answer even when the page's timers are throttled, and
+those silent for ``idle`` seconds are disconnected.
+"""
+WS4REDIS_KEEPALIVE = dict({
+    'heartbeat': 4,
+    'ping': 20,
+    'idle': 60,
+}, **getattr(settings, 'WS4REDIS_KEEPALIVE', {}))
+
+"""
+The time in seconds a user stays present after the last heartbeat of their websocket. Open
+websockets refresh their presence every third of this time.
+"""
+WS4REDIS_PRESENCE_TIMEOUT = getattr(settings, 'WS4REDIS_PRESENCE_TIMEOUT', 30)
+
+"""
+Compress messages with the permessage-deflate extension (RFC 7692) for clients offering it.
+Only applies to the websocket servers built into ws4redis, uWSGI negotiates on its own.
+"""
+WS4REDIS_PERMESSAGE_DEFLATE = getattr(settings, 'WS4REDIS_PERMESSAGE_DEFLATE', True)
+
+"""
+Options for permessage-deflate. ``window_bits`` (9 to 15) limits the LZ77 window in both
+directions and ``mem_level`` (1 to 9) the compressor's internal state, together they bound the
+memory each websocket holds. Without ``context_takeover`` every message is compressed on its own,
+which compresses worse but keeps no window between messages. Messages shorter than ``min_size``
+bytes are sent uncompressed, and inflated messages are limited to ``max_message_size`` bytes.
+"""
+WS4REDIS_PERMESSAGE_DEFLATE_OPTIONS = dict({
+    'window_bits': 12,
+    'mem_level': 5,
+    'context_takeover': True,
+    'min_size': 64,
+    'max_message_size': 1 << 20,
+}, **getattr(settings, 'WS4REDIS_PERMESSAGE_DEFLATE_OPTIONS', {}))
+
+"""
+How websocket loops served by uWSGI wait for their sockets. ``gevent`` yields to the gevent hub and
+requires uWSGI's gevent loop engine (``gevent = <cores>``), ``async`` suspends the async core with
+``uwsgi.wait_fd_read`` (``async = <cores>`` with e.g. ``ugreen``), and ``sync`` blocks the worker
+for as long as its websocket is open. ``auto`` picks from the options uWSGI was started with.
+"""
+WS4REDIS_UWSGI_MODE = getattr(settings, 'WS4REDIS_UWSGI_MODE', 'auto')
+
+"""
+Send JSON messages in the compact binary encoding of ``ws4redis.compact`` to clients offering the
+``ws4redis.compact.v1`` subprotocol. Only applies to the websocket servers built into ws4redis.
+"""
+WS4REDIS_COMPACT_PROTOCOL = getattr(settings, 'WS4REDIS_COMPACT_PROTOCOL', True)
+
+"""
+Messages which a client doesn't read fast enough are queued, up to ``max_bytes`` per websocket.
+When the queue is full, the ``policy`` decides what happens:
+``disconnect`` closes the websocket, ``drop`` drops the oldest queued messages whose type is
+listed in ``droppable`` and ``coalesce`` does the same but first replaces a queued droppable
+message by a newer one of the same type. ``droppable`` maps a type to the field which identifies
+what a message is about, e.g. the user of a status change, or to None if any newer message of the
+type supersedes it. If dropping doesn't free enough room, the websocket is closed.
+"""
+WS4REDIS_OUTBOX = dict({
+    'max_bytes': 256 * 1024,
+    'policy': 'coalesce',
+    'droppable': {},
+}, **getattr(settings, 'WS4REDIS_OUTBOX', {}))
+
+"""
+Limits on the websockets a process accepts. ``max_connections`` caps the open websockets of the
+process and ``max_per_user`` those of a single authenticated user. Handshakes are admitted at
+``handshake_rate`` per second, with bursts of up to ``handshake_burst``, before any session is
+loaded. Refused handshakes are answered with ``503 Service Unavailable`` and a Retry-After of
+``retry_after`` seconds plus up to ``retry_jitter`` times as much again at random, so that clients
+refused together don't come back together. Set a limit to None to disable it.
+"""
+WS4REDIS_ADMISSION = dict({
+    'max_connections': 2000,
+    'max_per_user': 20,
+    'handshake_rate': 100,
+    'handshake_burst': 200,
+    'retry_after': 5,
+    'retry_jitter': 1.0,
+}, **getattr(settings, 'WS4REDIS_ADMISSION', {}))
 
 """
 If set, this callback function is called right after the initialization of the Websocket.
@@ -47,6 +152,12 @@ database!
 """
 WS4REDIS_ALLOWED_CHANNELS = getattr(settings, 'WS4REDIS_ALLOWED_CHANNELS', None)
 
+"""
+The time in seconds a ticket issued by ``ws4redis.tickets.issue_ticket`` authorizes opening
+websockets. Clients which connect with an expired ticket are authorized by their session instead.
+"""
+WS4REDIS_TICKET_TTL = getattr(settings, 'WS4REDIS_TICKET_TTL', 600)
+
 """
 If set, this callback function is called instead of the default process_request function in WebsocketWSGIServer.
 This function can be used to enforce custom authentication flow. i.e. JWT
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Channels spread over several Redis nodes, configured by ``WS4REDIS_SHARDS``. A channel lives on
+the node its facility hashes to on a consistent hash ring, together with its sequence number,
+replay log and persisted message, so that all audiences of a facility share a node. Adding or
+removing a node only moves the facilities hashing next to it.
+"""
+import bisect
+import hashlib
+import struct
+from functools import lru_cache
+from redis import ConnectionPool, StrictRedis
+from ws4redis import settings
+
+
+def get_facility(channel):
+    """
+    Return the facility of a channel key such as ``<prefix>:broadcast:<facility>``.
+    """
+    return channel.rsplit(':', 1)[-1]
+
+
+def get_node_name(connection):
+    """
+    Name a node by its address rather than its position in the list, so that the ring stays put
+    when nodes are reordered.
+    """
+    return '{0}:{1}/{2}'.format(connection.get('host', 'localhost'), connection.get('port', 6379),
+                                connection.get('db', 0))
+
+
+def _hash(key):
+    return struct.unpack('>I', hashlib.md5(key.encode('utf-8')).digest()[:4])[0]
+
+
+class HashRing(object):
+    """
+    A consistent hash ring, each node is placed at ``REPLICAS`` points to even out its share.
+    """
+    REPLICAS = 128
+
+    def __init__(self, nodes):
+        points = sorted((_hash('{0}#{1}'.format(node, i)), node) for node in nodes for i in range(self.REPLICAS))
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    def get_node(self, key):
+        index = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+class Shards(object):
+    """
+    The Redis nodes channels are spread over. While nodes are being added or removed, ``previous``
+    lists the nodes before the change, and messages are also published to the node a facility
+    hashed to before, where websockets opened by processes which still run with the former list
+    listen.
+    """
+
+    def __init__(self, nodes, previous=()):
+        self._settings = dict((get_node_name(node), node) for node in list(nodes) + list(previous))
+        self.nodes = [get_node_name(node) for node in nodes]
+        self._ring = HashRing(self.nodes)
+        self._previous = HashRing([get_node_name(node) for node in previous]) if previous else None
+        self._connections = {}
+        self.get_node = lru_cache(maxsize=4096)(self._get_node)
+        self.get_publish_nodes = lru_cache(maxsize=4096)(self._get_publish_nodes)
+
+    def _get_node(self, channel):
+        """
+        Return the node ``channel`` is subscribed on.
+        """
+        return self._ring.get_node(get_facility(channel))
+
+    def _get_publish_nodes(self, channel):
+        """
+        Return the nodes messages for ``channel`` are published to, its node first.
+        """
+        node = self.get_node(channel)
+        if self._previous is None:
+            return (node,)
+        previous = self._previous.get_node(get_facility(channel))
+        return (node,) if previous == node else (node, previous)
+
+    def get_connection(self, node):
+        connection = self._connections.get(node)
+        if connection is None:
+            pool = ConnectionPool(**self._settings[node])
+            connection = self._connections[node] = StrictRedis(connection_pool=pool)
+        return connection
+
+
+class ShardedPubSub(object):
+    """
+    Pubsub connections to each node, where channels are subscribed on the node they live on.
+    ``default`` is the pubsub connection of ``connection``, which the process' other data, and
+    therefore its expiring keys, are stored on, and which holds all channels when not sharded.
+    """
+
+    def __init__(self, connection, shards=None):
+        self._shards = shards
+        self.default = connection.pubsub()
+        self._pubsubs = {}
+        if shards is not None:
+            for node in shards.nodes:
+                self._pubsubs[node] = shards.get_connection(node).pubsub()
+
+    def __iter__(self):
+        yield self.default
+        for pubsub in self._pubsubs.values():
+            yield pubsub
+
+    def get_pubsub(self, channel):
+        if self._shards is None:
+            return self.default
+        return self._pubsubs[self._shards.get_node(channel)]
+
+    def subscribe(self, channel):
+        pubsub = self.get_pubsub(channel)
+        pubsub.subscribe(channel)
+        return pubsub
+
+    def unsubscribe(self, channel):
+        self.get_pubsub(channel).unsubscribe(channel)
+
+
+_shards = []
+
+
+def get_shards():
+    """
+    Return the ``Shards`` configured for this process, or None if all channels live on the node
+    of ``WS4REDIS_CONNECTION``.
+    """
+    if not _shards:
+        nodes, previous = settings.WS4REDIS_SHARDS, settings.WS4REDIS_PREVIOUS_SHARDS
+        _shards.append(Shards(nodes, previous or ()) if len(nodes) > 1 or previous else None)
+    return _shards[0]
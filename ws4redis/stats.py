@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Counters of the websocket servers. Each process counts in memory and adds its counts to the Redis
+hash ``ws4redis:stats`` from time to time, where they can be read for all processes with:
+
+    redis-cli hgetall ws4redis:stats
+"""
+import threading
+import time
+from collections import Counter
+from redis.exceptions import RedisError
+
+import logging
+
+logger = logging.getLogger("django")
+
+STATS_KEY = 'ws4redis:stats'
+
+_counters = Counter()
+_lock = threading.Lock()
+_flushed = [0]
+
+
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def get_counters():
+    """
+    Return the counts of this process which have not been flushed yet.
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def flush(connection, interval=0):
+    """
+    Add the counts of this process to the counters in Redis and reset them, unless they have
+    been flushed less than ``interval`` seconds ago.
+    """
+    with _lock:
+        if not _counters or time.time() - _flushed[0] < interval:
+            return
+        _flushed[0] = time.time()
+        counters = dict(_counters)
+        _counters.clear()
+    pipe = connection.pipeline(transaction=False)
+    for name, amount in counters.items():
+        pipe.hincrby(STATS_KEY, name, amount)
+    try:
+        pipe.execute()
+    except RedisError as excpt:
+        logger.warning('Failed to flush counters: {}'.format(excpt))
+        with _lock:
+            _counters.update(counters)
@@ -1,11 +1,161 @@
 # -*- coding: utf-8 -*-
+import os
+import threading
+from collections import Counter, defaultdict, deque
+from redis.exceptions import ConnectionError
 from django.conf import settings
-from ws4redis.redis_store import RedisStore, SELF
+from ws4redis.redis_store import RedisMessage, RedisStore, SELF
+from ws4redis.sharding import ShardedPubSub, get_shards
+from ws4redis.timers import clock
 
 import logging
 
 logger = logging.getLogger("django")
 
+EXPIRED_CHANNEL = '__keyevent@0__:expired'
+
+
+class SubscriptionRegistry(object):
+    """
+    Process wide registry of channel subscriptions. All subscribers of this process share one
+    Redis pubsub connection per node, where each channel is subscribed only once, reference
+    counted by the local subscribers listening on it. Incoming messages are dispatched in memory
+    to the interested subscribers.
+
+    There is no reader thread: one of the subscribers is elected to watch the shared connection
+    in its websocket loop, and calls ``dispatch`` to drain it on behalf of all subscribers. So that
+    a loop which is busy with its own client doesn't hold up everyone else's messages, the elected
+    subscriber hands the role over before handling what its client sent, and one whose loop hasn't
+    come around for ``reader_term`` seconds is replaced by the next subscriber asking for the role.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # seconds the elected reader's loop may be away before another subscriber takes over
+    reader_term = 1.0
+
+    def __init__(self, connection):
+        self.pid = os.getpid()
+        self._lock = threading.RLock()
+        # how many times each local subscriber subscribed to a channel
+        self._listeners = defaultdict(Counter)
+        self._reader = None
+        self._read_at = 0
+        self._pubsub = ShardedPubSub(connection, get_shards())
+        self._pubsub.default.subscribe(EXPIRED_CHANNEL)
+
+    @classmethod
+    def get_instance(cls, connection):
+        """
+        Return the registry of the current process, creating it on first use (and after a fork).
+        """
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls(connection)
+            return cls._instance
+
+    def subscribe(self, subscriber, channels):
+        with self._lock:
+            self._listeners[EXPIRED_CHANNEL][subscriber] = 1
+            for channel in channels:
+                listeners = self._listeners[channel]
+                if not listeners:
+                    connected = self._pubsub.get_pubsub(channel).connection is not None
+                    self._pubsub.subscribe(channel)
+                    if not connected and self._reader is not None:
+                        # the pubsub of another node has connected, its descriptor is to be watched too
+                        self._reader.wakeup()
+                listeners[subscriber] += 1
+
+    def unsubscribe(self, subscriber, channels):
+        with self._lock:
+            self._listeners[EXPIRED_CHANNEL].pop(subscriber, None)
+            self.hand_over(subscriber)
+            self.unsubscribe_channels(subscriber, channels)
+
+    def unsubscribe_channels(self, subscriber, channels):
+        """
+        Unsubscribe ``subscriber`` once from each of ``channels``, while it stays subscribed to the
+        others, and to those it subscribed to more often.
+        """
+        with self._lock:
+            for channel in channels:
+                listeners = self._listeners.get(channel)
+                if not listeners or subscriber not in listeners:
+                    continue
+                listeners[subscriber] -= 1
+                if listeners[subscriber] <= 0:
+                    del listeners[subscriber]
+                if not listeners:
+                    del self._listeners[channel]
+                    self._pubsub.unsubscribe(channel)
+
+    def claim_reader(self, subscriber):
+        """
+        Elect ``subscriber`` to watch the shared pubsub connection, unless another subscriber
+        already does and its loop came around within ``reader_term`` seconds. Returns True if
+        ``subscriber`` is the elected reader.
+        """
+        with self._lock:
+            now = clock()
+            if self._reader is None or self._reader is subscriber or now - self._read_at > self.reader_term:
+                self._reader = subscriber
+                self._read_at = now
+            return self._reader is subscriber
+
+    def hand_over(self, subscriber):
+        """
+        Unless it isn't the elected reader, let ``subscriber`` give up watching the shared pubsub
+        connection, and wake up another subscriber, so that it takes over.
+        """
+        with self._lock:
+            if self._reader is not subscriber:
+                return
+            self._reader = None
+            for listener in self._listeners[EXPIRED_CHANNEL]:
+                if listener is not subscriber:
+                    listener.wakeup()
+                    break
+
+    def get_file_descriptors(self):
+        """
+        Returns the file descriptors of the shared pubsub connections.
+        """
+        with self._lock:
+            return [pubsub.connection._sock.fileno() for pubsub in self._pubsub
+                    if pubsub.connection and pubsub.connection._sock]
+
+    def dispatch(self):
+        """
+        Drain all pending messages from the shared pubsub connections and hand them to the local
+        subscribers of their channel.
+        """
+        with self._lock:
+            for pubsub in self._pubsub:
+                if pubsub.connection:
+                    self._dispatch(pubsub)
+
+    def _dispatch(self, pubsub):
+        while True:
+            try:
+                message = pubsub.get_message()
+            except ConnectionError as excpt:
+                # reconnecting resubscribes all channels of the shared connection
+                logger.warning('Lost connection to Redis: {}'.format(excpt))
+                pubsub.connection.disconnect()
+                pubsub.connection.connect()
+                return
+            if message is None:
+                return
+            if message['type'] != 'message':
+                continue
+            channel = message['channel']
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            response = [b'message', message['channel'], message['data']]
+            for subscriber in self._listeners.get(channel, ()):
+                subscriber.deliver(response)
+
 
 class RedisSubscriber(RedisStore):
     """
@@ -13,20 +163,63 @@ class RedisSubscriber(RedisStore):
     """
     subscription_channels = ['subscribe-session', 'subscribe-group', 'subscribe-user', 'subscribe-broadcast']
     publish_channels = ['publish-session', 'publish-group', 'publish-user', 'publish-broadcast']
+    expired_channel = EXPIRED_CHANNEL
 
     def __init__(self, connection):
         self._subscription = None
+        self._subscription_keys = []
+        self._pending = deque()
+        self._pending_lock = threading.Lock()
+        self._signalled = False
+        self._wakeup = None
         super(RedisSubscriber, self).__init__(connection)
 
+    def _signal(self):
+        # the wakeup pipe holds at most one byte, which is consumed by parse_response
+        if not self._signalled:
+            os.write(self._wakeup[1], b'x')
+            self._signalled = True
+
+    def deliver(self, response):
+        """
+        Queue a message response dispatched by the shared subscription, and wake up the
+        websocket loop listening on ``get_file_descriptor``.
+        """
+        with self._pending_lock:
+            self._pending.append(response)
+            self._signal()
+
+    def wakeup(self):
+        """
+        Wake up the websocket loop without delivering a message.
+        """
+        with self._pending_lock:
+            self._signal()
+
     def parse_response(self):
         """
-        Parse a message response sent by the Redis datastore on a subscribed channel.
+        Return the next message response queued for this subscriber, if any.
         """
-        return self._subscription.parse_response()
+        with self._pending_lock:
+            os.read(self._wakeup[0], 1)
+            self._signalled = False
+            if not self._pending:
+                return None
+            response = self._pending.popleft()
+            if self._pending:
+                self._signal()
+            return response
 
-    def set_pubsub_channels(self, request, channels):
+    def dispatch(self):
+        """
+        Called when the shared pubsub connection is readable.
+        """
+        self._subscription.dispatch()
+
+    def get_channel_keys(self, request, channels):
         """
-        Initialize the channels used for publishing and subscribing messages through the message queue.
+        Return the keys to publish messages to and the keys to subscribe to, for the ``channels``
+        agreed with a client on the facility of ``request``.
         """
         facility = request.path_info.replace(settings.WEBSOCKET_URL, '', 1)
 
@@ -37,9 +230,7 @@ class RedisSubscriber(RedisStore):
             'sessions': 'publish-session' in channels and [SELF] or [],
             'broadcast': 'publish-broadcast' in channels,
         }
-        self._publishers = set()
-        for key in self._get_message_channels(request=request, facility=facility, **audience):
-            self._publishers.add(key)
+        publishers = self._get_message_channels(request=request, facility=facility, **audience)
 
         # initialize subscribers
         audience = {
@@ -48,34 +239,105 @@ class RedisSubscriber(RedisStore):
             'sessions': 'subscribe-session' in channels and [SELF] or [],
             'broadcast': 'subscribe-broadcast' in channels,
         }
-        self._subscription = self._connection.pubsub()
-        for key in self._get_message_channels(request=request, facility=facility, **audience):
-            self._subscription.subscribe(key)
-        self._subscription.subscribe('__keyevent@0__:expired')
+        return publishers, self._get_message_channels(request=request, facility=facility, **audience)
+
+    def set_channels(self, request, channels):
+        """
+        Initialize the channels used for publishing messages and return the keys this client
+        shall be subscribed to, without opening a subscription on the message queue.
+        """
+        publishers, self._subscription_keys = self.get_channel_keys(request, channels)
+        self._publishers = set(publishers)
+        return self._subscription_keys
+
+    def set_pubsub_channels(self, request, channels):
+        """
+        Initialize the channels used for publishing and subscribing messages through the message
+        queue. Subscriptions are shared with all other subscribers of this process.
+        """
+        self._wakeup = os.pipe()
+        self._subscription = SubscriptionRegistry.get_instance(self._connection)
+        self._subscription.subscribe(self, self.set_channels(request, channels))
+
+    def subscribe_channels(self, keys):
+        """
+        Additionally subscribe to ``keys``, once ``set_pubsub_channels`` has been called.
+        """
+        self._subscription_keys = self._subscription_keys + list(keys)
+        self._subscription.subscribe(self, keys)
+
+    def unsubscribe_channels(self, keys):
+        """
+        Unsubscribe from ``keys``, leaving the other channels of this subscriber subscribed.
+        """
+        remaining = list(self._subscription_keys)
+        for key in keys:
+            if key in remaining:
+                remaining.remove(key)
+        self._subscription_keys = remaining
+        self._subscription.unsubscribe_channels(self, keys)
 
     def send_persited_messages(self, websocket):
         """
         This method is called immediately after a websocket is openend by the client, so that
         persisted messages can be sent back to the client upon connection.
         """
-        for channel in self._subscription.channels:
-            message = self._connection.get(channel)
+        for channel in self._subscription_keys:
+            message = self._get_connection(channel).get(channel)
             if message:
                 websocket.send(message)
 
+    def get_missed_messages(self, since, keys=None):
+        """
+        Return the messages published on the subscribed channels, or on ``keys``, after the
+        sequence number ``since``, for a client resuming its connection. For a channel whose replay
+        log doesn't reach back that far, the message ``{"seq":<seq>,"type":"gap"}`` is returned
+        instead, so that the client knows it has to reload its state.
+        """
+        messages = []
+        for channel in self._subscription_keys if keys is None else keys:
+            seq, missed = self.get_messages_since(channel, since)
+            if missed is None:
+                messages.append(RedisMessage('{{"seq":{0},"type":"gap"}}'.format(seq)))
+            else:
+                messages.extend(missed)
+        return messages
+
     def get_file_descriptor(self):
         """
         Returns the file descriptor used for passing to the select call when listening
-        on the message queue.
+        for messages queued for this subscriber.
+        """
+        return self._wakeup and self._wakeup[0]
+
+    def get_shared_file_descriptors(self):
+        """
+        Returns the file descriptors of the pubsub connections shared by all subscribers, if this
+        subscriber has been elected to watch them. Whenever one is readable, ``dispatch`` shall be
+        called.
+        """
+        if self._subscription and self._subscription.claim_reader(self):
+            return self._subscription.get_file_descriptors()
+        return []
+
+    def hand_over(self):
+        """
+        Called before this subscriber's loop handles what its client sent, which may take a while,
+        so that meanwhile another subscriber watches the shared pubsub connections.
         """
-        return self._subscription.connection and self._subscription.connection._sock.fileno()
+        if self._subscription:
+            self._subscription.hand_over(self)
 
     def release(self):
         """
         New implementation to free up Redis subscriptions when websockets close. This prevents
         memory sap when Redis Output Buffer and Output Lists build when websockets are abandoned.
         """
-        if self._subscription and self._subscription.subscribed:
-            self._subscription.unsubscribe()
-            self._subscription.reset()
+        if self._subscription:
+            self._subscription.unsubscribe(self, self._subscription_keys)
+            self._subscription = None
+        if self._wakeup:
+            os.close(self._wakeup[0])
+            os.close(self._wakeup[1])
+            self._wakeup = None
 
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Deadlines for many websockets. Each websocket keeps a single entry, which is checked when it falls
+due and then rescheduled from the websocket's own timestamps, so that traffic on a websocket only
+updates those timestamps and never touches the queue.
+"""
+import heapq
+import itertools
+import time
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class TimerQueue(object):
+    """
+    A heap of ``(deadline, item)`` entries. Entries can't be cancelled, the owner of an item shall
+    ignore it when it expires after having been discarded.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # breaks ties between equal deadlines, items need not be comparable
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, deadline, item):
+        heapq.heappush(self._heap, (deadline, next(self._counter), item))
+
+    def timeout(self, now=None):
+        """
+        Seconds until the next deadline, or None if there is none.
+        """
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - (clock() if now is None else now))
+
+    def expired(self, now=None):
+        """
+        Remove and return the items whose deadline has passed, earliest first.
+        """
+        if now is None:
+            now = clock()
+        items = []
+        while self._heap and self._heap[0][0] <= now:
+            items.append(heapq.heappop(self._heap)[2])
+        return items
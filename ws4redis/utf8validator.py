@@ -27,6 +27,7 @@
 ##
 ###############################################################################
 
+import codecs
 import six
 
 if six.PY3:
@@ -46,6 +47,11 @@ except:
 
         Implements the algorithm "Flexible and Economical UTF-8 Decoder" by
         Bjoern Hoehrmann (http://bjoern.hoehrmann.de/utf-8/decoder/dfa/).
+
+        On Python 3, whole chunks are validated by the incremental UTF-8 codec
+        of the standard library. The DFA only runs to determine the octet at
+        which an invalid chunk bails out, and over the (at most three) octets
+        of a code point left incomplete at the end of a chunk.
         """
 
         ## DFA transitions
@@ -73,6 +79,7 @@ except:
             self.state = None
             self.codepoint = None
             self.i = None
+            self.decoder = codecs.getincrementaldecoder('utf-8')()
             self.reset()
 
         def decode(self, b):
@@ -104,6 +111,7 @@ except:
             self.state = Utf8Validator.UTF8_ACCEPT
             self.codepoint = 0
             self.i = 0
+            self.decoder.reset()
 
         def validate(self, ba):
             """
@@ -118,15 +126,48 @@ except:
             When valid? == True, currentIndex will be len(ba) and totalIndex the
             total amount of consumed bytes.
             """
+            if isinstance(ba, six.text_type):
+                ba = ba.encode('utf-8')
+            if six.PY2:
+                # Python 2 decodes surrogates, which are invalid UTF-8
+                return self.validate_octets(ba)
+
+            pending = self.decoder.getstate()[0]
+            try:
+                self.decoder.decode(ba)
+            except UnicodeDecodeError:
+                pass
+            else:
+                # the codec only checks a code point left incomplete at the end
+                # of the chunk once it is completed, hence check it here
+                state = Utf8Validator.UTF8_ACCEPT
+                for b in bytearray(self.decoder.getstate()[0]):
+                    state = Utf8Validator.UTF8VALIDATOR_DFA[256 + (state << 4) + Utf8Validator.UTF8VALIDATOR_DFA[b]]
+                if state != Utf8Validator.UTF8_REJECT:
+                    l = len(ba)
+                    self.i += l
+                    self.state = state
+                    return True, state == Utf8Validator.UTF8_ACCEPT, l, self.i
+
+            # invalid: replay the DFA, including the incomplete code point carried
+            # over from the previous chunk, to find the octet of bail out
+            self.decoder.reset()
+            self.state = Utf8Validator.UTF8_ACCEPT
+            self.i -= len(pending)
+            valid, endsOnCodePoint, i, total = self.validate_octets(pending + ba)
+            return valid, endsOnCodePoint, i - len(pending), total
 
-            if not isinstance(ba, six.text_type):
-                ba = ba.decode()
+        def validate_octets(self, ba):
+            """
+            Same as validate(), but walks the DFA one octet at a time.
+            """
+            ba = bytearray(ba)
             l = len(ba)
 
             for i in xrange(l):
                 ## optimized version of decode(), since we are not interested in actual code points
 
-                self.state = Utf8Validator.UTF8VALIDATOR_DFA[256 + (self.state << 4) + Utf8Validator.UTF8VALIDATOR_DFA[ord(ba[i])]]
+                self.state = Utf8Validator.UTF8VALIDATOR_DFA[256 + (self.state << 4) + Utf8Validator.UTF8VALIDATOR_DFA[ba[i]]]
 
                 if self.state == Utf8Validator.UTF8_REJECT:
                     self.i += i
@@ -1,13 +1,37 @@
 # -*- coding: utf-8 -*-
+import math
+import select
 import uwsgi
-import gevent.select
+from ws4redis import settings as private_settings
 from ws4redis.exceptions import WebSocketError
+from ws4redis.timers import clock
 from ws4redis.wsgi_server import WebsocketWSGIServer
 
+try:
+    import gevent.select
+except ImportError:
+    gevent = None
+
+
+def get_mode():
+    """
+    Return how websocket loops wait on this uWSGI worker, as configured by WS4REDIS_UWSGI_MODE or,
+    with ``auto``, according to the loop engine uWSGI runs: ``gevent``, ``async`` or ``sync``.
+    """
+    mode = private_settings.WS4REDIS_UWSGI_MODE
+    if mode != 'auto':
+        return mode
+    if 'gevent' in uwsgi.opt:
+        return 'gevent'
+    if int(uwsgi.opt.get('async') or 0) > 1:
+        return 'async'
+    return 'sync'
+
 
 class uWSGIWebsocket(object):
     def __init__(self):
         self._closed = False
+        self.sent_at = clock()
 
     def get_file_descriptor(self):
         """Return the file descriptor for the given websocket"""
@@ -21,6 +45,16 @@ class uWSGIWebsocket(object):
     def closed(self):
         return self._closed
 
+    @property
+    def received_at(self):
+        # uWSGI pings clients and drops those not answering on its own, see websocket-pong-tolerance
+        return clock()
+
+    pinged_at = received_at
+
+    def ping(self):
+        pass
+
     def receive(self):
         if self._closed:
             raise WebSocketError("Connection is already closed")
@@ -39,6 +73,7 @@ class uWSGIWebsocket(object):
     def send(self, message, binary=None):
         try:
             uwsgi.websocket_send(message)
+            self.sent_at = clock()
         except IOError as e:
             self.close()
             raise WebSocketError(e)
@@ -48,9 +83,34 @@ class uWSGIWebsocket(object):
 
 
 class uWSGIWebsocketServer(WebsocketWSGIServer):
+    def __init__(self, redis_connection=None):
+        super(uWSGIWebsocketServer, self).__init__(redis_connection)
+        self.mode = get_mode()
+
     def upgrade_websocket(self, environ, start_response):
         uwsgi.websocket_handshake(environ['HTTP_SEC_WEBSOCKET_KEY'], environ.get('HTTP_ORIGIN', ''))
         return uWSGIWebsocket()
 
     def select(self, rlist, wlist, xlist, timeout=None):
-        return gevent.select.select(rlist, wlist, xlist, timeout)
+        if self.mode == 'gevent':
+            return gevent.select.select(rlist, wlist, xlist, timeout)
+        if self.mode == 'async' and (timeout is None or timeout > 0):
+            return self.suspend(rlist, wlist, timeout)
+        return select.select(rlist, wlist, xlist, timeout)
+
+    def suspend(self, rlist, wlist, timeout=None):
+        """
+        Suspend this async core until one of the file descriptors is ready, or the timeout passed,
+        while uWSGI serves other requests on the worker's remaining cores.
+        """
+        # uWSGI waits for whole seconds, and 0 means forever
+        seconds = 0 if timeout is None else max(1, int(math.ceil(timeout)))
+        for fd in rlist:
+            uwsgi.wait_fd_read(fd, seconds)
+        for fd in wlist:
+            uwsgi.wait_fd_write(fd, seconds)
+        uwsgi.suspend()
+        fd = uwsgi.ready_fd()
+        if fd < 0:
+            return [], [], []
+        return [fd] if fd in rlist else [], [fd] if fd in wlist else [], []
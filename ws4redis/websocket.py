@@ -1,20 +1,42 @@
 # -*- coding: utf-8 -*-
 # This code was generously pilfered from https://bitbucket.org/Jeffrey/gevent-websocket
 # written by Jeffrey Gelens (http://noppo.pro/) and licensed under the Apache License, Version 2.0
+import os
+import re
 import six
 import struct
-from socket import error as socket_error
+from collections import deque
+from socket import socket, error as socket_error
 from django.core.handlers.wsgi import logger
+from ws4redis import settings as private_settings, stats
+from ws4redis.timers import clock
 from ws4redis.utf8validator import Utf8Validator
 from ws4redis.exceptions import WebSocketError, FrameTooLargeException
 
+try:
+    from socket import MSG_DONTWAIT
+except ImportError:
+    MSG_DONTWAIT = 0
+
+_TYPE_RE = re.compile(br'"type": ?"(\w+)"')
+_FACILITY_RE = re.compile(br',"facility":"([^"]*)"}$')
+
 
 if six.PY3:
     xrange = range
 
+## use Cython implementation of the frame masking if available
+##
+try:
+    from wsaccel.xormask import XorMaskerSimple
+except ImportError:
+    XorMaskerSimple = None
+
 
 class WebSocket(object):
-    __slots__ = ('_closed', 'stream', 'utf8validator', 'utf8validate_last')
+    __slots__ = ('_closed', 'stream', 'utf8validator', 'utf8validate_last', 'deflate', 'encoder',
+                 '_outbox', '_outbox_size', '_superseded', '_partial', '_input', '_input_start', '_input_end',
+                 '_message', '_opcode', '_compressed', 'received_at', 'sent_at', 'pinged_at')
 
     OPCODE_CONTINUATION = 0x00
     OPCODE_TEXT = 0x01
@@ -23,11 +45,38 @@ class WebSocket(object):
     OPCODE_PING = 0x09
     OPCODE_PONG = 0x0a
 
-    def __init__(self, wsgi_input):
+    # received data is read into a buffer of this size, which grows for larger frames and is
+    # given back once it exceeds MAX_IDLE_BUFFER_SIZE and has been consumed
+    INPUT_BUFFER_SIZE = 4096
+    MAX_IDLE_BUFFER_SIZE = 64 * 1024
+    MAX_FRAME_SIZE = 1 << 20
+
+    def __init__(self, wsgi_input, deflate=None, encoder=None):
+        """
+        ``deflate`` is the negotiated ``PerMessageDeflate``, if any. ``encoder`` encodes text
+        messages for the negotiated subprotocol, returning None for those to be sent as they are.
+        """
         self._closed = False
         self.stream = Stream(wsgi_input)
         self.utf8validator = Utf8Validator()
         self.utf8validate_last = None
+        self.deflate = deflate
+        self.encoder = encoder
+        # frames waiting for the socket to become writable, as [data, outbox key] pairs
+        self._outbox = deque()
+        self._outbox_size = 0
+        self._superseded = {}
+        # whether the first frame of the outbox has been written in part
+        self._partial = False
+        # received data not consumed yet, frames are parsed straight out of the buffer
+        self._input = bytearray(self.INPUT_BUFFER_SIZE)
+        self._input_start = self._input_end = 0
+        # the fragments of the message being received
+        self._message = None
+        self._opcode = None
+        self._compressed = False
+        # when the peer was last heard from, last sent a frame, and last pinged, for keep_alive
+        self.received_at = self.sent_at = self.pinged_at = clock()
 
     def __del__(self):
         try:
@@ -84,6 +133,14 @@ class WebSocket(object):
     def closed(self):
         return self._closed
 
+    @property
+    def outbox_size(self):
+        """
+        The number of bytes waiting to be written, the socket shall be polled for writability
+        and ``flush`` be called while this is not 0.
+        """
+        return self._outbox_size
+
     def handle_close(self, header, payload):
         """
         Called when a close frame has been decoded from the stream.
@@ -117,31 +174,80 @@ class WebSocket(object):
     def handle_pong(self, header, payload):
         pass
 
+    @property
+    def buffered(self):
+        """
+        The number of bytes received but not consumed yet. As these may hold further frames,
+        ``receive`` shall be called again before waiting for the socket to become readable.
+        """
+        return self._input_end - self._input_start
+
+    def has_frame(self):
+        """
+        Whether a complete frame is buffered, which ``read_frame`` returns without reading the socket.
+        """
+        decoded = Header.decode_header(self._input, self._input_start, self._input_end)
+        return decoded is not None and self._input_end - decoded[1] >= decoded[0].length
+
+    def _fill(self, size):
+        """
+        Receive into the input buffer, making room for ``size`` bytes from the first unconsumed
+        one. On a non-blocking socket without data, ``BlockingIOError`` is raised.
+        """
+        buffered = self._input_end - self._input_start
+        if self._input_start + size > len(self._input):
+            if size > len(self._input):
+                grown = bytearray(max(size, 2 * len(self._input)))
+                grown[:buffered] = self._input[self._input_start:self._input_end]
+                self._input = grown
+            else:
+                self._input[:buffered] = self._input[self._input_start:self._input_end]
+            self._input_start, self._input_end = 0, buffered
+        received = self.stream.recv_into(memoryview(self._input)[self._input_end:])
+        if not received:
+            raise WebSocketError('Unexpected EOF while reading frame')
+        self._input_end += received
+        self.received_at = clock()
+
     def read_frame(self):
         """
-        Block until a full frame has been read from the socket.
+        Block until a full frame has been read from the socket, or raise ``BlockingIOError`` on a
+        non-blocking socket. Nothing is consumed until the frame is complete, and one ``recv``
+        may fetch many frames sent in a row.
 
         This is an internal method as calling this will not cleanup correctly
         if an exception is called. Use `receive` instead.
 
         :return: The header and payload as a tuple.
         """
-        header = Header.decode_header(self.stream)
-        if header.flags:
-            raise WebSocketError
+        while True:
+            decoded = Header.decode_header(self._input, self._input_start, self._input_end)
+            if decoded is None:
+                self._fill(Header.MAX_SIZE)
+                continue
+            header, offset = decoded
+            if header.length > self.MAX_FRAME_SIZE:
+                raise FrameTooLargeException('Frame exceeds {0} bytes'.format(self.MAX_FRAME_SIZE))
+            if self._input_end - offset >= header.length:
+                break
+            self._fill(offset - self._input_start + header.length)
+        if header.flags and (header.flags != Header.RSV0_MASK or self.deflate is None or
+                             header.opcode not in (self.OPCODE_TEXT, self.OPCODE_BINARY)):
+            # only the first frame of a message may be flagged as compressed
+            raise WebSocketError('Unexpected reserved bits: {0!r}'.format(header))
+        end = offset + header.length
         if not header.length:
-            return header, ''
-        try:
-            payload = self.stream.read(header.length)
-        except socket_error:
-            payload = ''
-        except Exception:
-            logger.debug("{}: {}".format(type(e), six.text_type(e)))
-            payload = ''
-        if len(payload) != header.length:
-            raise WebSocketError('Unexpected EOF reading frame payload')
-        if header.mask:
-            payload = header.unmask_payload(payload)
+            payload = b''
+        elif header.mask:
+            payload = header.unmask_payload(memoryview(self._input)[offset:end])
+        else:
+            payload = bytes(self._input[offset:end])
+        if end == self._input_end:
+            self._input_start = self._input_end = 0
+            if len(self._input) > self.MAX_IDLE_BUFFER_SIZE:
+                self._input = bytearray(self.INPUT_BUFFER_SIZE)
+        else:
+            self._input_start = end
         return header, payload
 
     def validate_utf8(self, payload):
@@ -155,53 +261,71 @@ class WebSocket(object):
 
     def read_message(self):
         """
-        Return the next text or binary message from the socket.
+        Return the next text or binary message from the socket. The fragments of a message
+        received so far are kept if ``read_frame`` raises ``BlockingIOError``. After a control
+        frame, ``BlockingIOError`` is raised unless another frame is buffered, so that a blocking
+        socket isn't read again before the caller's loop has waited for it.
 
         This is an internal method as calling this will not cleanup correctly
         if an exception is called. Use `receive` instead.
         """
-        opcode = None
-        message = ""
         while True:
             header, payload = self.read_frame()
             f_opcode = header.opcode
+            if header.fin and not header.flags and not self._opcode:
+                # the common case of a message in a single uncompressed frame, whose UTF-8 is
+                # validated by decoding it at once
+                if f_opcode == self.OPCODE_TEXT:
+                    text = payload.decode('utf-8')
+                    return str(payload) if six.PY2 else text
+                if f_opcode == self.OPCODE_BINARY:
+                    return bytearray(payload)
             if f_opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
                 # a new frame
-                if opcode:
+                if self._opcode:
                     raise WebSocketError("The opcode in non-fin frame is expected to be zero, got {0!r}".format(f_opcode))
                 # Start reading a new message, reset the validator
                 self.utf8validator.reset()
                 self.utf8validate_last = (True, True, 0, 0)
-                opcode = f_opcode
+                self._opcode = f_opcode
+                self._compressed = bool(header.flags)
+                self._message = bytearray()
             elif f_opcode == self.OPCODE_CONTINUATION:
-                if not opcode:
+                if not self._opcode:
                     raise WebSocketError("Unexpected frame with opcode=0")
-            elif f_opcode == self.OPCODE_PING:
-                self.handle_ping(header, payload)
-                continue
-            elif f_opcode == self.OPCODE_PONG:
-                self.handle_pong(header, payload)
+            elif f_opcode in (self.OPCODE_PING, self.OPCODE_PONG):
+                if f_opcode == self.OPCODE_PING:
+                    self.handle_ping(header, payload)
+                else:
+                    self.handle_pong(header, payload)
+                if not self.has_frame():
+                    raise BlockingIOError('No frame buffered after a control frame')
                 continue
             elif f_opcode == self.OPCODE_CLOSE:
                 self.handle_close(header, payload)
                 return
             else:
                 raise WebSocketError("Unexpected opcode={0!r}".format(f_opcode))
-            if opcode == self.OPCODE_TEXT:
+            if self._opcode == self.OPCODE_TEXT and not self._compressed:
+                # validated incrementally, since frames may split a code point
                 self.validate_utf8(payload)
-                if six.PY3:
-                    payload = payload.decode()
-            message += payload
+            self._message += payload
             if header.fin:
                 break
+        opcode, message, compressed = self._opcode, self._message, self._compressed
+        self._opcode = self._message = None
+        if compressed:
+            message = bytearray(self.deflate.decompress(message))
+            if opcode == self.OPCODE_TEXT:
+                self.validate_utf8(message)
         if opcode == self.OPCODE_TEXT:
+            if not self.utf8validate_last[1]:
+                raise UnicodeError("Text message ends within a UTF-8 code point")
             if six.PY2:
-                self.validate_utf8(message)
-            else:
-                self.validate_utf8(message.encode())
-            return message
+                return str(message)
+            return message.decode('utf-8')
         else:
-            return bytearray(message)
+            return message
 
     def receive(self):
         """
@@ -212,6 +336,9 @@ class WebSocket(object):
             raise WebSocketError("Connection is already closed")
         try:
             return self.read_message()
+        except (BlockingIOError, InterruptedError):
+            # no complete message yet
+            raise
         except UnicodeError as e:
             logger.info('websocket.receive: UnicodeError {}'.format(e))
             self.close(1007)
@@ -224,13 +351,131 @@ class WebSocket(object):
 
     def flush(self):
         """
-        Flush a websocket. In this implementation intentionally it does nothing.
+        Write as much of the queued frames as the socket takes without blocking.
         """
-        pass
+        outbox = self._outbox
+        while outbox:
+            entry = outbox[0]
+            if entry[0] is None:
+                # dropped or superseded
+                outbox.popleft()
+                continue
+            if entry[2] is not None:
+                # frames are compressed in the order they are written, so that dropping one never
+                # breaks the compression context shared with the client
+                self._forget(entry)
+                size = len(entry[0])
+                entry[0] = memoryview(self._encode_frame(entry[0], entry[2]))
+                entry[2] = None
+                self._outbox_size += len(entry[0]) - size
+            try:
+                sent = self.stream.send(entry[0])
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket_error:
+                raise WebSocketError("Socket is dead")
+            self._outbox_size -= sent
+            if sent < len(entry[0]):
+                entry[0] = entry[0][sent:]
+                self._partial = True
+                return
+            outbox.popleft()
+            self._partial = False
 
-    def send_frame(self, message, opcode):
+    def _forget(self, entry):
+        if entry[1] is not None and self._superseded.get(entry[1]) is entry:
+            del self._superseded[entry[1]]
+        entry[1] = None
+
+    @staticmethod
+    def get_outbox_key(message):
         """
-        Send a frame over the websocket with message as its payload
+        Return the key under which a message may be dropped or superseded while waiting to be
+        written, or None if it must be delivered. See ``WS4REDIS_OUTBOX``.
+        """
+        droppable = private_settings.WS4REDIS_OUTBOX['droppable']
+        if not droppable or message[:1] not in (b'{', u'{'):
+            return None
+        if not isinstance(message, six.binary_type):
+            message = message.encode('utf-8')
+        match = _TYPE_RE.search(message, 0, 64)
+        if match is None:
+            return None
+        kind = match.group(1).decode('ascii')
+        if kind not in droppable:
+            return None
+        if droppable[kind] is None:
+            key = kind
+        else:
+            field = re.search(br'"' + droppable[kind].encode('ascii') + br'": ?(\d+|"[^"]*")', message)
+            if field is None:
+                return None
+            key = '{0}:{1}'.format(kind, field.group(1).decode('utf-8'))
+        # on a multiplexed websocket, messages only supersede those of the same facility
+        facility = _FACILITY_RE.search(message, max(0, len(message) - 80))
+        return facility and '{0}:{1}'.format(facility.group(1).decode('utf-8'), key) or key
+
+    def _enqueue(self, payload, opcode, key):
+        options = private_settings.WS4REDIS_OUTBOX
+        if key is not None and options['policy'] == 'coalesce':
+            queued = self._superseded.get(key)
+            if queued is not None:
+                self._outbox_size -= len(queued[0])
+                queued[0] = queued[1] = None
+                stats.incr('outbox.coalesced')
+        entry = [payload, key, opcode]
+        self._outbox.append(entry)
+        self._outbox_size += len(payload)
+        if key is not None:
+            self._superseded[key] = entry
+        if self._outbox_size <= options['max_bytes']:
+            return
+        if options['policy'] != 'disconnect':
+            # drop the oldest events which may be lost
+            for queued in self._outbox:
+                if queued[1] is not None:
+                    self._outbox_size -= len(queued[0])
+                    queued[0] = None
+                    self._forget(queued)
+                    stats.incr('outbox.dropped')
+                    if self._outbox_size <= options['max_bytes']:
+                        return
+        stats.incr('outbox.disconnected')
+        # the rest of a frame written in part has to go before the close frame, all else is dropped
+        pending = self._outbox[0][0] if self._partial else b''
+        self._outbox.clear()
+        self._outbox_size = 0
+        self._superseded.clear()
+        self._partial = False
+        self._closed = True
+        self._write_close(pending, 1008, 'Slow consumer')
+        raise WebSocketError("Slow consumer, more than {0} bytes outstanding".format(options['max_bytes']))
+
+    def _write_close(self, pending, code, message):
+        """
+        Write a close frame straight to the socket, past the outbox, following ``pending``. This is
+        best effort: what the socket doesn't take without blocking is lost along with the connection.
+        """
+        message = self._encode_bytes(message)
+        frame = self._encode_frame(struct.pack('!H%ds' % len(message), code, message), self.OPCODE_CLOSE)
+        try:
+            self.stream.send(bytes(pending) + frame)
+        except socket_error:
+            logger.debug("Failed to write closing frame of a slow consumer")
+
+    def _encode_frame(self, message, opcode):
+        flags = 0
+        if self.deflate is not None and opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+            compressed = self.deflate.compress(message)
+            if compressed is not None:
+                message = compressed
+                flags = Header.RSV0_MASK
+        return Header.encode_header(True, opcode, '', len(message), flags) + message
+
+    def send_frame(self, message, opcode, key=None):
+        """
+        Send a frame over the websocket with message as its payload. Whatever the socket doesn't
+        take right away is queued, under ``key`` if the message may be dropped or superseded.
         """
         if self._closed:
             raise WebSocketError("Connection is already closed")
@@ -238,11 +483,16 @@ class WebSocket(object):
             message = self._encode_bytes(message)
         elif opcode == self.OPCODE_BINARY:
             message = six.binary_type(message)
-        header = Header.encode_header(True, opcode, '', len(message), 0)
-        try:
-            self.stream.write(header + message)
-        except socket_error:
-            raise WebSocketError("Socket is dead")
+        self._enqueue(message, opcode, key)
+        self.sent_at = clock()
+        self.flush()
+
+    def ping(self):
+        """
+        Ask the peer for a pong, browsers answer pings on their own, even in background tabs.
+        """
+        self.send_frame(b'', self.OPCODE_PING)
+        self.pinged_at = self.sent_at
 
     def send(self, message, binary=False):
         """
@@ -250,11 +500,13 @@ class WebSocket(object):
         """
         if binary is None:
             binary = not isinstance(message, six.string_types)
+        key = None if binary else self.get_outbox_key(message)
+        if self.encoder is not None and not binary:
+            encoded = self.encoder(message)
+            if encoded is not None:
+                message, binary = encoded, True
         opcode = self.OPCODE_BINARY if binary else self.OPCODE_TEXT
-        try:
-            self.send_frame(message, opcode)
-        except WebSocketError:
-            raise WebSocketError("Socket is dead")
+        self.send_frame(message, opcode, key)
 
     def close(self, code=1000, message=''):
         """
@@ -283,16 +535,24 @@ class Stream(object):
     object that can be read from/written to by the lower level websocket api.
     """
 
-    __slots__ = ('read', 'write', 'fileno')
+    __slots__ = ('read', 'recv_into', 'send', 'fileno')
 
     def __init__(self, wsgi_input):
-        if six.PY2:
-            self.read = wsgi_input._sock.recv
-            self.write = wsgi_input._sock.sendall
+        if isinstance(wsgi_input, socket):
+            # a raw socket, handed over by the event driven hub
+            sock = wsgi_input
+        elif six.PY2:
+            sock = wsgi_input._sock
         else:
-            self.read = wsgi_input.raw._sock.recv
-            self.write = wsgi_input.raw._sock.sendall
-        self.fileno = wsgi_input.fileno()
+            sock = wsgi_input.raw._sock
+        self.read = sock.recv
+        self.recv_into = sock.recv_into
+        self.fileno = sock.fileno()
+        if sock.gettimeout() is None and MSG_DONTWAIT:
+            self.send = lambda data: sock.send(data, MSG_DONTWAIT)
+        else:
+            # a socket with a timeout is non-blocking underneath, but its send would wait
+            self.send = lambda data: os.write(self.fileno, data)
 
 
 class Header(object):
@@ -309,6 +569,9 @@ class Header(object):
     # bitwise mask that will determine the reserved bits for a frame header
     HEADER_FLAG_MASK = RSV0_MASK | RSV1_MASK | RSV2_MASK
 
+    # two octets, a 64 bit length and a mask
+    MAX_SIZE = 14
+
     def __init__(self, fin=0, opcode=0, flags=0, length=0):
         self.mask = ''
         self.fin = fin
@@ -317,12 +580,20 @@ class Header(object):
         self.length = length
 
     def mask_payload(self, payload):
+        length = len(payload)
+        if not length:
+            return payload
+        if XorMaskerSimple is not None:
+            return XorMaskerSimple(self.mask).process(bytes(payload))
+        if six.PY3:
+            # XOR the whole payload at once against the 4-byte key, repeated to its length
+            key = (self.mask * (length // 4 + 1))[:length]
+            masked = int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')
+            return masked.to_bytes(length, 'big')
         payload = bytearray(payload)
         mask = bytearray(self.mask)
-        for i in xrange(self.length):
+        for i in xrange(length):
             payload[i] ^= mask[i % 4]
-        if six.PY3:
-            return bytes(payload)
         return str(payload)
 
     # it's the same operation
@@ -334,18 +605,19 @@ class Header(object):
                                    self.flags, id(self))
 
     @classmethod
-    def decode_header(cls, stream):
+    def decode_header(cls, data, start=0, end=None):
         """
-        Decode a WebSocket header.
+        Decode a WebSocket header from a buffer.
 
-        :param stream: A file like object that can be 'read' from.
-        :returns: A `Header` instance.
+        :param data: A buffer holding the received data, of which ``data[start:end]`` is unconsumed.
+        :returns: A `Header` instance and the offset of the payload in ``data``, or None if the
+                  header is incomplete.
         """
-        read = stream.read
-        data = read(2)
-        if len(data) != 2:
-            raise WebSocketError("Unexpected EOF while decoding header")
-        first_byte, second_byte = struct.unpack('!BB', data)
+        if end is None:
+            end = len(data)
+        if end - start < 2:
+            return None
+        first_byte, second_byte = data[start], data[start + 1]
         header = cls(
             fin=first_byte & cls.FIN_MASK == cls.FIN_MASK,
             opcode=first_byte & cls.OPCODE_MASK,
@@ -354,28 +626,29 @@ class Header(object):
         has_mask = second_byte & cls.MASK_MASK == cls.MASK_MASK
         if header.opcode > 0x07:
             if not header.fin:
-                raise WebSocketError('Received fragmented control frame: {0!r}'.format(data))
+                raise WebSocketError('Received fragmented control frame: {0!r}'.format(header))
             # Control frames MUST have a payload length of 125 bytes or less
             if header.length > 125:
-                raise FrameTooLargeException('Control frame cannot be larger than 125 bytes: {0!r}'.format(data))
+                raise FrameTooLargeException('Control frame cannot be larger than 125 bytes: {0!r}'.format(header))
+        offset = start + 2
         if header.length == 126:
             # 16 bit length
-            data = read(2)
-            if len(data) != 2:
-                raise WebSocketError('Unexpected EOF while decoding header')
-            header.length = struct.unpack('!H', data)[0]
+            if end - offset < 2:
+                return None
+            header.length = struct.unpack_from('!H', data, offset)[0]
+            offset += 2
         elif header.length == 127:
             # 64 bit length
-            data = read(8)
-            if len(data) != 8:
-                raise WebSocketError('Unexpected EOF while decoding header')
-            header.length = struct.unpack('!Q', data)[0]
+            if end - offset < 8:
+                return None
+            header.length = struct.unpack_from('!Q', data, offset)[0]
+            offset += 8
         if has_mask:
-            mask = read(4)
-            if len(mask) != 4:
-                raise WebSocketError('Unexpected EOF while decoding header')
-            header.mask = mask
-        return header
+            if end - offset < 4:
+                return None
+            header.mask = bytes(data[offset:offset + 4])
+            offset += 4
+        return header, offset
 
     @classmethod
     def encode_header(cls, fin, opcode, mask, length, flags):
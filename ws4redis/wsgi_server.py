@@ -16,11 +16,18 @@ from django.core.exceptions import PermissionDenied
 from django import http
 from django.utils.encoding import force_str
 from django.utils.functional import SimpleLazyObject
-from ws4redis import settings as private_settings
+from ws4redis import settings as private_settings, stats
 from ws4redis.redis_store import RedisMessage
-from ws4redis.exceptions import WebSocketError, HandshakeError, UpgradeRequiredError
+from ws4redis.timers import clock
+from ws4redis.admission import Admission, get_refusal_response
+from ws4redis.tickets import TicketUser, read_ticket
+from ws4redis.exceptions import WebSocketError, HandshakeError, UpgradeRequiredError, ServiceUnavailableError
+from ws4redis.multiplex import MULTIPLEX_FACILITY, MAX_FACILITIES, Facility, Multiplex, get_facility_request, \
+    parse_control, tag_message
 
-from lanes.models import User, Organisation, OrgMembership
+from lanes.models import OrgMembership
+from lanes.commands import RoomCommands
+from lanes.presence import Presence
 
 import logging
 
@@ -46,6 +53,7 @@ class WebsocketWSGIServer(object):
         self.possible_channels = Subscriber.subscription_channels + Subscriber.publish_channels
         self._redis_connection = redis_connection and redis_connection or StrictRedis(**private_settings.WS4REDIS_CONNECTION)
         self.Subscriber = Subscriber
+        self.admission = Admission()
 
     def assure_protocol_requirements(self, environ):
         if environ.get('REQUEST_METHOD') != 'GET':
@@ -60,6 +68,11 @@ class WebsocketWSGIServer(object):
     def process_request(self, request):
         request.session = None
         request.user = None
+        # a page which issued a ticket has authenticated the user already
+        request.ticket = read_ticket(request.GET.get('ticket'))
+        if request.ticket is not None:
+            request.user = TicketUser(request.ticket)
+            return
         session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME, None)
         if session_key is not None:
             engine = import_module(settings.SESSION_ENGINE)
@@ -77,75 +90,307 @@ class WebsocketWSGIServer(object):
                 echo_message = True
         return agreed_channels, echo_message
 
+    def prepare_request(self, environ):
+        """
+        Check the handshake, authenticate the client and resolve the channels it may use.
+        Returns the request, the agreed channels and whether messages shall be echoed.
+        """
+        self.assure_protocol_requirements(environ)
+        # shed load before loading any session
+        self.admission.check_handshake()
+        request = WSGIRequest(environ)
+        if callable(private_settings.WS4REDIS_PROCESS_REQUEST):
+            private_settings.WS4REDIS_PROCESS_REQUEST(request)
+        else:
+            self.process_request(request)
+        channels, echo_message = self.process_subscriptions(request)
+        return request, self.get_allowed_channels(request, channels), echo_message
+
+    def get_allowed_channels(self, request, channels):
+        """
+        Restrict the ``channels`` requested for the facility of ``request`` to those allowed by
+        ``WS4REDIS_ALLOWED_CHANNELS``, which may also raise ``PermissionDenied``. A request
+        authorized by a ticket may only open the facilities listed in it.
+        """
+        ticket = getattr(request, 'ticket', None)
+        if ticket is not None:
+            facility = request.path_info.rsplit('/', 1)[-1]
+            if facility != MULTIPLEX_FACILITY and facility not in ticket['facilities']:
+                raise PermissionDenied('Facility {0} is not covered by the ticket'.format(facility))
+        if callable(private_settings.WS4REDIS_ALLOWED_CHANNELS):
+            channels = list(private_settings.WS4REDIS_ALLOWED_CHANNELS(request, channels))
+        elif private_settings.WS4REDIS_ALLOWED_CHANNELS is not None:
+            try:
+                mod, callback = private_settings.WS4REDIS_ALLOWED_CHANNELS.rsplit('.', 1)
+                callback = getattr(import_module(mod), callback, None)
+                if callable(callback):
+                    channels = list(callback(request, channels))
+            except AttributeError:
+                pass
+        return channels
+
+    def on_open(self, request, subscriber, name):
+        """
+        Called once the websocket for facility ``name`` is established.
+        """
+        if name[:4] == 'org_' and request.user and request.user.is_authenticated():
+            ticket = getattr(request, 'ticket', None)
+            Presence(name[4:]).go_online(request.user, ticket and ticket.get('author'))
+            subscriber.set_present(request.user, True, name)
+
+    def get_missed_messages(self, request, subscriber):
+        """
+        Return the messages a client reconnecting with ``?since=<seq>`` has missed.
+        """
+        since = request.GET.get('since', '')
+        if not since.isdigit() or private_settings.WS4REDIS_REPLAY_LENGTH <= 0:
+            return []
+        return subscriber.get_missed_messages(int(since))
+
+    def on_receive(self, request, subscriber, name, message):
+        """
+        Called with each message received on a websocket for facility ``name``. Returns the reply
+        for the client if the message has been consumed as a command, otherwise None and the
+        message is published.
+        """
+        if not message:
+            return None
+        commands = getattr(request, 'commands', None)
+        if commands is None and name[:5] == 'room_' and request.user and request.user.is_authenticated():
+            # loaded with the first message, so that opening a room costs no queries
+            commands = request.commands = RoomCommands(request, int(name[5:]))
+        if commands is None:
+            return None
+        return commands.handle(message)
+
+    def on_heartbeat(self, request, subscriber, name):
+        """
+        Called each time ``keep_alive`` checked an open websocket on facility ``name``, which is
+        at least every third of WS4REDIS_PRESENCE_TIMEOUT.
+        """
+        if name[:4] == 'org_' and request.user and request.user.is_authenticated():
+            subscriber.set_present(request.user, True, name)
+
+    def keep_alive(self, websocket, now):
+        """
+        Send a heartbeat to a websocket which hasn't been sent anything for a while, ping a client
+        which hasn't been heard from and close the websocket of one which stays silent. Returns when
+        the websocket shall be checked again, or None once it has been closed.
+        """
+        timeouts = private_settings.WS4REDIS_KEEPALIVE
+        if now - websocket.received_at >= timeouts['idle']:
+            stats.incr('connections.idle')
+            websocket.close(code=1001, message='Idle timeout')
+            return None
+        if now - max(websocket.received_at, websocket.pinged_at) >= timeouts['ping']:
+            websocket.ping()
+        if private_settings.WS4REDIS_HEARTBEAT and now - websocket.sent_at >= timeouts['heartbeat']:
+            websocket.send(private_settings.WS4REDIS_HEARTBEAT)
+        deadline = min(websocket.received_at + timeouts['idle'],
+                       max(websocket.received_at, websocket.pinged_at) + timeouts['ping'],
+                       now + private_settings.WS4REDIS_PRESENCE_TIMEOUT / 3.0)
+        if private_settings.WS4REDIS_HEARTBEAT:
+            deadline = min(deadline, websocket.sent_at + timeouts['heartbeat'])
+        return deadline
+
+    def get_facilities(self, request, name, multiplex):
+        """
+        Return the ``(request, facility)`` pairs served by a websocket, which are those opened on
+        it if it is multiplexed.
+        """
+        if multiplex is None:
+            return [(request, name)]
+        return [(facility.request, facility.name) for facility in multiplex.facilities.values()]
+
+    def on_multiplex(self, request, multiplex, message):
+        """
+        Handle a control message received on a multiplexed websocket. Returns the messages to
+        send back to the client.
+        """
+        control = parse_control(message)
+        if control is None:
+            return []
+        op, name = control.get('op'), control['facility']
+        if op == 'subscribe':
+            return self.open_facility(request, multiplex, name, control)
+        facility = multiplex.facilities.get(name)
+        if facility is None:
+            return []
+        if op == 'unsubscribe':
+            self.close_facility(multiplex, name)
+        elif op == 'send':
+            payload = control.get('message')
+            if not isinstance(payload, six.string_types):
+                return []
+            reply = self.on_receive(facility.request, multiplex.subscriber, name, payload)
+            if reply:
+                return [tag_message(reply, name)]
+            facility.recvmsg = RedisMessage(payload)
+            if facility.recvmsg and facility.publishers:
+                multiplex.subscriber.publish_messages([(key, facility.recvmsg) for key in facility.publishers])
+        return []
+
+    def open_facility(self, request, multiplex, name, control):
+        """
+        Open facility ``name`` on a multiplexed websocket for the channels requested by the
+        ``control`` message, checked as for a websocket of its own, and return the messages the
+        client missed since the sequence number it passed. A facility which is refused is answered
+        with a message of type ``refused``.
+        """
+        self.close_facility(multiplex, name)
+        requested = [channel for channel in control.get('channels') or () if isinstance(channel, six.string_types)]
+        channels = [channel for channel in requested if channel in self.possible_channels]
+        facility_request = get_facility_request(request, name, channels)
+        try:
+            if name == MULTIPLEX_FACILITY or len(multiplex.facilities) >= MAX_FACILITIES:
+                raise PermissionDenied('Too many facilities')
+            channels = self.get_allowed_channels(facility_request, channels)
+        except PermissionDenied as excpt:
+            logger.warning('PermissionDenied: {}'.format(excpt))
+            channels = []
+        if not channels:
+            return [tag_message('{"type":"refused"}', name)]
+        publishers, keys = multiplex.subscriber.get_channel_keys(facility_request, channels)
+        multiplex.add(Facility(name, facility_request, keys, publishers, 'echo' in requested))
+        try:
+            self.on_open(facility_request, multiplex.subscriber, name)
+        except Exception as excpt:
+            logger.error('Other Exception: {}'.format(excpt), exc_info=sys.exc_info())
+            self.close_facility(multiplex, name)
+            return [tag_message('{"type":"refused"}', name)]
+        since = control.get('since')
+        if not isinstance(since, six.integer_types) or since < 0 or private_settings.WS4REDIS_REPLAY_LENGTH <= 0:
+            return []
+        return [tag_message(message, name) for message in multiplex.subscriber.get_missed_messages(since, keys)]
+
+    def close_facility(self, multiplex, name):
+        facility = multiplex.remove(name)
+        if facility is not None:
+            self.on_close(facility.request, multiplex.subscriber, name)
+
+    def on_expired(self, key, name):
+        """
+        Called with the key of an expired Redis entry, for a websocket on facility ``name``.
+        Returns True if the key has been consumed and must not be forwarded to the client.
+        """
+        # redis-cli config set notify-keyspace-events Kx
+        if isinstance(key, six.binary_type):
+            key = key.decode()
+        if name[:4] == 'org_' and key[:14] == 'users_present:':
+            prefix = 'users_present:' + name + ':'
+            if key[:len(prefix)] == prefix:
+                Presence(name[4:]).set_status(int(key[len(prefix):]), OrgMembership.STATUS_OFFLINE)
+            return True
+        return False
+
+    def on_close(self, request, subscriber, name=''):
+        """
+        Called after the websocket has been closed, or the handshake failed.
+        """
+        if name[:4] == 'org_' and request is not None and request.user and request.user.is_authenticated():
+            subscriber.set_present(request.user, False, name)
+
     def __call__(self, environ, start_response):
         """
         Hijack the main loop from the original thread and listen on events on the Redis
         and the Websocket filedescriptors.
         """
         websocket = None
+        request = None
         subscriber = self.Subscriber(self._redis_connection)
         name = ''
+        multiplex = None
+        ticket = None
         try:
-            self.assure_protocol_requirements(environ)
-            request = WSGIRequest(environ)
-            if callable(private_settings.WS4REDIS_PROCESS_REQUEST):
-                private_settings.WS4REDIS_PROCESS_REQUEST(request)
-            else:
-                self.process_request(request)
-            channels, echo_message = self.process_subscriptions(request)
-            if callable(private_settings.WS4REDIS_ALLOWED_CHANNELS):
-                channels = list(private_settings.WS4REDIS_ALLOWED_CHANNELS(request, channels))
-            elif private_settings.WS4REDIS_ALLOWED_CHANNELS is not None:
-                try:
-                    mod, callback = private_settings.WS4REDIS_ALLOWED_CHANNELS.rsplit('.', 1)
-                    callback = getattr(import_module(mod), callback, None)
-                    if callable(callback):
-                        channels = list(callback(request, channels))
-                except AttributeError:
-                    pass
+            request, channels, echo_message = self.prepare_request(environ)
+            ticket = self.admission.enter(request)
             websocket = self.upgrade_websocket(environ, start_response)
             subscriber.set_pubsub_channels(request, channels)
             websocket_fd = websocket.get_file_descriptor()
-            listening_fds = [websocket_fd]
             redis_fd = subscriber.get_file_descriptor()
-            if redis_fd:
-                listening_fds.append(redis_fd)
             name = request.path.split('/')[-1]
-            if request.user and name[:4] == 'org_':
-                request.user.set_status(Organisation.objects.get(slug=name[4:]), OrgMembership.STATUS_ONLINE)
-                subscriber.set_present(request.user, True)
+            if name == MULTIPLEX_FACILITY:
+                multiplex = Multiplex(subscriber, subscriber.subscribe_channels, subscriber.unsubscribe_channels)
+            self.on_open(request, subscriber, name)
+            # subscribed before fetching, so that nothing published meanwhile is lost
+            for message in self.get_missed_messages(request, subscriber):
+                websocket.send(message)
             recvmsg = None
+            next_check = self.keep_alive(websocket, clock())
             while websocket and not websocket.closed:
-                ready = self.select(listening_fds, [], [], 4.0)[0]
-                if not ready:
+                # this loop may be (re-)elected to watch the shared pubsub connection at any time
+                shared_fds = subscriber.get_shared_file_descriptors()
+                listening_fds = [fd for fd in (websocket_fd, redis_fd) if fd] + shared_fds
+                # wait for a slow client to take what's queued for it, meanwhile Redis is drained
+                writing_fds = [websocket_fd] if getattr(websocket, 'outbox_size', 0) else []
+                # frames received along with the last one are already buffered, a partial frame
+                # however waits for the socket, which would block until the rest arrives
+                buffered = getattr(websocket, 'buffered', 0) and websocket.has_frame()
+                timeout = 0 if buffered else max(0.0, next_check - clock())
+                ready, writable = self.select(listening_fds, writing_fds, [], timeout)[:2]
+                if buffered and websocket_fd not in ready:
+                    ready.append(websocket_fd)
+                if not ready or writable:
                     # flush empty socket
                     websocket.flush()
                 for fd in ready:
-                    if fd == websocket_fd:
-                        recv = websocket.receive()
+                    if fd in shared_fds:
+                        subscriber.dispatch()
+                    elif fd == websocket_fd:
+                        # commands query the database, meanwhile other loops must not wait for this one
+                        subscriber.hand_over()
+                        try:
+                            recv = websocket.receive()
+                        except BlockingIOError:
+                            # a control frame was consumed, nothing else has arrived yet
+                            continue
+                        if multiplex is not None:
+                            for message in self.on_multiplex(request, multiplex, recv):
+                                websocket.send(message)
+                            continue
+                        reply = self.on_receive(request, subscriber, name, recv)
+                        if reply:
+                            websocket.send(reply)
+                            continue
                         recvmsg = RedisMessage(recv)
                         if recvmsg:
                             subscriber.publish_message(recvmsg)
                     elif fd == redis_fd:
-                        sendmsg = RedisMessage(subscriber.parse_response())
-                        # redis-cli config set notify-keyspace-events Kx
-                        if sendmsg and name[:4] == 'org_' and len(sendmsg) > 14 and sendmsg[:14] == "users_present:":
-                            User.objects.get(id=sendmsg[14:]).set_status(Organisation.objects.get(slug=name[4:]), OrgMembership.STATUS_OFFLINE)
+                        response = subscriber.parse_response()
+                        sendmsg = RedisMessage(response)
+                        if sendmsg and multiplex is not None:
+                            channel = force_str(response[1])
+                            if channel == subscriber.expired_channel:
+                                for facility_request, facility in self.get_facilities(request, name, multiplex):
+                                    self.on_expired(sendmsg, facility)
+                                continue
+                            sendmsg = multiplex.deliver(channel, sendmsg)
+                            if sendmsg:
+                                websocket.send(sendmsg)
+                            continue
+                        if sendmsg and self.on_expired(sendmsg, name):
                             sendmsg = None
                         if sendmsg and (echo_message or sendmsg != recvmsg):
                             websocket.send(sendmsg)
                     else:
                         logger.error('Invalid file descriptor: {0}'.format(fd))
-                # Check again that the websocket is closed before sending the heartbeat,
+                # Check again that the websocket is closed before keeping it alive,
                 # because the websocket can closed previously in the loop.
-                if private_settings.WS4REDIS_HEARTBEAT and not websocket.closed:
-                    websocket.send(private_settings.WS4REDIS_HEARTBEAT)
+                if not websocket.closed and clock() >= next_check:
+                    next_check = self.keep_alive(websocket, clock())
+                    if next_check is not None:
+                        for facility_request, facility in self.get_facilities(request, name, multiplex):
+                            self.on_heartbeat(facility_request, subscriber, facility)
+                stats.flush(self._redis_connection, 10)
         except WebSocketError as excpt:
             logger.warning('WebSocketError: {}'.format(excpt), exc_info=sys.exc_info())
             response = http.HttpResponse(status=1001, content='Websocket Closed')
         except UpgradeRequiredError as excpt:
             logger.info('Websocket upgrade required')
             response = http.HttpResponseBadRequest(status=426, content=excpt)
+        except ServiceUnavailableError as excpt:
+            logger.info('{0}, retry after {1}s'.format(excpt, excpt.retry_after))
+            response = get_refusal_response(excpt)
         except HandshakeError as excpt:
             logger.warning('HandshakeError: {}'.format(excpt), exc_info=sys.exc_info())
             response = http.HttpResponseBadRequest(content=excpt)
@@ -158,8 +403,10 @@ class WebsocketWSGIServer(object):
         else:
             response = http.HttpResponse()
         finally:
-            subscriber.set_present(request.user, False)
+            for facility_request, facility in self.get_facilities(request, name, multiplex):
+                self.on_close(facility_request, subscriber, facility)
             subscriber.release()
+            self.admission.leave(ticket)
             if websocket:
                 websocket.close(code=1001, message='Websocket Closed')
             else:
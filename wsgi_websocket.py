@@ -1,5 +1,12 @@
 import gevent.monkey
+
+# patched before anything opens a socket, so that Redis and Django yield to other websockets
+gevent.monkey.patch_all()
+
+# psycopg2 doesn't use Python's sockets, its wait callback makes the queries of commands yield too
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
 from ws4redis.uwsgi_runserver import uWSGIWebsocketServer
 
-gevent.monkey.patch_thread()
 application = uWSGIWebsocketServer()